@@ -9,6 +9,8 @@ and that will come in time.
 '''
 
 import asyncio
+from commandRecording import Recorder
+import json
 import logging
 import params
 from playSound import playSound
@@ -16,6 +18,9 @@ import buttshockClient as buttshock
 import dweebClient as dweeb
 import queue
 import random
+from scheduler import AsyncScheduler, Scheduler
+import sessionPlan
+from SurpriseClient import CommandQueue
 import sys
 import threading
 import time
@@ -28,44 +33,89 @@ def noop():
 
 class Surprise:
     def __init__(self, maxSession = params.MAX_SESSION_TIME, testMode=False,
-                 modes=params.USEFUL_ET232_MODES):
+                 modes=params.USEFUL_ET232_MODES, engine=params.engine,
+                 loop=None, scheduler=None, rng=random, clock=time.time,
+                 device=None, sound=playSound, services=True):
+        '''engine is 'threaded' (timer, device and websocket threads) or
+           'async' (everything runs as coroutines and callbacks on loop,
+           normally the tornado IOLoop's asyncio loop, except a device
+           handler with blocking I/O, which keeps its thread).
+
+           The remaining arguments let a simulation (see simulation.py)
+           replace the timers, randomness, wall clock, device handler and
+           sounds.  With services=False neither the websocket server nor
+           the device handler is started.
+        '''
+        self.rng = rng
+        self.clock = clock
+        self.playSound = sound
         self.maxSession = maxSession
         self.sessionTime = 0
         self.onTime = 0
         self.offTime = 0
+        self.teases = 0
         self.idleOn = False
         self.state = 'Idle'
-        self.stateStart = time.time()
+        self.stateStart = self.clock()
         self.stateTime = 0
         self.timer = None
         self.failsafeTimer = None
         self.sessionTimer = None
-        self.device = None
+        self.plan = None
+        self.sessionStart = None
+        self.engine = engine
+        if scheduler is not None:
+            self.loop = loop
+            self.scheduler = scheduler
+        elif engine == 'async':
+            self.loop = loop or asyncio.get_event_loop()
+            self.scheduler = AsyncScheduler(self.loop)
+        else:
+            self.loop = None
+            self.scheduler = Scheduler()
+        self.sessionTimers = self.scheduler.group()
+        self.device = device
+        self.wsHandler = None
         self.locked = False
         self.testMode = testMode
-        self.modes = modes
-        self.queue = queue.Queue()
-        self.wsQueue = queue.Queue()
-        random.shuffle(self.modes)
-        self.modeIndex = random.randint(0, len(self.modes)-1);
-        logging.info('Surprise: maxSession %d, %d modes' % (maxSession, len(modes)))
-
-        wsHandler = wsSurprise.wsHandler(surprise=self, queue=self.wsQueue)
-        wsThread = threading.Thread(name='websocket', target=wsHandler.start)
-        wsThread.start()
-        logging.info('wsThread running')
-
-        if params.estimHandler == 'buttshock':
-            self.device = buttshock.deviceHandler(self.queue, port=params.estimDevice, test=True)
-        elif params.estimHandler == 'dweeb':
-            self.device = dweeb.deviceHandler(self.queue, port=params.estimDevice, test=True)
+        self.modes = list(modes)
+        self.queue = CommandQueue(coalesce=params.coalesceCommands)
+        self.wsQueue = CommandQueue()
+        self.setState(self.state)
+        self.scheduler.start()
+        self.rng.shuffle(self.modes)
+        self.modeIndex = self.rng.randint(0, len(self.modes)-1);
+        logging.info('Surprise: maxSession %d, %d modes, %s engine' % (
+                     maxSession, len(modes), engine))
+
+        if services:
+            wsHandler = wsSurprise.wsHandler(surprise=self, queue=self.wsQueue)
+            self.wsHandler = wsHandler
+            if self.engine == 'async':
+                wsHandler.spawn(wsHandler.serve(), loop=self.loop)
+            else:
+                wsThread = threading.Thread(name='websocket', target=wsHandler.start)
+                wsThread.start()
+                logging.info('wsThread running')
+
+        if self.device is None:
+            if params.estimHandler == 'buttshock':
+                self.device = buttshock.deviceHandler(self.queue, port=params.estimDevice, test=True)
+            elif params.estimHandler == 'dweeb':
+                self.device = dweeb.deviceHandler(self.queue, port=params.estimDevice, test=True)
+        if services and params.commandRecording:
+            self.device.recorder = Recorder(params.commandRecording)
 
         self.queue.put({'cmd': 'release'})
         self.queue.put({'cmd': 'reserve'})
         self.queue.put({'cmd': 'off'})
 
-        t = threading.Thread(name='deviceHandler', target=self.startDevice)
-        t.start()
+        if services:
+            if self.engine == 'async' and not self.device.blocking:
+                self.loop.create_task(self.device.run())
+            else:
+                t = threading.Thread(name='deviceHandler', target=self.startDevice)
+                t.start()
 
         self.keepAliveModeChange()
 
@@ -79,42 +129,61 @@ class Surprise:
         return self.state
 
     def timerStatus(self):
-        now = time.time()
+        now = self.clock()
         timeInState = now - self.stateStart
         return (self.state, self.stateTime, timeInState, self.sessionTime)
 
-    def delay(self, max, min=params.DELAY_MIN):
-        secs = random.randint(min, max)
+    def delay(self, max, min=None):
+        if min is None:
+            min = params.DELAY_MIN
+        secs = self.rng.randint(min, max)
         return secs
 
-    def setTimer(self, secs, function, state):
+    def setTimer(self, secs, function, state, group=None):
+        '''Schedule function to run after secs.  If state is given, also
+           transition to that state.  Timers in a group (normally
+           sessionTimers) are all cancelled by endSession.
+        '''
         logging.info('setTimer %s for %.1f' % (state, secs))
         if self.testMode is True:
             secs = secs / 100
-        timer = threading.Timer(secs, function)
+        if group is None:
+            group = self.scheduler
+        timer = group.schedule(secs, function)
         if state:
             self.timer = timer
-            self.state = state
-            self.stateStart = time.time()
-            self.stateTime = secs
-        timer.start()
+            self.setState(state, secs)
+        return timer
+
+    def setState(self, state, secs=0):
+        '''Enter state, planned to last secs (0 if open-ended).  With the
+           'event' websocket protocol browsers are sent the new state once
+           and count down locally.
+        '''
+        self.state = state
+        self.stateStart = self.clock()
+        self.stateTime = secs
+        if params.wsProtocol == 'event':
+            self.wsUpdate('state', json.dumps({
+                'state': state, 'start': self.stateStart, 'duration': secs,
+                'total': self.sessionTime, 'now': self.clock()}))
 
     def idle(self):
         '''Called once at service startup.  Announce service is started.
         '''
-        playSound('ready')
+        self.playSound('ready')
 
     def startWait(self):
-        self.state = 'Waiting'
+        self.setState('Waiting')
         self.queue.put({'cmd': 'off'})
         if self.testMode:
             failsafeStart = 0.5
         else:
             failsafeStart = params.FAILSAFE_START
         logging.info('waiting for start button or %d seconds' % failsafeStart)
-        self.failsafeTimer = threading.Timer(failsafeStart, self.turnOn)
-        self.failsafeTimer.start()
-        playSound('activated')
+        self.failsafeTimer = self.sessionTimers.schedule(failsafeStart,
+                                                         self.failsafeStart)
+        self.playSound('activated')
 
     def failsafeStart(self):
         logging.info('failsafe start')
@@ -125,16 +194,68 @@ class Surprise:
     def startSurprise(self):
         if self.failsafeTimer:
             self.failsafeTimer.cancel()
-            self.filesafetimer = None
-        random.shuffle(self.modes)
-        self.sessionTimer = threading.Timer(self.maxSession, self.endSession)
-        self.sessionTimer.start()
+            self.failsafeTimer = None
+        self.rng.shuffle(self.modes)
+        self.sessionTimer = self.sessionTimers.schedule(self.maxSession,
+                                                        self.endSession)
         secs = self.delay(params.START_SLEEP_MAX)
         self.offTime = secs
         self.onTime = 0
-        self.setTimer(secs, self.turnOn, 'Starting')
+        self.sessionStart = self.clock()
+        if params.sessionPlan:
+            self.plan = sessionPlan.SessionPlan(
+                sessionPlan.generate(self.rng, self.maxSession, secs,
+                                     self.modes, self.modeIndex,
+                                     (self.device.ma_low, self.device.ma_high)),
+                self.modes, eager=(params.sessionPlan == 'eager'))
+            self.setTimer(secs, self.planStep, 'Starting', self.sessionTimers)
+        else:
+            self.plan = None
+            self.setTimer(secs, self.turnOn, 'Starting', self.sessionTimers)
         self.wsUpdate('status', 'Starting in %d secs' % secs)
-        playSound('starting')
+        self.playSound('starting')
+
+    def planStep(self):
+        '''Carry out the next step of the session plan and schedule the
+           one after it.
+        '''
+        (at, kind, secs, level, teased, mode, ma) = self.plan.advance()
+        if kind == sessionPlan.END:
+            self.endSession()
+            return
+        if teased:
+            logging.info('  teasing!')
+            self.teases += 1
+        if kind == sessionPlan.ON:
+            self.onTime += secs
+            self.sessionTime += secs
+            self.setState('On', secs)
+            self.applyPlannedChange(level, mode, ma)
+        elif kind == sessionPlan.CHANGE:
+            self.applyPlannedChange(level, mode, ma)
+        elif kind == sessionPlan.OFF:
+            self.offTime += secs
+            self.sessionTime += secs
+            self.setState('Off', secs)
+            logging.info('Turning off')
+            self.queue.put({'cmd': 'off'})
+            self.wsUpdate('status', 'Off')
+        following = self.plan.peek()
+        self.setTimer(following[0] - at, self.planStep, None, self.sessionTimers)
+
+    def applyPlannedChange(self, level, mode, ma):
+        '''Queue the mode, MA and power the plan settled on.'''
+        # Carry on the rotation from here once the session is over.
+        self.modeIndex = mode + 1
+        self.queueModeAndPowerChange(level, self.plan.modes[mode], ma)
+
+    def planPreview(self):
+        '''The current (or last) session plan, None without one.'''
+        if self.plan is None:
+            return None
+        preview = self.plan.preview()
+        preview['sessionStart'] = self.sessionStart
+        return preview
 
     def nextMode(self):
         mode = self.modes[self.modeIndex % len(self.modes)]
@@ -153,33 +274,35 @@ class Surprise:
             self.queueModeChange()
         self.setTimer(params.keepaliveInterval, self.keepAliveModeChange, None)
 
-    def queueModeAndPowerChange(self):
+    def queueModeAndPowerChange(self, level=None, mode=None, ma=None):
+        '''level is an index into params.onCommand; it, the mode and the
+           MA are drawn if not given.
+        '''
         if self.state == 'On':
-            newMode = self.queueModeChange()
-            level = params.onCommand[random.randint(0, len(params.onCommand) - 1)]
+            newMode = self.queueModeChange(mode, ma)
+            if level is None:
+                level = self.rng.randint(0, len(params.onCommand) - 1)
+            level = params.onCommand[level]
             logging.info('Turning %s, %s' % (level, newMode))
             self.wsUpdate('status', '%s, %s' % (newMode, level))
             self.queue.put({'cmd': level})
             if params.announcePower is True:
-                playSound(level)
+                self.playSound(level)
 
-    def queueModeChange(self):
-        mode = self.nextMode()
-        maValue = self.device.randomMA()
+    def queueModeChange(self, mode=None, maValue=None):
+        if mode is None:
+            mode = self.nextMode()
+        if maValue is None:
+            maValue = self.device.randomMA()
         self.queue.put({'cmd': 'set_ma', 'value': maValue})
         self.queue.put({'cmd': 'set_mode', 'value': mode})
         return '%s, MA %d' % (mode, maValue)
 
     def calculateTime(self, max, percentage):
-        secs = self.delay(max)
-        amounts = [secs]
-        while random.randint(0, 100) < percentage:
-            more = self.delay(max)
-            secs += more
-            amounts.append(more)
-        if secs > 10 and random.randint(0, 100) < params.TEASE_PERCENT:
+        (secs, amounts, teased) = sessionPlan.interval(self.rng, max, percentage)
+        if teased:
             logging.info('  teasing!')
-            secs /= 10
+            self.teases += 1
         logging.debug('Interval %d seconds %s' % (secs, amounts))
         self.sessionTime += secs
         return secs
@@ -201,17 +324,16 @@ class Surprise:
         secs = self.calculateTime(params.ESTIM_ON_MAX,
                                   params.ADD_ON_PERCENT)
         self.onTime += secs
-        self.setTimer(secs, self.turnOff, 'On')
-        t = 0
-        while (secs - t) > 120:
-            t = random.randint(max(60,t),secs-20)
+        self.setTimer(secs, self.turnOff, 'On', self.sessionTimers)
+        for t in sessionPlan.changeTimes(self.rng, secs):
             logging.info('scheduling mode/power change after %d' % t)
-            self.setTimer(t, self.queueModeAndPowerChange, None)
+            self.setTimer(t, self.queueModeAndPowerChange, None,
+                          self.sessionTimers)
 
         self.queueModeAndPowerChange()
 
     def reallyTurnOn(self):
-        self.state = 'IdleOn'
+        self.setState('IdleOn')
         self.idleOn = True
         self.queueModeChange()
         self.wsUpdate('status', 'On Max')
@@ -225,44 +347,44 @@ class Surprise:
         secs = self.calculateTime(params.ESTIM_OFF_MAX,
                                   params.ADD_OFF_PERCENT)
         self.offTime += secs
-        self.setTimer(secs, self.turnOn, 'Off')
+        self.setTimer(secs, self.turnOn, 'Off', self.sessionTimers)
         logging.info('Turning off')
         self.queue.put({'cmd': 'off'})
         self.wsUpdate('status', 'Off')
 
     def reallyTurnOff(self):
-        self.state = 'Idle'
+        self.setState('Idle')
         self.idleOn = False
         self.queue.put({'cmd': 'off'})
         self.wsUpdate('status', 'Off')
 
     def toggle(self):
         if self.state == 'Idle' or self.idleOn == 'AB':
-            self.state = 'IdleOn'
+            self.setState('IdleOn')
             self.idleOn = 'A'
             logging.info('Turning on max a, %s' %self.queueModeChange())
             self.queue.put({'cmd': 'on_max_a'})
             self.wsUpdate('status', 'Max A')
-            playSound('max-a')
+            self.playSound('max-a')
         elif self.idleOn == 'A':
             self.idleOn = 'B'
             logging.info('Turning on max b')
             self.queue.put({'cmd': 'on_max_b'})
             self.wsUpdate('status', 'Max B')
-            playSound('max-b')
+            self.playSound('max-b')
         elif self.idleOn == 'B':
             self.idleOn = 'AB'
             logging.info('Turning on max a and b')
             self.queue.put({'cmd': 'on_max'})
             self.wsUpdate('status', 'Max A & B')
-            playSound('a-and-b')
+            self.playSound('a-and-b')
         else:
             logging.error('Bad state %s in toggle' % self.idleOn)
 
     def lock(self):
         logging.info('Locked.')
         self.locked = True
-        playSound('locked')
+        self.playSound('locked')
         self.setMinimum()
 
     def setMinimum(self, zero=False):
@@ -272,20 +394,16 @@ class Surprise:
 
     def setLevelsFromDevice(self, zero=False):
         logging.info('setting levels from device')
-        playSound('levels_set_from_device')
+        self.playSound('levels_set_from_device')
         self.queue.put({'cmd': 'set_levels_from_device'})
 
     def endSession(self):
-        self.state = 'Idle'
-        if self.sessionTimer:
-            self.sessionTimer.cancel()
-            self.sessionTimer = None
-        if self.failsafeTimer:
-            self.failsafeTimer.cancel()
-            self.failsafeTimer = None
-        if self.timer:
-            self.timer.cancel()
-            self.timer = None
+        self.setState('Idle')
+        cancelled = self.sessionTimers.cancel()
+        logging.debug('cancelled %d session timers' % cancelled)
+        self.sessionTimer = None
+        self.failsafeTimer = None
+        self.timer = None
 
         self.queue.put({'cmd': 'off'})
         self.setMinimum(True)
@@ -294,11 +412,16 @@ class Surprise:
         self.locked = False
 
         logging.info('--------------- Ending session ------------------')
-        logging.info('On time %d, off time %d' % (self.onTime, self.offTime))
+        logging.info('On time %d, off time %d, %d teases' % (
+                     self.onTime, self.offTime, self.teases))
+        (enqueued, coalesced) = self.queue.coalesceStats()
+        logging.info('Device commands: %d queued, %d coalesced %s' % (
+                     enqueued, sum(coalesced.values()), coalesced))
         self.sessionTime = 0
         self.onTime = 0
         self.offTime = 0
-        playSound('reset')
+        self.teases = 0
+        self.playSound('reset')
 
 
 def main(argv):
@@ -4,6 +4,7 @@ generic deviceHandler class
 '''
 
 import asyncio
+from commandTiming import CommandTiming, DEQUEUED, newStamps, stamp, unstamped
 import fcntl
 import json
 import logging
@@ -35,8 +36,136 @@ ModeCodes = {
 }
 
 
+# Output registers written by each absolute command.  Relative commands
+# (adjust_ab) and commands that only change handler settings are absent.
+CommandRegisters = {
+    'off':         frozenset(['level_a', 'level_b']),
+    'on':          frozenset(['level_a', 'level_b']),
+    'on_low':      frozenset(['level_a', 'level_b']),
+    'on_norm':     frozenset(['level_a', 'level_b']),
+    'on_max':      frozenset(['level_a', 'level_b']),
+    'on_max_plus': frozenset(['level_a', 'level_b']),
+    'on_max_a':    frozenset(['level_a', 'level_b']),
+    'on_max_b':    frozenset(['level_a', 'level_b']),
+    'set_level_a': frozenset(['level_a']),
+    'set_level_b': frozenset(['level_b']),
+    'set_ma':      frozenset(['ma']),
+    'set_mode':    frozenset(['mode']),
+}
+
+# Commands that nothing may be coalesced across.
+BarrierCommands = ('reserve', 'release', 'set_levels_from_device')
+
+
+class CommandQueue(queue.Queue):
+    '''
+    A queue.Queue that can also be awaited from any asyncio event loop.
+    Producers use put() from any thread as before; a consumer running in
+    an event loop awaits aget() instead of blocking the loop in get().
+
+    With coalesce=True, a command that writes the same output registers
+    as commands still waiting in the queue replaces them: the older
+    commands are dropped and the new one is queued at the end.  Commands
+    are never coalesced across a reserve, release or
+    set_levels_from_device.
+
+    popWhile() lets a consumer take a run of related commands (e.g.
+    adjust_ab) off the head of the queue together.
+
+    Every command put is queued as a copy stamped with the time it was
+    queued (see commandTiming); the caller's dict is left alone.
+    '''
+    def __init__(self, maxsize=0, coalesce=False):
+        super(CommandQueue, self).__init__(maxsize)
+        self.waiters = []
+        self.coalesce = coalesce
+        self.enqueued = 0
+        self.coalesced = {}
+
+    def _put(self, item):
+        # Called with self.mutex held.
+        self.enqueued += 1
+        if item is not None:
+            item = dict(item, stamps=newStamps())
+        if self.coalesce:
+            self.supersede(item)
+        super(CommandQueue, self)._put(item)
+        for waiter in self.waiters:
+            waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+        self.waiters = []
+
+    def supersede(self, item):
+        registers = CommandRegisters.get(item['cmd']) if item else None
+        if not registers:
+            return
+        for index in range(len(self.queue) - 1, -1, -1):
+            queued = self.queue[index]
+            cmd = queued['cmd'] if queued else None
+            if cmd in BarrierCommands:
+                break
+            if cmd in CommandRegisters and CommandRegisters[cmd] <= registers:
+                del self.queue[index]
+                self.unfinished_tasks -= 1
+                self.coalesced[cmd] = self.coalesced.get(cmd, 0) + 1
+                logging.debug('coalesced %s, superseded by %s' % (
+                              unstamped(queued), unstamped(item)))
+
+    def popWhile(self, predicate):
+        '''Remove and return the commands at the head of the queue for
+           which predicate is true, up to the first one that isn't.  They
+           are counted as done.
+        '''
+        items = []
+        with self.mutex:
+            while self.queue and predicate(self.queue[0]):
+                items.append(self._get())
+                self.unfinished_tasks -= 1
+            if items:
+                self.not_full.notify(len(items))
+        return items
+
+    def coalesceStats(self):
+        with self.mutex:
+            return (self.enqueued, dict(self.coalesced))
+
+    @staticmethod
+    def _wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def aget(self, timeout=None):
+        '''Remove and return an item, waiting without blocking the loop.
+           Raises queue.Empty if timeout expires first.
+        '''
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.mutex:
+                if self._qsize():
+                    item = self._get()
+                    self.not_full.notify()
+                    return item
+                waiter = loop.create_future()
+                self.waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise queue.Empty
+            finally:
+                with self.mutex:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+
+
 class genericDeviceHandler():
 
+    # A handler whose I/O blocks (e.g. serial port reads and writes) runs
+    # on a thread of its own even with the async engine, so a slow or
+    # reconnecting device can't hold up the IOLoop.
+    blocking = False
 
     class NoDeviceFound(Exception):
         pass
@@ -56,6 +185,13 @@ class genericDeviceHandler():
         self.ma_low = 0
         self.ma_high = 255
         self.seqNr = 1
+        self.merged = 0
+        self.commands = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.current = None
+        self.timing = CommandTiming()
+        self.recorder = None
 
     def connect(self):
         raise(NotImplemented)
@@ -85,12 +221,8 @@ class genericDeviceHandler():
         prev_max_b = self.max_b
         logging.info('requested levels: max_a %d, max_b %d' % 
                       (max_a, max_b))
-        max_a = max(self.max_a_min, max_a)
-        max_b = max(self.max_b_min, max_b)
-        if max_a <= self.hard_max_a:
-            self.max_a = max_a
-        if max_b <= self.hard_max_b:
-            self.max_b = max_b
+        self.max_a = max(self.max_a_min, min(self.hard_max_a, max_a))
+        self.max_b = max(self.max_b_min, min(self.hard_max_b, max_b))
         self.max_plus_a = min(int(self.max_a * params.MAX_PLUS_LEVEL), self.hard_max_a)
         self.max_plus_b = min(int(self.max_b * params.MAX_PLUS_LEVEL), self.hard_max_b)
         self.norm_a = int(self.max_a * params.NORMAL_LEVEL)
@@ -133,16 +265,68 @@ class genericDeviceHandler():
             self.queue.task_done()
         self.queue.put({'cmd': 'off'})
 
+    async def nextCommand(self):
+        '''Wait for the next command.  A CommandQueue is awaited so the
+           handler can share an event loop with other coroutines.
+        '''
+        if not isinstance(self.queue, CommandQueue):
+            return self.dequeued(self.queue.get())
+        while True:
+            command = await self.queue.aget()
+            if not command or command['cmd'] != 'adjust_ab':
+                return self.dequeued(command)
+            command = self.mergeAdjustments(command)
+            if command['a'] or command['b']:
+                return self.dequeued(command)
+            # The adjustments cancelled out; nothing to do.
+            self.queue.task_done()
+
+    def dequeued(self, command):
+        stamp(command, DEQUEUED)
+        self.current = command
+        if self.recorder is not None:
+            self.recorder.record(command)
+        return command
+
+    def finish(self, command):
+        '''Count a processed command and record its timing.'''
+        if command is not None:
+            self.commands += 1
+            self.timing.record(command)
+
+    def mergeAdjustments(self, command):
+        '''Fold the adjust_ab commands queued right behind this one (with
+           the same activate flag) into it, so the levels are set and the
+           registers written once however many are waiting.
+        '''
+        activate = command['activate']
+        merged = self.queue.popWhile(
+            lambda queued: (queued is not None and
+                            queued['cmd'] == 'adjust_ab' and
+                            queued['activate'] == activate))
+        if not merged:
+            return command
+        command = dict(command)
+        for queued in merged:
+            command['a'] += queued['a']
+            command['b'] += queued['b']
+        self.merged += len(merged)
+        logging.debug('merged %d adjust_ab commands: a %+d, b %+d' % (
+                      len(merged) + 1, command['a'], command['b']))
+        return command
+
     async def producer_handler(self):
         while True:
             try:
                 # logging.info('---- producer_handler called: qsize %d ----' % self.queue.qsize())
-                command = self.queue.get()
+                command = await self.nextCommand()
                 self.queue.task_done()
                 await self.processCommand(command)
+                self.finish(command)
             except Exception as e:
                 # TODO(me): need to reopen device at this point
                 logging.info('device no longer open: %s' % e)
+                self.errors += 1
                 self.reconnect()
                 await self.drainQueue()
 
@@ -76,14 +76,14 @@ class Surprise:
 
     def setTimer(self, secs, function, state):
         logging.error('setTimer %s for %.1f' % (state, secs))
+        if self.testMode is True:
+            secs = secs / 100
         timer = threading.Timer(secs, function)
         if state:
             self.timer = timer
             self.state = state
             self.stateStart = time.time()
             self.stateTime = secs
-        if self.testMode is True:
-            secs = secs / 100
         timer.start()
 
     def idle(self):
@@ -99,7 +99,7 @@ class Surprise:
         else:
             failsafeStart = params.FAILSAFE_START
         logging.error('waiting for start button or %d seconds' % failsafeStart)
-        self.failsafeTimer = threading.Timer(failsafeStart, self.turnOn)
+        self.failsafeTimer = threading.Timer(failsafeStart, self.failsafeStart)
         self.failsafeTimer.start()
         playSound('activated')
 
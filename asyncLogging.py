@@ -0,0 +1,177 @@
+'''
+Asynchronous logging: application threads only queue log records, and
+one writer thread hands them to the real handlers.
+
+Without it every logging call writes to /var/log/surprise.log (and
+flushes) and sends to /dev/log on whichever thread made it: a timer,
+the device handler or the IOLoop.  install() replaces the handlers with
+a BoundedQueueHandler; a BatchingListener thread takes the records off
+the queue in batches, passes each to the handlers and flushes them at
+most once every flushInterval seconds.
+
+The queue holds at most queueSize records.  When it is full, overflow
+decides what happens to a new record:
+
+  'drop-new'  discard it
+  'drop-old'  discard the oldest queued record to make room
+  'block'     wait for room (the caller is held up, nothing is lost)
+
+Dropped records are counted and reported by the writer as a warning.
+Records still queued when the process is killed are lost; stop() (run
+at exit) drains the queue.
+'''
+
+import atexit
+import logging
+import logging.handlers
+import params
+import queue
+import threading
+import time
+
+Overflows = ('drop-new', 'drop-old', 'block')
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queueSize=params.logQueueSize,
+                 overflow=params.logOverflow):
+        if overflow not in Overflows:
+            raise ValueError('overflow must be one of %s' % (Overflows,))
+        super(BoundedQueueHandler, self).__init__(queue.Queue(queueSize))
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare() formats the message and copies the record
+        # on the calling thread.  Most messages here are formatted before
+        # the call anyway, so leave all of that to the writer.
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == 'drop-new':
+                    self.dropped += 1
+                    return
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+
+class BatchedFileHandler(logging.FileHandler):
+    '''A FileHandler that writes without flushing, leaving that to
+       BatchingListener.
+    '''
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingListener():
+    '''Drains source (a BoundedQueueHandler) on a thread of its own, up
+       to batchSize records at a time.  The handlers are flushed
+       flushInterval seconds after the first record written since the
+       last flush.
+    '''
+    def __init__(self, source, handlers, batchSize=params.logBatchSize,
+                 flushInterval=params.logFlushInterval):
+        self.source = source
+        self.queue = source.queue
+        self.handlers = list(handlers)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.reported = 0
+        self.batches = 0
+        self.records = 0
+        self.flushes = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(name='log-writer', target=self.run,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Write out everything queued so far and end the thread.'''
+        if not self.running:
+            return
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        flushAt = None
+        while True:
+            timeout = None
+            if flushAt is not None:
+                timeout = max(0, flushAt - time.monotonic())
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                self.flush()
+                flushAt = None
+                continue
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self.write([record for record in batch if record is not None])
+            if stop:
+                self.flush()
+                return
+            if flushAt is None:
+                flushAt = time.monotonic() + self.flushInterval
+            elif time.monotonic() >= flushAt:
+                self.flush()
+                flushAt = None
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self.flushes += 1
+
+    def write(self, batch):
+        dropped = self.source.dropped
+        if dropped != self.reported:
+            batch.append(logging.makeLogRecord({
+                'name': 'asyncLogging', 'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': 'log queue full: dropped %d records' % (
+                       dropped - self.reported)}))
+            self.reported = dropped
+        for handler in self.handlers:
+            for record in batch:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        self.batches += 1
+        self.records += len(batch)
+
+
+def install(logger, handlers, queueSize=params.logQueueSize,
+            overflow=params.logOverflow, batchSize=params.logBatchSize,
+            flushInterval=params.logFlushInterval):
+    '''Route logger's records to handlers through a writer thread.
+       Returns the BatchingListener.
+    '''
+    source = BoundedQueueHandler(queueSize, overflow)
+    listener = BatchingListener(source, handlers, batchSize, flushInterval)
+    logger.addHandler(source)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
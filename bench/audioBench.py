@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Time from a playSound() request to the first audio sample.
+
+Legacy: a new mpg123 process per sound; measured until mpg123 produces
+its first decoded bytes.  Engine: the AudioEngine with all sounds
+decoded up front; measured until the first chunk is handed to the
+output.  By default output goes to /dev/null so this runs headless; use
+--aplay to play through the sound card.
+
+    ./bench/audioBench.py [--rounds 5] [--aplay]
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import params
+import playSound
+
+SOUNDS = ['sorry', 'max-a', 'locked', 'on_norm']
+
+
+def legacy(directory, rounds):
+    latencies = []
+    for _ in range(rounds):
+        for name in SOUNDS:
+            start = time.monotonic()
+            proc = subprocess.Popen(
+                [playSound.MPG123, '-q', '-s', os.path.join(directory, name + '.mp3')],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            proc.stdout.read(1)
+            latencies.append(time.monotonic() - start)
+            proc.kill()
+            proc.wait()
+    return latencies
+
+
+def engine(directory, rounds, aplay):
+    player = None if aplay else ['sh', '-c', 'cat > /dev/null']
+    audio = playSound.AudioEngine(directory, params.soundRules, player=player)
+    start = time.monotonic()
+    audio.start()
+    print('engine: decoded %d sounds in %.2fs' % (len(audio.cache),
+                                                  time.monotonic() - start))
+    for _ in range(rounds):
+        for name in SOUNDS:
+            audio.play(name)
+            while audio.pending:
+                time.sleep(0.001)
+            time.sleep(0.05 if not aplay else 2)
+    return list(audio.latencies)
+
+
+def report(name, latencies):
+    print('%-7s %3d sounds: request to first sample mean %.2fms max %.2fms' % (
+          name, len(latencies), statistics.mean(latencies) * 1000,
+          max(latencies) * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--aplay', action='store_true',
+                        help='play through aplay instead of /dev/null')
+    parser.add_argument('--sounds', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'sounds'))
+    args = parser.parse_args(argv[1:])
+
+    report('legacy', legacy(args.sounds, args.rounds))
+    report('engine', engine(args.sounds, args.rounds, args.aplay))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Key event to callback latency for the clicker readers.
+
+A fake device replays a burst of presses (with contact bounce) while the
+callback takes as long as Processor.process() does (BEEP_DELAY).  The
+inline reader, like Clicker.handler(), runs each callback before reading
+the next event; Clicker.run() debounces and queues them.
+
+--hold replays a key held for that many seconds (kernel repeat delay
+250ms, period 33ms) and counts the level adjustments it produces.  It
+then holds down through runSurprise.Processor, once unlocked during a
+session (the press locks; the hold must not lower the levels) and once
+locked (the hold lowers them), and exits 1 if either goes wrong.
+
+    ./bench/clickerBench.py [--presses 6] [--interval 0.1] [--work 0.5]
+    ./bench/clickerBench.py --hold 3
+'''
+
+import argparse
+import asyncio
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clicker
+from evdev import InputEvent, ecodes
+
+
+class FakeDevice():
+    def __init__(self, presses, interval, bounce):
+        self.presses = presses
+        self.interval = interval
+        self.bounce = bounce
+        self.done = asyncio.Event()
+
+    async def async_read_loop(self):
+        # Events are stamped when the key is pressed, as the kernel does,
+        # not when the reader gets round to them.
+        start = time.time()
+        for i in range(self.presses):
+            for j in range(1 + self.bounce):
+                stamp = start + i * self.interval + j * 0.002
+                await asyncio.sleep(max(0, stamp - time.time()))
+                sec = int(stamp)
+                yield InputEvent(sec, int((stamp - sec) * 1000000),
+                                 ecodes.EV_KEY, clicker.UP[0], 1)
+        await self.done.wait()
+
+    def close(self):
+        pass
+
+
+def callback(args, handled):
+    def pressed(code):
+        handled.append(time.time())
+        time.sleep(args.work)
+    return pressed
+
+
+async def inline(args):
+    '''What handler() does: the callback runs before the next read.'''
+    latencies = []
+    device = FakeDevice(args.presses, args.interval, args.bounce)
+    work = callback(args, [])
+    reader = device.async_read_loop()
+    for _ in range(args.presses * (1 + args.bounce)):
+        event = await reader.__anext__()
+        latencies.append(time.time() - event.timestamp())
+        work(event.code)
+    return latencies, args.presses * (1 + args.bounce)
+
+
+async def queued(args):
+    handled = []
+    c = clicker.Clicker('fake')
+    c.setUp(callback(args, handled))
+    device = FakeDevice(args.presses, args.interval, args.bounce)
+    c.open = lambda: device
+    task = asyncio.ensure_future(c.run())
+    while len(handled) < args.presses:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(args.work)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return list(c.latencies), len(handled)
+
+
+def holdEvents(code, secs):
+    '''Press, repeat and release events of a key held for secs.'''
+    def event(stamp, value):
+        sec = int(stamp)
+        return InputEvent(sec, int((stamp - sec) * 1000000), ecodes.EV_KEY,
+                          code, value)
+
+    yield event(0.0, 1)
+    stamp = 0.25
+    while stamp < secs:
+        yield event(stamp, 2)
+        stamp += 0.033
+    yield event(secs, 0)
+
+
+def hold(args):
+    adjustments = []
+    c = clicker.Clicker('fake')
+    c.setUpRepeat(adjustments.append)
+    for event in holdEvents(clicker.UP[0], args.hold):
+        steps = c.repeat(event)
+        if steps:
+            adjustments.append(steps)
+    print('held %.1fs: %d steps (+1 for the press) in %d adjustments: %s' % (
+          args.hold, sum(adjustments), len(adjustments), adjustments))
+
+
+class Session():
+    '''Just enough of Surprise for Processor to lock and adjust.'''
+    def __init__(self, state, locked):
+        self.state = state
+        self.locked = locked
+        self.queue = queue.Queue()
+        self.adjusted = 0
+
+    def getState(self):
+        return self.state
+
+    def lock(self):
+        self.locked = True
+
+    def adjustLevels(self, steps):
+        self.adjusted += steps
+
+
+def lockHold(args, locked):
+    '''Hold down during a session, the way Clicker.handler() runs the
+       callbacks.  Returns the total level adjustment.
+    '''
+    import runSurprise
+    runSurprise.BEEP_DELAY = 0
+    runSurprise.surprise = Session('On', locked)
+    c = clicker.Clicker('fake')
+    runSurprise.Processor(c)
+    for event in holdEvents(clicker.DOWN[0], args.hold):
+        if event.value == 1:
+            c.keytable[event.code](event.code)
+        steps = c.repeat(event)
+        if steps:
+            c.repeattable[event.code](steps)
+    return runSurprise.surprise.adjusted
+
+
+def checkLockHold(args):
+    unlocked = lockHold(args, False)
+    locked = lockHold(args, True)
+    print('held down %.1fs in a session: unlocked adjusted %+d (locks), '
+          'locked adjusted %+d' % (args.hold, unlocked, locked))
+    if unlocked != 0 or locked >= -1:
+        print('FAIL: holding down to lock must not adjust the levels, '
+              'holding it while locked must lower them')
+        return False
+    return True
+
+
+def report(name, result):
+    (latencies, handled) = result
+    print('%-7s %2d callbacks: event to callback mean %.1fms max %.1fms' % (
+          name, handled, sum(latencies) / len(latencies) * 1000,
+          max(latencies) * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--presses', type=int, default=6)
+    parser.add_argument('--bounce', type=int, default=1,
+                        help='extra bounce events per press')
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--work', type=float, default=0.5)
+    parser.add_argument('--hold', type=float, default=0)
+    args = parser.parse_args(argv[1:])
+    if args.hold:
+        hold(args)
+        if not checkLockHold(args):
+            sys.exit(1)
+        return
+    report('inline', asyncio.run(inline(args)))
+    report('queued', asyncio.run(queued(args)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+'''
+Throughput and latency of the dweeb command transport.
+
+Runs mockDeviceWeb on a background thread and pushes a burst of
+set_level_a commands through dweebClient.deviceHandler, first with the
+old transport (fixed 1.5 s sleep after every send) and then with the
+pipelined transport at several window sizes.  Latency is measured from
+enqueue to DeviceWeb's reply, and the handler must count every command
+(surprise_device_commands_total) or the bench exits 1.
+
+Then, with commands arriving every --interval seconds, DeviceWeb drops
+every connection and refuses new ones for --downtime seconds, and the
+time from DeviceWeb being back until it receives the next command is
+measured.
+
+    ./bench/dweebBench.py [--commands 40] [--latency 0.02] [--jitter 0]
+                          [--reconnects 3] [--downtime 1.0]
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dweebClient as dweeb
+from mockDeviceWeb import MockDeviceWeb
+from SurpriseClient import CommandQueue
+
+
+class TimedHandler(dweeb.deviceHandler):
+    '''Records enqueue to reply latency of every command sent.'''
+    latencies = []
+
+    async def processCommand(self, ws, command):
+        self.current = command
+        await super(TimedHandler, self).processCommand(ws, command)
+
+    async def sendCommand(self, ws, cmd):
+        ack = await super(TimedHandler, self).sendCommand(ws, cmd)
+        enqueued = self.current['enqueued']
+        ack.add_done_callback(
+            lambda f: self.latencies.append(time.monotonic() - enqueued))
+        return ack
+
+
+class LegacyHandler(TimedHandler):
+    '''The transport as it was: no replies read, 1.5 s after every send.'''
+    async def sendCommand(self, ws, cmd):
+        cmd['seqNr'] = self.seqNr
+        self.seqNr += 1
+        cmd['devix'] = self.devix
+        await ws.send(json.dumps(cmd))
+        await asyncio.sleep(1.5)
+        self.latencies.append(time.monotonic() - self.current['enqueued'])
+        ack = asyncio.get_event_loop().create_future()
+        ack.set_result(None)
+        return ack
+
+
+async def burst(mock, handlerClass, commands, window):
+    url = 'localhost:%d/devices' % mock.port
+    mock.state.update(level_a=30, level_b=30)
+    handlerClass.latencies = []
+    device = handlerClass(CommandQueue(), webUrl='http://' + url,
+                          WSUrl='ws://' + url, test=True, window=window)
+    start = time.monotonic()
+    for i in range(commands):
+        device.queue.put({'cmd': 'set_level_a', 'value': i % 20,
+                          'enqueued': time.monotonic()})
+    task = asyncio.ensure_future(device.run())
+    while len(device.latencies) < commands:
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+    # Commands are counted once all their replies are in.
+    while device.commands < commands and time.monotonic() - start < elapsed + 1:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.wait([task])
+    if device.commands != commands:
+        print('FAIL: %d commands processed, the handler counted %d' % (
+              commands, device.commands))
+        sys.exit(1)
+    return elapsed, sorted(device.latencies)
+
+
+async def reconnect(mock, args):
+    url = 'localhost:%d/devices' % mock.port
+    device = dweeb.deviceHandler(CommandQueue(), webUrl='http://' + url,
+                                 WSUrl='ws://' + url, test=True,
+                                 reconnectDelay=args.reconnectDelay)
+    task = asyncio.ensure_future(device.run())
+
+    async def feed():
+        i = 0
+        while True:
+            if device.queue.qsize() < 4:
+                device.queue.put({'cmd': 'set_level_a', 'value': i % 20})
+                i += 1
+            await asyncio.sleep(args.interval)
+
+    feeder = asyncio.ensure_future(feed())
+    await asyncio.sleep(0.5)
+    recoveries = []
+    for _ in range(args.reconnects):
+        mock.disconnect(args.downtime)
+        back = mock.downUntil
+        while not mock.received or mock.received[-1] < back:
+            if time.monotonic() - back > 30:
+                print('reconnect: no command 30s after DeviceWeb came back')
+                break
+            await asyncio.sleep(0.005)
+        else:
+            recoveries.append(mock.received[-1] - back)
+        await asyncio.sleep(0.5)
+    feeder.cancel()
+    task.cancel()
+    await asyncio.wait([task, feeder])
+    print('reconnect: %d disconnects of %.1fs, next command %s after '
+          'DeviceWeb came back (reconnect delay %.1fs)' % (
+          args.reconnects, args.downtime,
+          ', '.join('%.0fms' % (r * 1000) for r in recoveries),
+          args.reconnectDelay))
+
+
+def report(name, commands, elapsed, latencies):
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print('%-12s %4d commands in %6.2fs: %7.2f cmd/s, p95 latency %.3fs' % (
+          name, commands, elapsed, commands / elapsed, p95))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', type=int, default=40)
+    parser.add_argument('--legacy-commands', type=int, default=4,
+                        help='commands for the (slow) legacy transport')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mock DeviceWeb processing time per command')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this much more processing time')
+    parser.add_argument('--port', type=int, default=31281)
+    parser.add_argument('--reconnects', type=int, default=3)
+    parser.add_argument('--downtime', type=float, default=1.0)
+    parser.add_argument('--interval', type=float, default=0.02,
+                        help='seconds between commands while reconnecting')
+    parser.add_argument('--reconnectDelay', type=float,
+                        default=dweeb.params.dweebReconnectDelay)
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    mock = MockDeviceWeb(args.port, args.latency, args.jitter, seed=1).start()
+    elapsed, latencies = asyncio.run(
+        burst(mock, LegacyHandler, args.legacy_commands, 1))
+    report('legacy', args.legacy_commands, elapsed, latencies)
+    for window in (1, 2, 4, 8):
+        elapsed, latencies = asyncio.run(
+            burst(mock, TimedHandler, args.commands, window))
+        report('window %d' % window, args.commands, elapsed, latencies)
+    if args.reconnects:
+        asyncio.run(reconnect(mock, args))
+    print('mock DeviceWeb: %d commands, %d connections' % (
+          len(mock.received), mock.connections))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
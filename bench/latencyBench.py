@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+'''
+End to end latency from an input to the device write it causes.
+
+Runs the real runSurprise stack in-process: Surprise, Processor,
+MainHandler and Clicker, on the tornado IOLoop with the chosen engine.
+Inputs are key presses from a fake evdev device read by Clicker, and
+GET /?action=... requests to MainHandler.  The device side is a mock
+ET232 behind the real buttshock handler, or the mock DeviceWeb behind
+the real dweeb handler.  Sounds are silenced.
+
+For every step of a scenario that goes through each action
+Processor.transition handles in each state, locked and unlocked,
+latency is measured from the input (the key event timestamp or the
+moment the request is sent) to the last et232.write or dweeb send that
+it caused.  Steps that write nothing (everything already at the right
+level, or handler-only commands) are counted separately; the run fails
+if a step that must write to the device doesn't.  Before reading the
+levels from the device the bench sets them to 30, as the user would
+with the knobs.
+
+The session's own timers don't get to run: the scenario moves from
+Starting to On to Off and ends sessions by calling the Surprise methods
+the timers would (these steps aren't measured), and the remaining
+session timers are cancelled after each step.
+
+Results are printed and saved as JSON.  --baseline compares p95 with an
+earlier run and exits 1 if any action got slower than --tolerance.
+
+    ./bench/latencyBench.py [--device buttshock|dweeb] [--engine threaded|async]
+                            [--cycles 3] [--json out.json] [--baseline old.json]
+'''
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import buttshockClient
+import clicker
+import dweebClient
+from evdev import InputEvent, ecodes
+import params
+import playSound
+import runSurprise
+from Surprise import Surprise
+import tornado.httpclient
+import tornado.ioloop
+from mockDeviceWeb import MockDeviceWeb
+
+# (state the step starts in, action, whether it must write to the
+# device).  Commands that leave a register as it is write nothing.  An
+# action in Timers stands in for a session timer firing.
+Scenario = (
+    ('Idle', 'middle', False),       # set_levels_from_device
+    ('Idle', 'left', True),          # end session: off
+    ('Idle', 'right', True),         # max A: set_ma, set_mode, on_max_a
+    ('IdleOn', 'up', True),          # adjust_ab
+    ('IdleOn', 'down', True),        # adjust_ab
+    ('IdleOn', 'right', True),       # max B
+    ('IdleOn', 'right', True),       # max A & B
+    ('IdleOn', 'middle', False),     # set_minimum (handler only)
+    ('IdleOn', 'left', True),        # end session: off
+    ('Idle', 'up', False),           # activate: off, already off
+    ('Waiting', 'left', False),      # end session: off, already off
+    # A locked session through every state.
+    ('Idle', 'up', False),
+    ('Waiting', 'down', False),      # lock: set_minimum
+    ('Waiting', 'up', False),        # start the session (no command)
+    ('Starting', 'up', False),       # adjust_ab, not activated
+    ('Starting', 'down', False),
+    ('Starting', 'middle', False),   # set_minimum
+    ('Starting', 'left', False),     # 'sorry', no command
+    ('Starting', 'turnOn', True),
+    ('On', 'up', True),              # adjust_ab, activated
+    ('On', 'down', True),
+    ('On', 'middle', False),
+    ('On', 'left', False),
+    ('On', 'turnOff', True),
+    ('Off', 'up', False),
+    ('Off', 'down', False),
+    ('Off', 'middle', False),
+    ('Off', 'left', False),
+    ('Off', 'endSession', False),
+    # Unlocked sessions: lock or end each state.
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'down', False),     # lock
+    ('Starting', 'endSession', False),
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'left', False),     # end session: off, already off
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'turnOn', True),
+    ('On', 'down', False),           # lock
+    ('On', 'endSession', True),
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'turnOn', True),
+    ('On', 'left', True),            # end session: off
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'turnOn', True),
+    ('On', 'turnOff', True),
+    ('Off', 'down', False),          # lock
+    ('Off', 'endSession', False),
+    ('Idle', 'up', False),
+    ('Waiting', 'up', False),
+    ('Starting', 'turnOn', True),
+    ('On', 'turnOff', True),
+    ('Off', 'left', False),          # end session: off
+)
+
+Timers = ('turnOn', 'turnOff', 'endSession')
+
+Keys = {
+    'up': clicker.UP[0],
+    'down': clicker.DOWN[0],
+    'left': clicker.LEFT[0],
+    'right': clicker.RIGHT[0],
+    'middle': clicker.MIDDLE[0],
+}
+
+
+class Silent():
+    '''playSound engine that plays nothing.'''
+    def play(self, name):
+        pass
+
+
+class Writes():
+    '''Timestamps (time.time()) of device writes and whether the handler
+       is in the middle of a command.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = []
+        self.busy = False
+
+    def record(self):
+        with self.lock:
+            self.times.append(time.time())
+
+    def lastSince(self, start):
+        with self.lock:
+            times = [t for t in self.times if t >= start]
+        return max(times) if times else None
+
+
+class MockET232():
+    '''Stands in for buttshock.et232.ET232SerialSync.'''
+    writes = None
+    latency = 0.0
+
+    class Port():
+        def __init__(self):
+            self.file = tempfile.TemporaryFile()
+
+        def isOpen(self):
+            return True
+
+        def fileno(self):
+            return self.file.fileno()
+
+    def __init__(self, port, debug=False):
+        self.port = self.Port()
+        self.registers = {0x8c: 30, 0x88: 30, 0x89: 128, 0xa3: 11,
+                          0xa4: 0, 0xd3: 0}
+
+    def perform_handshake(self):
+        pass
+
+    def read(self, register):
+        return self.registers.get(register, 0)
+
+    def write(self, register, values):
+        time.sleep(self.latency)    # serial round trip
+        self.registers[register] = values[0]
+        self.writes.record()
+
+    def close(self):
+        self.port.file.close()
+
+
+class ButtshockHandler(buttshockClient.deviceHandler):
+    async def processCommand(self, command):
+        self.writesLog.busy = True
+        try:
+            await super(ButtshockHandler, self).processCommand(command)
+        finally:
+            self.writesLog.busy = False
+
+
+class DweebHandler(dweebClient.deviceHandler):
+    async def processCommand(self, ws, command):
+        self.writesLog.busy = True
+        try:
+            await super(DweebHandler, self).processCommand(ws, command)
+        finally:
+            self.writesLog.busy = False
+
+    async def sendCommand(self, ws, cmd):
+        ack = await super(DweebHandler, self).sendCommand(ws, cmd)
+        self.writesLog.record()
+        return ack
+
+
+class FakeInputDevice():
+    '''Stands in for evdev.InputDevice for both Clicker readers.'''
+    def __init__(self, loop):
+        self.loop = loop
+        self.events = queue.Queue()
+        self.aevents = None
+        self.reader = None
+
+    def press(self, code):
+        now = time.time()
+        sec = int(now)
+        event = InputEvent(sec, int((now - sec) * 1000000), ecodes.EV_KEY, code, 1)
+        if self.reader == 'async':
+            self.loop.call_soon_threadsafe(self.aevents.put_nowait, event)
+        else:
+            self.events.put(event)
+        return event.timestamp()
+
+    def read_loop(self):
+        self.reader = 'thread'
+        while True:
+            yield self.events.get()
+
+    async def async_read_loop(self):
+        self.reader = 'async'
+        self.aevents = asyncio.Queue()
+        while True:
+            yield await self.aevents.get()
+
+    def close(self):
+        pass
+
+
+def percentile(values, p):
+    '''Nearest rank percentile of a sorted list.'''
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def summary(latencies, noWrite):
+    result = {'count': len(latencies), 'noWrite': noWrite}
+    if latencies:
+        values = sorted(latencies)
+        result.update({
+            'p50': percentile(values, 50) * 1000,
+            'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000,
+            'mean': sum(values) / len(values) * 1000,
+            'max': values[-1] * 1000,
+        })
+    return result
+
+
+class Bench():
+    def __init__(self, args, ioloop):
+        self.args = args
+        self.ioloop = ioloop
+        self.writes = Writes()
+        self.port = args.port
+        # Steps that should have written to the device and didn't.
+        self.missing = set()
+
+    def setup(self):
+        args = self.args
+        playSound.engine = Silent()
+        runSurprise.BEEP_DELAY = args.beepDelay
+        if args.device == 'buttshock':
+            MockET232.writes = self.writes
+            MockET232.latency = args.writeLatency
+            buttshockClient.buttshock.et232.ET232SerialSync = MockET232
+            device = ButtshockHandler(None, port='mock')
+        else:
+            self.mock = MockDeviceWeb(self.port + 1, args.writeLatency).start()
+            device = DweebHandler(
+                None, webUrl='http://127.0.0.1:%d/devices' % (self.port + 1),
+                WSUrl='ws://127.0.0.1:%d/devices' % (self.port + 1), test=True)
+        device.writesLog = self.writes
+
+        surprise = Surprise(params.MAX_SESSION_TIME, engine=args.engine,
+                            loop=self.ioloop.asyncio_loop, device=device,
+                            sound=lambda name: None, services=False)
+        device.queue = surprise.queue
+        if args.engine == 'async':
+            self.ioloop.asyncio_loop.create_task(device.run())
+        else:
+            threading.Thread(name='deviceHandler', target=device.start,
+                             daemon=True).start()
+        runSurprise.surprise = surprise
+        self.surprise = surprise
+        self.device = device
+
+        self.input = FakeInputDevice(self.ioloop.asyncio_loop)
+        self.clicker = clicker.Clicker('fake')
+        self.clicker.open = lambda: self.input
+        processor = runSurprise.Processor(
+            self.clicker, ioloop=self.ioloop if args.engine == 'async' else None)
+        if args.clicker == 'async':
+            self.ioloop.spawn_callback(self.clicker.run)
+        else:
+            threading.Thread(name='clicker', target=self.clicker.handler,
+                             daemon=True).start()
+        runSurprise.make_app(processor.processAsync).listen(self.port, '127.0.0.1')
+        self.client = tornado.httpclient.AsyncHTTPClient()
+
+    async def settle(self, enqueued):
+        '''Wait for the commands an input queued to be written out.  An
+           input queues them right away, if at all.
+        '''
+        deadline = time.monotonic() + 1
+        while self.surprise.queue.enqueued == enqueued:
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.005)
+        idle = 0
+        while idle < 2:
+            await asyncio.sleep(0.02)
+            if self.surprise.queue.empty() and not self.writes.busy:
+                idle += 1
+            else:
+                idle = 0
+        return True
+
+    async def timer(self, action):
+        '''Do what a session timer would, and wait for its commands.'''
+        enqueued = self.surprise.queue.enqueued
+        getattr(self.surprise, action)()
+        await self.settle(enqueued)
+
+    def turnKnobs(self, level=30):
+        '''Set the device's levels, as the user would with its knobs, for
+           set_levels_from_device to read.  The startup and end of session
+           offs leave them at 0, and levels of 0 would leave nothing for
+           the later level commands to write.
+        '''
+        if self.args.device == 'buttshock':
+            self.device.et232.registers.update({0x8c: level, 0x88: level})
+        else:
+            self.mock.state.update(level_a=level, level_b=level)
+
+    def freeze(self):
+        '''Cancel the session timers, so only the scenario changes state.'''
+        if self.surprise.getState() not in ('Idle', 'IdleOn'):
+            self.surprise.sessionTimers.cancel()
+
+    async def step(self, kind, action):
+        enqueued = self.surprise.queue.enqueued
+        if kind == 'clicker':
+            start = self.input.press(Keys[action])
+        else:
+            start = time.time()
+            request = self.client.fetch('http://127.0.0.1:%d/?action=%s' % (
+                                        self.port, action))
+        queued = await self.settle(enqueued)
+        if kind == 'http':
+            await request
+        # Let Processor finish its beep wait before the next input.
+        await asyncio.sleep(self.args.beepDelay + 0.05)
+        last = self.writes.lastSince(start)
+        if not queued or last is None:
+            return None
+        return last - start
+
+    async def run(self):
+        # Let the device handler take the startup commands.
+        await self.settle(-1)
+        await asyncio.sleep(0.2)
+        results = {}
+        for kind in self.args.inputs.split(','):
+            latencies = {}
+            noWrite = {}
+            skipping = False
+            for cycle in range(self.args.cycles):
+                for (state, action, writes) in Scenario:
+                    label = '%s%s %s' % (
+                            state, ' locked' if self.surprise.locked else '',
+                            action)
+                    if self.surprise.getState() != state:
+                        # Start over at the next step from Idle.
+                        if not skipping:
+                            logging.error('%s: in state %s, expected %s' % (
+                                          label, self.surprise.getState(), state))
+                            self.surprise.endSession()
+                            await asyncio.sleep(0.2)
+                        skipping = True
+                        continue
+                    skipping = False
+                    if action in Timers:
+                        await self.timer(action)
+                        self.freeze()
+                        continue
+                    if action == 'middle' and state == 'Idle':
+                        self.turnKnobs()
+                    latency = await self.step(kind, action)
+                    self.freeze()
+                    latencies.setdefault(label, [])
+                    noWrite.setdefault(label, 0)
+                    if latency is None:
+                        noWrite[label] += 1
+                        if writes:
+                            logging.error('%s: no device write' % label)
+                            self.missing.add('%s %s' % (kind, label))
+                    else:
+                        latencies[label].append(latency)
+            results[kind] = {label: summary(latencies[label], noWrite[label])
+                             for label in latencies}
+        return results
+
+
+def report(results):
+    for (kind, actions) in results.items():
+        print('%s:' % kind)
+        print('  %-22s %5s %8s %8s %8s %8s' % ('action', 'n', 'p50', 'p95',
+                                              'p99', 'max'))
+        for (label, s) in actions.items():
+            if s['count']:
+                print('  %-22s %5d %7.1fms %7.1fms %7.1fms %7.1fms' % (
+                      label, s['count'], s['p50'], s['p95'], s['p99'], s['max']))
+            else:
+                print('  %-22s %5d   no device write' % (label, s['noWrite']))
+
+
+def compare(results, baseline, tolerance):
+    '''Print p95 against the baseline; False if anything regressed.'''
+    ok = True
+    for (kind, actions) in results.items():
+        for (label, s) in actions.items():
+            before = baseline.get('results', {}).get(kind, {}).get(label, {})
+            if not s.get('p95') or not before.get('p95'):
+                continue
+            ratio = s['p95'] / before['p95']
+            regressed = ratio > 1 + tolerance
+            ok = ok and not regressed
+            print('%-8s %-22s p95 %7.1fms -> %7.1fms  %+5.0f%%%s' % (
+                  kind, label, before['p95'], s['p95'], (ratio - 1) * 100,
+                  '  REGRESSION' if regressed else ''))
+    return ok
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', choices=('buttshock', 'dweeb'),
+                        default='buttshock')
+    parser.add_argument('--engine', choices=('threaded', 'async'),
+                        default=params.engine)
+    parser.add_argument('--clicker', choices=('thread', 'async'),
+                        default='async' if params.clickerAsync else 'thread')
+    parser.add_argument('--inputs', default='clicker,http')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--writeLatency', type=float, default=0.005,
+                        help='seconds per device write')
+    parser.add_argument('--beepDelay', type=float, default=runSurprise.BEEP_DELAY)
+    parser.add_argument('--port', type=int, default=18890)
+    parser.add_argument('--json', default=None, help='save results here')
+    parser.add_argument('--baseline', default=None,
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    bench = Bench(args, ioloop)
+    bench.setup()
+    results = ioloop.run_sync(bench.run)
+    report(results)
+    if bench.missing:
+        print('FAIL: no device write for %s' % ', '.join(sorted(bench.missing)))
+
+    output = {
+        'version': params.version,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {name: getattr(args, name) for name in (
+                   'device', 'engine', 'clicker', 'cycles', 'writeLatency',
+                   'beepDelay')},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.tolerance):
+                return 1
+    return 1 if bench.missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
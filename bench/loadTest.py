@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''
+Request throughput of the web UI before and after making MainHandler
+non-blocking.
+
+Starts the tornado app twice on a server thread: once with the original
+synchronous handler (Processor.process sleeps on the IOLoop for the
+beep) and once with the async MainHandler.  Several simulated phones then
+press buttons concurrently and the request rate and latency are reported.
+The Surprise instance is a stand-in that stays Idle, so only the request
+path is measured.
+
+    ./bench/loadTest.py [--clients 3] [--requests 10]
+'''
+
+import argparse
+import asyncio
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clicker
+import pages
+import runSurprise
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+
+
+class FakeSurprise():
+    def __init__(self):
+        self.state = 'Idle'
+        self.locked = False
+        self.queue = queue.Queue()
+
+    def getState(self):
+        return self.state
+
+
+class LegacyMainHandler(tornado.web.RequestHandler):
+    '''The handler as it was: processes the action on the IOLoop.'''
+    def initialize(self, processor):
+        self.processor = processor
+
+    def get(self):
+        action = self.get_argument('action', None)
+        state = self.processor(action)
+        self.write(pages.render(runSurprise.Page[state],
+                                runSurprise.surprise.locked))
+
+
+def serve(app, port):
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = app.listen(port, address='127.0.0.1')
+        holder['loop'] = tornado.ioloop.IOLoop.current()
+        holder['server'] = server
+        ready.set()
+        holder['loop'].start()
+
+    thread = threading.Thread(name='server', target=run, daemon=True)
+    thread.start()
+    ready.wait()
+    return holder, thread
+
+
+def stop(holder, thread):
+    holder['loop'].add_callback(holder['server'].stop)
+    holder['loop'].add_callback(holder['loop'].stop)
+    thread.join()
+
+
+async def phone(client, url, requests, latencies):
+    for _ in range(requests):
+        start = time.monotonic()
+        await client.fetch(url)
+        latencies.append(time.monotonic() - start)
+
+
+async def load(port, clients, requests):
+    client = tornado.httpclient.AsyncHTTPClient()
+    url = 'http://127.0.0.1:%d/?action=down' % port
+    latencies = []
+    start = time.monotonic()
+    await asyncio.gather(*[phone(client, url, requests, latencies)
+                           for _ in range(clients)])
+    return time.monotonic() - start, latencies
+
+
+def measure(name, handler, processor, port, clients, requests):
+    if handler is LegacyMainHandler:
+        app = tornado.web.Application([(r"/", handler, dict(processor=processor))])
+    else:
+        app = runSurprise.make_app(processor)
+    holder, thread = serve(app, port)
+    elapsed, latencies = asyncio.run(load(port, clients, requests))
+    stop(holder, thread)
+    print('%-8s %4d requests in %6.2fs: %6.2f req/s, latency mean %.3fs max %.3fs' % (
+          name, len(latencies), elapsed, len(latencies) / elapsed,
+          statistics.mean(latencies), max(latencies)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=3,
+                        help='number of concurrent phones/clickers')
+    parser.add_argument('--requests', type=int, default=10,
+                        help='button presses per client')
+    parser.add_argument('--port', type=int, default=18888)
+    args = parser.parse_args(argv[1:])
+
+    runSurprise.surprise = FakeSurprise()
+    processor = runSurprise.Processor(clicker.Clicker('/dev/null'))
+    measure('before', LegacyMainHandler, processor.process,
+            args.port, args.clients, args.requests)
+    measure('after', runSurprise.MainHandler, processor.processAsync,
+            args.port + 1, args.clients, args.requests)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+Cost of a logging.info call on the calling thread, with the handlers
+runSurprise uses attached directly and through asyncLogging.
+
+Both set-ups log to a FileHandler on a temporary file and a
+SysLogHandler on a local unix socket (standing in for /dev/log).
+--stall makes every --stallEvery-th write to the file take that many
+milliseconds, the way an SD card does now and then.  The per call time
+is measured around each logging.info call, with --interval seconds
+between calls.
+
+Then a burst larger than the queue shows what each overflow policy does.
+
+    ./bench/loggingBench.py [--calls 20000] [--interval 0.0002]
+                            [--stall 20] [--stallEvery 500]
+'''
+
+import argparse
+import logging
+import logging.handlers
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import asyncLogging
+
+
+class SyslogSink():
+    '''A unix datagram socket that reads and discards whatever arrives.'''
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'log')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        threading.Thread(name='syslog-sink', target=self.run,
+                         daemon=True).start()
+
+    def run(self):
+        while True:
+            self.socket.recv(65536)
+
+
+class StallingStream():
+    '''Wraps a file; every stallEvery-th write blocks for stall seconds.'''
+    def __init__(self, stream, stall, stallEvery):
+        self.stream = stream
+        self.stall = stall
+        self.stallEvery = stallEvery
+        self.count = 0
+
+    def write(self, data):
+        self.count += 1
+        if self.stall and self.count % self.stallEvery == 0:
+            time.sleep(self.stall)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def handlers(args, directory, name, batched):
+    path = os.path.join(directory, name + '.log')
+    fileClass = asyncLogging.BatchedFileHandler if batched else logging.FileHandler
+    fileHandler = fileClass(filename=path)
+    fileHandler.stream = StallingStream(fileHandler.stream, args.stall / 1000.0,
+                                        args.stallEvery)
+    fileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    syslogHandler = logging.handlers.SysLogHandler(address=args.syslog)
+    return (path, [syslogHandler, fileHandler])
+
+
+def logCalls(logger, calls, interval=0):
+    times = []
+    command = {'cmd': 'set_level_a', 'value': 20}
+    for i in range(calls):
+        start = time.perf_counter()
+        logger.info('processing %s (%d)' % (command, i))
+        times.append(time.perf_counter() - start)
+        if interval:
+            time.sleep(interval)
+    return sorted(times)
+
+
+def lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def report(name, times, written, calls):
+    print('%-10s mean %6.1fus  p50 %6.1fus  p99 %7.1fus  max %7.1fms  '
+          '%d/%d lines written' % (
+          name, sum(times) / len(times) * 1e6, times[len(times) // 2] * 1e6,
+          times[int(len(times) * 0.99)] * 1e6, times[-1] * 1e3, written, calls))
+
+
+def sync(args, directory):
+    logger = logging.getLogger('bench.sync')
+    (path, attached) = handlers(args, directory, 'sync', False)
+    for handler in attached:
+        logger.addHandler(handler)
+    times = logCalls(logger, args.calls, args.interval)
+    for handler in attached:
+        handler.close()
+    report('sync', times, lines(path), args.calls)
+
+
+def async_(args, directory):
+    logger = logging.getLogger('bench.async')
+    (path, attached) = handlers(args, directory, 'async', True)
+    listener = asyncLogging.install(logger, attached, queueSize=args.queueSize)
+    times = logCalls(logger, args.calls, args.interval)
+    listener.stop()
+    for handler in attached:
+        handler.close()
+    report('async', times, lines(path), args.calls)
+    print('           writer: %d batches, %.0f records per batch, %d flushes, '
+          '%d dropped' % (
+          listener.batches, listener.records / max(1, listener.batches),
+          listener.flushes, listener.source.dropped))
+
+
+def overflow(args, directory):
+    print('burst of %d records into a queue of %d, file stalled %dms every '
+          '%d writes:' % (args.burst, args.burstQueue, args.stall,
+                          args.stallEvery))
+    for policy in asyncLogging.Overflows:
+        logger = logging.getLogger('bench.overflow.' + policy)
+        (path, attached) = handlers(args, directory, 'overflow-' + policy, True)
+        listener = asyncLogging.install(logger, attached,
+                                        queueSize=args.burstQueue,
+                                        overflow=policy)
+        start = time.perf_counter()
+        logCalls(logger, args.burst)
+        elapsed = time.perf_counter() - start
+        listener.stop()
+        for handler in attached:
+            handler.close()
+        print('  %-9s burst took %6.1fms, %5d dropped, %5d lines written' % (
+              policy, elapsed * 1000, listener.source.dropped, lines(path)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--interval', type=float, default=0.0002,
+                        help='seconds between calls (0: back to back)')
+    parser.add_argument('--stall', type=float, default=20.0,
+                        help='milliseconds a stalled file write takes')
+    parser.add_argument('--stallEvery', type=int, default=500)
+    parser.add_argument('--queueSize', type=int, default=10000)
+    parser.add_argument('--burst', type=int, default=5000)
+    parser.add_argument('--burstQueue', type=int, default=500)
+    args = parser.parse_args(argv[1:])
+
+    directory = tempfile.mkdtemp(prefix='loggingBench-')
+    args.syslog = SyslogSink(directory).path
+    logging.getLogger('bench').setLevel(logging.INFO)
+    logging.getLogger('bench').propagate = False
+    sync(args, directory)
+    async_(args, directory)
+    overflow(args, directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''
+Records per second through RFC5424Formatter, as it was (cache=False)
+and with the cached hostname, timezone and timestamp (cache=True).
+
+First checks that both produce the same text for --check records with
+timestamps spread over a few days, including whole seconds, fractions
+that round up into the next second and structured data.  The records
+of the timing run are created --spacing seconds apart, like a busy
+logger's.
+
+    ./bench/rfc5424Bench.py [--records 200000] [--spacing 0.0005]
+                            [--check 100000] [--tz Europe/Amsterdam]
+'''
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from syslog_rfc5424_formatter import RFC5424Formatter
+
+
+def makeRecords(created):
+    records = []
+    for (i, at) in enumerate(created):
+        if i % 10 == 0:
+            (msg, args) = ('level %s', ({'structured_data': {'a': str(i)}},))
+        else:
+            (msg, args) = ('processing %d', (i,))
+        record = logging.LogRecord('surprise', logging.INFO, __file__, 1,
+                                   msg, args, None)
+        record.created = at
+        records.append(record)
+    return records
+
+
+def check(args):
+    rng = random.Random(42)
+    base = time.time()
+    created = []
+    for i in range(args.check):
+        at = base + rng.uniform(0, 3 * 86400)
+        kind = i % 4
+        if kind == 1:
+            at = float(int(at))
+        elif kind == 2:
+            at = int(at) + 1 - rng.choice((5e-7, 4e-7, 6e-7, 1e-9))
+        elif kind == 3:
+            at = int(at) + rng.randrange(1000000) / 1e6
+        created.append(at)
+    created.sort()
+    plain = RFC5424Formatter(sd_id='bench')
+    cached = RFC5424Formatter(sd_id='bench', cache=True)
+    # format() takes procid and msgid out of the args, so each formatter
+    # gets records of its own.
+    expected = [plain.format(r) for r in makeRecords(created)]
+    actual = [cached.format(r) for r in makeRecords(created)]
+    mismatches = [(e, a) for (e, a) in zip(expected, actual) if e != a]
+    for (e, a) in mismatches[:5]:
+        print('  expected %r\n  got      %r' % (e, a))
+    print('checked %d records: %d differ' % (len(created), len(mismatches)))
+    return not mismatches
+
+
+def run(name, formatter, records):
+    start = time.perf_counter()
+    for record in records:
+        formatter.format(record)
+    elapsed = time.perf_counter() - start
+    print('%-9s %8.0f records/s  %5.2fus per record' % (
+          name, len(records) / elapsed, elapsed / len(records) * 1e6))
+    return elapsed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--spacing', type=float, default=0.0005,
+                        help='seconds between the records\' timestamps')
+    parser.add_argument('--check', type=int, default=100000)
+    parser.add_argument('--tz', help='TZ to run in (default: the local one)')
+    args = parser.parse_args(argv[1:])
+
+    if args.tz:
+        os.environ['TZ'] = args.tz
+        time.tzset()
+    if not check(args):
+        sys.exit(1)
+
+    base = time.time()
+    created = [base + i * args.spacing for i in range(args.records)]
+    plain = run('uncached', RFC5424Formatter(sd_id='bench'), makeRecords(created))
+    cached = run('cached', RFC5424Formatter(sd_id='bench', cache=True), makeRecords(created))
+    print('%.1fx' % (plain / cached))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
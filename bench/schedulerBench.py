@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+Compare threading.Timer against the heap based scheduler.Scheduler.
+
+Schedules the same set of timers with both approaches and reports the
+peak live thread count, peak RSS and firing jitter (how late each timer
+fired relative to its deadline).
+
+    ./bench/schedulerBench.py [--timers 200] [--spread 2.0]
+'''
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from scheduler import Scheduler
+
+
+def rssKb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class Probe():
+    '''Collects jitter samples and waits for all timers to fire.'''
+    def __init__(self, count):
+        self.remaining = count
+        self.jitter = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def fired(self, deadline):
+        late = time.monotonic() - deadline
+        with self.lock:
+            self.jitter.append(late)
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+
+def runTimers(delays):
+    probe = Probe(len(delays))
+    for secs in delays:
+        deadline = time.monotonic() + secs
+        t = threading.Timer(secs, probe.fired, args=(deadline,))
+        t.start()
+    return probe, None
+
+
+def runScheduler(delays):
+    probe = Probe(len(delays))
+    scheduler = Scheduler(name='bench-scheduler')
+    scheduler.start()
+    for secs in delays:
+        deadline = time.monotonic() + secs
+        scheduler.schedule(secs, probe.fired, deadline)
+    return probe, scheduler
+
+
+def measure(name, runner, delays):
+    baseThreads = threading.active_count()
+    baseRss = rssKb()
+    probe, scheduler = runner(delays)
+    peakThreads = 0
+    peakRss = 0
+    while not probe.done.wait(0.01):
+        peakThreads = max(peakThreads, threading.active_count())
+        peakRss = max(peakRss, rssKb())
+    if scheduler:
+        scheduler.stop()
+    jitter = sorted(probe.jitter)
+    p99 = jitter[min(len(jitter) - 1, int(len(jitter) * 0.99))]
+    print('%-10s threads +%-5d rss +%-7dkB jitter mean %.3fms p99 %.3fms max %.3fms' % (
+          name, peakThreads - baseThreads, max(0, peakRss - baseRss),
+          statistics.mean(jitter) * 1000, p99 * 1000, jitter[-1] * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--timers', type=int, default=200,
+                        help='number of timers to schedule')
+    parser.add_argument('--spread', type=float, default=2.0,
+                        help='timers fire uniformly within this many seconds')
+    args = parser.parse_args(argv[1:])
+
+    random.seed(1)
+    delays = [random.uniform(0.5, 0.5 + args.spread) for _ in range(args.timers)]
+    measure('Timer', runTimers, delays)
+    measure('Scheduler', runScheduler, delays)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
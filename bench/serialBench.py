@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+buttshockClient over the serial path, against the ET232 emulator.
+
+The real buttshockClient.deviceHandler connects to the emulator's pty
+(handshake, register reads, override reset) and then:
+
+  throughput  runs commands through processCommand as fast as they go
+              and compares the writes per second with what the baud rate
+              allows
+  reconnect   feeds commands through the real handler loop, drops the
+              line (like pulling the USB cable) and measures how long it
+              takes until the device is written again after the line is
+              back
+
+buttshock-py's ET232SerialSync is checked against the emulator first
+and the bench refuses to run if they disagree.  Without buttshock-py's
+ET232 support it only runs with --standIn, using the emulator's own
+SerialClient; the results then say nothing about the real client.
+
+    ./bench/serialBench.py [--commands 300] [--baud 19200] [--hangups 3]
+                           [--drop 0.01] [--corrupt 0.01] [--standIn]
+'''
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import buttshockClient
+from et232Emulator import ET232Emulator, Faults, useClient
+import playSound
+from SurpriseClient import CommandQueue
+
+Commands = ('on_low', 'on_norm', 'on_max', 'on_max_plus', 'off', 'set_ma')
+
+
+class Silent():
+    def play(self, name):
+        pass
+
+
+def command(rng):
+    cmd = rng.choice(Commands)
+    if cmd == 'set_ma':
+        return {'cmd': cmd, 'value': rng.randint(0, 255)}
+    return {'cmd': cmd}
+
+
+def throughput(args, emulator, device):
+    rng = random.Random(1)
+    loop = asyncio.new_event_loop()
+    (writes, served) = (device.writes, emulator.served)
+    start = time.monotonic()
+    for _ in range(args.commands):
+        loop.run_until_complete(device.processCommand(command(rng)))
+    elapsed = time.monotonic() - start
+    writes = device.writes - writes
+    # A write is 'I' + 4 hex digits + CR, answered by one ACK byte.
+    limit = args.baud / 10.0 / 7
+    print('throughput: %d commands, %d writes (%d elided) in %.2fs: '
+          '%.0f commands/s, %.0f writes/s (baud limit %.0f writes/s)' % (
+          args.commands, writes, device.elided, elapsed,
+          args.commands / elapsed, writes / elapsed, limit))
+    loop.close()
+
+
+def reconnect(args, emulator, device):
+    rng = random.Random(2)
+    threading.Thread(name='deviceHandler', target=device.start,
+                     daemon=True).start()
+    stop = threading.Event()
+
+    def feed():
+        while not stop.is_set():
+            if device.queue.qsize() < 4:
+                device.queue.put(command(rng))
+            time.sleep(args.interval)
+
+    threading.Thread(name='feeder', target=feed, daemon=True).start()
+    time.sleep(0.5)
+    recoveries = []
+    for _ in range(args.hangups):
+        hungUp = time.monotonic()
+        emulator.hangup(args.downtime)
+        while not emulator.writes or emulator.writes[-1][0] < hungUp + args.downtime:
+            if time.monotonic() - hungUp > args.downtime + 30:
+                print('reconnect: no write 30s after the line came back')
+                stop.set()
+                return
+            time.sleep(0.005)
+        recoveries.append(emulator.writes[-1][0] - hungUp - args.downtime)
+        time.sleep(0.5)
+    stop.set()
+    print('reconnect: %d hangups of %.1fs, device written again %s after '
+          'the line came back' % (
+          args.hangups, args.downtime,
+          ', '.join('%.0fms' % (r * 1000) for r in recoveries)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', type=int, default=300)
+    parser.add_argument('--baud', type=int, default=19200)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='device processing time per command')
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--corrupt', type=float, default=0.0)
+    parser.add_argument('--hangups', type=int, default=3)
+    parser.add_argument('--downtime', type=float, default=1.0)
+    parser.add_argument('--interval', type=float, default=0.02,
+                        help='seconds between commands while reconnecting')
+    parser.add_argument('--standIn', action='store_true',
+                        help="without buttshock-py's ET232 support, run with "
+                             "the emulator's SerialClient")
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    playSound.engine = Silent()
+    try:
+        client = useClient(buttshockClient.buttshock.et232, args.standIn)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    print('client: %s' % client)
+
+    emulator = ET232Emulator(args.baud, args.latency)
+    emulator.start()
+    start = time.monotonic()
+    device = buttshockClient.deviceHandler(CommandQueue(), port=emulator.path)
+    print('connected in %.0fms' % ((time.monotonic() - start) * 1000))
+    # Faults only once connected: the constructor doesn't retry.
+    emulator.faults = Faults(drop=args.drop, corrupt=args.corrupt, seed=1)
+    if not args.drop and not args.corrupt:
+        throughput(args, emulator, device)
+    if args.hangups:
+        reconnect(args, emulator, device)
+    print('emulator: %d commands served, %d dropped, %d corrupted, %d hangups' % (
+          emulator.served, emulator.dropped, emulator.corrupted, emulator.hangups))
+    emulator.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+'''
+Time from a button press to updated status in the web UI.
+
+form:      the browser submits GET /?action=..., downloads the whole page
+           and opens a new status websocket, which is done when the first
+           status frame arrives.
+websocket: the action is sent over the persistent /command websocket and
+           is done when the reply with the new buttons arrives.
+
+The form flow includes the server's BEEP_DELAY, which it needs because
+the browser navigates away; the websocket flow does not.  Surprise is a
+stand-in that stays Idle, so only the UI path is measured.
+
+    ./bench/uiBench.py [--presses 20]
+'''
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clicker
+import runSurprise
+from SurpriseClient import CommandQueue
+import tornado.httpclient
+import websockets
+import wsSurprise
+
+from loadTest import FakeSurprise, serve, stop
+
+
+class StatusSurprise(FakeSurprise):
+    def timerStatus(self):
+        return (self.state, 0, 0, 0)
+
+
+async def formPress(client, args):
+    start = time.monotonic()
+    await client.fetch('http://127.0.0.1:%d/?action=down' % args.port)
+    async with websockets.connect('ws://127.0.0.1:%d/' % args.wsPort) as ws:
+        await ws.recv()
+    return time.monotonic() - start
+
+
+async def run(args):
+    client = tornado.httpclient.AsyncHTTPClient()
+    form = [await formPress(client, args) for _ in range(args.presses)]
+    command = []
+    async with websockets.connect('ws://127.0.0.1:%d/command' % args.port) as ws:
+        await ws.recv()
+        for _ in range(args.presses):
+            start = time.monotonic()
+            await ws.send('down')
+            await ws.recv()
+            command.append(time.monotonic() - start)
+    return form, command
+
+
+def report(name, latencies):
+    print('%-9s %3d presses: press to status mean %.1fms max %.1fms' % (
+          name, len(latencies), statistics.mean(latencies) * 1000,
+          max(latencies) * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--presses', type=int, default=20)
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--wsPort', type=int, default=18889)
+    args = parser.parse_args(argv[1:])
+
+    runSurprise.surprise = StatusSurprise()
+    status = wsSurprise.wsHandler(surprise=runSurprise.surprise,
+                                  queue=CommandQueue(), listenAddr='127.0.0.1',
+                                  port=args.wsPort)
+    threading.Thread(name='websocket', target=status.start, daemon=True).start()
+    processor = runSurprise.Processor(clicker.Clicker('/dev/null'))
+    holder, thread = serve(runSurprise.make_app(processor.processAsync), args.port)
+
+    form, command = asyncio.run(run(args))
+    stop(holder, thread)
+    report('form', form)
+    report('websocket', command)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''
+Delivery latency of the status websocket with many browsers connected.
+
+Runs wsSurprise.wsHandler on its own thread (as the threaded engine
+does), connects simulated clients, then publishes status updates
+through the producer queue.  Every client must receive every update;
+latency is measured from the put() on the queue to receipt.  Optional
+slow clients connect with small socket buffers at both ends (on
+loopback the hub's send buffer would otherwise grow to megabytes) and
+never read, so updates padded to --padding random bytes soon fill the
+TCP window and then their buffer in the hub.  The hub must drop updates
+for them (or disconnect them) while the others still get every update;
+the bench exits 1 if it doesn't.
+
+    ./bench/wsHubBench.py [--clients 50] [--messages 200] [--slow 2]
+                          [--padding 1024] [--slowClient drop|disconnect]
+'''
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import params
+from SurpriseClient import CommandQueue
+import websockets
+import wsSurprise
+
+
+class FakeSurprise():
+    def timerStatus(self):
+        return ('On', 100, 42, 200)
+
+
+async def client(url, messages, latencies, ready, seen):
+    '''Collect the updates (by their timestamp) in seen.  The hub re-sends
+       the last update while there is nothing new, so count each once.
+    '''
+    async with websockets.connect(url, max_queue=None) as ws:
+        ready.release()
+        async for frame in ws:
+            (field, value) = frame.split(':', 1)
+            if field != 'status':
+                continue
+            sent = value.split()[0]
+            if sent in seen:
+                continue
+            seen.add(sent)
+            latencies.append(time.monotonic() - float(sent))
+            if len(seen) == messages:
+                return
+
+
+async def slowClient(url, port, ready):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_event_loop().sock_connect(sock, ('127.0.0.1', port))
+    ws = await websockets.connect(url, sock=sock, max_queue=1, read_limit=1024)
+    ready.release()
+    return ws
+
+
+def shrinkSendBuffers(handler, slow):
+    '''Cap the hub's send buffer for each of the slow clients.'''
+    addresses = {ws.local_address for ws in slow}
+    for ws in list(handler.clients):
+        if ws.remote_address in addresses:
+            sock = ws.transport.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+
+async def run(args):
+    url = 'ws://127.0.0.1:%d/' % args.port
+    ready = asyncio.Semaphore(0)
+    latencies = []
+    slow = [await slowClient(url, args.port, ready) for _ in range(args.slow)]
+    seen = [set() for _ in range(args.clients)]
+    tasks = [asyncio.ensure_future(client(url, args.messages, latencies, ready,
+                                          s))
+             for s in seen]
+    for _ in range(args.clients + args.slow):
+        await ready.acquire()
+    await asyncio.sleep(0.2)
+    shrinkSendBuffers(args.handler, slow)
+
+    start = time.monotonic()
+    for _ in range(args.messages):
+        # Random, so permessage-deflate can't shrink it.
+        padding = os.urandom(args.padding // 2).hex()
+        args.queue.put({'field': 'status',
+                        'value': '%.6f %s' % (time.monotonic(), padding)})
+        await asyncio.sleep(args.interval)
+    (done, pending) = await asyncio.wait(tasks, timeout=30)
+    elapsed = time.monotonic() - start
+    for task in pending:
+        task.cancel()
+    for ws in slow:
+        ws.transport.abort()
+    return elapsed, [len(s) for s in seen], sorted(latencies)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.02,
+                        help='seconds between published updates')
+    parser.add_argument('--slow', type=int, default=2,
+                        help='clients that connect but never read')
+    parser.add_argument('--padding', type=int, default=1024,
+                        help='bytes added to every update')
+    parser.add_argument('--buffer', type=int, default=params.wsClientBuffer,
+                        help='per-client buffer size')
+    parser.add_argument('--slowClient', choices=('drop', 'disconnect'),
+                        default=params.wsSlowClient,
+                        help='what the hub does with a full client buffer')
+    parser.add_argument('--port', type=int, default=18889)
+    args = parser.parse_args(argv[1:])
+
+    args.queue = CommandQueue()
+    handler = wsSurprise.wsHandler(surprise=FakeSurprise(), queue=args.queue,
+                                   listenAddr='127.0.0.1', port=args.port,
+                                   bufferSize=args.buffer,
+                                   slowClient=args.slowClient)
+    args.handler = handler
+    threading.Thread(name='websocket', target=handler.start, daemon=True).start()
+    time.sleep(0.5)
+
+    elapsed, received, latencies = asyncio.run(run(args))
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print('%d clients (+%d slow), %d updates in %.2fs' % (
+          args.clients, args.slow, args.messages, elapsed))
+    print('delivered %d/%d, latency mean %.2fms p95 %.2fms max %.2fms' % (
+          sum(received), args.clients * args.messages,
+          statistics.mean(latencies) * 1000, p95 * 1000, latencies[-1] * 1000))
+    print('hub sent %d frames, dropped %d updates for slow clients' % (
+          handler.sent, handler.dropped))
+    if sum(received) != args.clients * args.messages:
+        print('FAIL: the other clients missed updates')
+        return 1
+    if args.slow and not handler.dropped:
+        print('FAIL: the slow clients never fell behind')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
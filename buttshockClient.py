@@ -4,6 +4,7 @@ buttshock-py client interface an ErosTek ET232
 '''
 
 import asyncio
+from commandTiming import DONE, stamp, started, unstamped
 import fcntl
 import json
 import logging
@@ -33,9 +34,20 @@ def modeName(code):
     global ModeNames
     return ModeNames[code]
 
+# Registers we write and keep a shadow copy of.
+#   0x8c channel A level, 0x88 channel B level, 0x89 MA,
+#   0xa3 mode, 0xa4 override flags, 0xd3 mode timer
+ShadowRegisters = (0x8c, 0x88, 0x89, 0xa3, 0xa4, 0xd3)
+# The device changes these by itself, so writes are never skipped.
+VolatileRegisters = (0xd3,)
+# The front panel controls these again once overrides are released.
+OverrideRegisters = (0x8c, 0x88, 0x89, 0xa3)
+
 
 class deviceHandler(SurpriseClient.genericDeviceHandler):
 
+    # Serial I/O through buttshock-py, and connect() sleeps between retries.
+    blocking = True
 
     def __init__(self, deviceQ, max_a=params.HARD_MAX_A, max_b=params.HARD_MAX_B,
                        port='/dev/ttyUSB0',
@@ -47,6 +59,9 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
         self.ma_low = 0
         self.ma_high = 255
         self.port = port
+        self.shadow = {}
+        self.writes = 0
+        self.elided = 0
         self.et232 = self.connect()
         self.setLevelsFromDevice()
 
@@ -75,6 +90,12 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
             try:
                 et232.perform_handshake()
                 logging.info("[+] connected")
+                # reset overides if present
+                et232.write(0xa4, [0])
+                shadow = {0xa4: 0}
+                for register in ShadowRegisters:
+                    if register not in shadow:
+                        shadow[register] = et232.read(register)
                 playSound('connected')
                 break
             except Exception as e:
@@ -85,21 +106,42 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
                 sleep(5)
             attempt += 1
 
-        # reset overides if present
-        et232.write(0xa4, [0])
-
+        self.shadow = shadow
         logging.info('Mode: %s, MA %d, chA %d, chB %d, D3 timer %d' % (
-          modeName(et232.read(0xa3)), et232.read(0x89),
-          et232.read(0x8c), et232.read(0x88), et232.read(0xd3)))
+          modeName(self.shadow[0xa3]), self.shadow[0x89],
+          self.shadow[0x8c], self.shadow[0x88], self.shadow[0xd3]))
         return et232
 
     def reconnect(self):
+        self.reconnects += 1
+        self.shadow = {}
         self.et232.close()
         self.et232 = self.connect()
 
+    def writeRegister(self, register, value):
+        '''Write a register unless the shadow copy says it already holds
+           value.  The shadow entry is dropped until the write succeeds.
+        '''
+        if (register not in VolatileRegisters and
+            self.shadow.get(register) == value):
+            self.elided += 1
+            return
+        self.shadow.pop(register, None)
+        started(self.current)
+        self.et232.write(register, [value])
+        stamp(self.current, DONE)
+        self.writes += 1
+        self.shadow[register] = value
+
+    def invalidate(self, registers):
+        for register in registers:
+            self.shadow.pop(register, None)
+
     def setLevelsFromDevice(self):
         level_a = self.et232.read(0x8c)
         level_b = self.et232.read(0x88)
+        self.shadow[0x8c] = level_a
+        self.shadow[0x88] = level_b
         logging.info('Current (minimum) levels: chA %d, chB %d' % (level_a, level_b))
         self.setLevels(level_a, level_b, fromUser=False)
 
@@ -108,39 +150,40 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
             logging.info('Commands finished.')
             return
         else:
-            logging.info('processing %s' % command)
+            logging.info('processing %s' % unstamped(command))
             cmd = command['cmd']
             if cmd == 'reserve':
                 # enable overrides for MA, chA, chB
-                self.et232.write(0xa4, [0x13])
+                self.writeRegister(0xa4, 0x13)
             elif cmd == 'release':
                 # disable overrides for MA, chA, chB
-                self.et232.write(0xa4, [0x00])
+                self.writeRegister(0xa4, 0x00)
+                self.invalidate(OverrideRegisters)
             elif cmd == 'on_low':
-                self.et232.write(0x8c, [self.low_a])
-                self.et232.write(0x88, [self.low_b])
+                self.writeRegister(0x8c, self.low_a)
+                self.writeRegister(0x88, self.low_b)
             elif cmd == 'on' or cmd == 'on_norm':
-                self.et232.write(0x8c, [self.norm_a])
-                self.et232.write(0x88, [self.norm_b])
+                self.writeRegister(0x8c, self.norm_a)
+                self.writeRegister(0x88, self.norm_b)
             elif cmd == 'on_max':
-                self.et232.write(0x8c, [self.max_a])
-                self.et232.write(0x88, [self.max_b])
+                self.writeRegister(0x8c, self.max_a)
+                self.writeRegister(0x88, self.max_b)
             elif cmd == 'on_max_plus':
-                self.et232.write(0x8c, [self.max_plus_a])
-                self.et232.write(0x88, [self.max_plus_b])
+                self.writeRegister(0x8c, self.max_plus_a)
+                self.writeRegister(0x88, self.max_plus_b)
             elif cmd == 'on_max_a':
-                self.et232.write(0x8c, [self.max_a])
-                self.et232.write(0x88, [0])
+                self.writeRegister(0x8c, self.max_a)
+                self.writeRegister(0x88, 0)
             elif cmd == 'on_max_b':
-                self.et232.write(0x8c, [0])
-                self.et232.write(0x88, [self.max_b])
+                self.writeRegister(0x8c, 0)
+                self.writeRegister(0x88, self.max_b)
             elif cmd == 'adjust_ab':
                 if (self.adjustLevels(2 * command['a'], 2 * command['b']) and
                     command['activate']):
                     if command['a'] != 0:
-                        self.et232.write(0x8c, [self.max_a])
+                        self.writeRegister(0x8c, self.max_a)
                     if command['b'] != 0:
-                        self.et232.write(0x88, [self.max_b])
+                        self.writeRegister(0x88, self.max_b)
             elif cmd == 'set_minimum':
                 value = command['value']
                 self.setMinimum(zero=value)
@@ -149,32 +192,33 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
             elif cmd == 'set_levels_from_device':
                 self.setLevelsFromDevice()
             elif cmd == 'off':
-                self.et232.write(0x8c, [0])
-                self.et232.write(0x88, [0])
+                self.writeRegister(0x8c, 0)
+                self.writeRegister(0x88, 0)
             elif cmd == 'set_ma':
                 value = command['value']
                 if self.invalidValue(cmd, value):
                     return
-                self.et232.write(0x89, [value])
+                self.writeRegister(0x89, value)
             elif cmd == 'set_mode':
                 value = command['value']
                 if self.invalidValue(cmd, value):
                     return
-                self.et232.write(0xa3, [modeCode(value)])
+                self.writeRegister(0xa3, modeCode(value))
                 # Reset time timer every time we change mode
-                self.et232.write(0xd3, [0])
+                self.writeRegister(0xd3, 0)
             elif cmd == 'set_level_a':
                 value = command['value']
                 if self.invalidValue(cmd, value):
                     return
-                self.et232.write(0x8c, [value])
+                self.writeRegister(0x8c, value)
             elif cmd == 'set_level_b':
                 value = command['value']
                 if self.invalidValue(cmd, value):
                     return
-                self.et232.write(0x88, [value])
+                self.writeRegister(0x88, value)
             else:
                 logging.error('Unknown command: %s' % cmd)
+            logging.debug('register writes %d, elided %d' % (self.writes, self.elided))
 
 
 if __name__ == "__main__":
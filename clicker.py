@@ -12,11 +12,28 @@ it was flakey and disconnected unexpectly)
 The button actions are eventually mapped to application actions.
 The setXXXX methods are used to associate a button click with
 a callback to effect an application action on a button press.
+
+handler() reads the device on its own thread and runs the callbacks
+inline.  run() is the asyncio alternative: the reader only debounces
+and queues presses, and a dispatcher hands them one at a time to a
+worker thread, so a slow callback never delays the next read.  The
+queue is unbounded: a lost press could change what the state machine
+does.  Only the steps of a held key are combined while they wait.
+
+Holding a key with a repeat function (setUpRepeat/setDownRepeat) earns
+steps from the key repeat events at an accelerating rate; they are
+delivered to the repeat function at most once per repeat tick and when
+the key is released.
 '''
 
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from evdev import InputDevice, ecodes
 import logging
+import params
 import sys
+import time
 from time import sleep
 
 # Key mappings for original pointer
@@ -36,9 +53,33 @@ MIDDLE = [42]
 def noop(code):
     print('Clicker code is %d' % code)
 
+
+class Hold():
+    '''A key being held down.'''
+    def __init__(self, stamp):
+        self.start = stamp
+        self.last = None
+        self.flushed = stamp
+        self.steps = 0.0
+
 class Clicker():
-    def __init__(self, device):
+    def __init__(self, device, debounce=params.clickerDebounce,
+                 repeatRates=params.clickerRepeatRates,
+                 repeatTick=params.clickerRepeatTick):
         self.device = device
+        self.debounce = debounce
+        self.repeatRates = repeatRates
+        self.repeatTick = repeatTick
+        self.repeattable = {}
+        self.held = {}
+        self.lastPress = {}
+        self.events = None
+        # Steps per key queued and not yet dispatched.
+        self.pendingSteps = {}
+        self.executor = None
+        self.bounced = 0
+        self.combined = 0
+        self.latencies = collections.deque(maxlen=100)
         self.keytable = {
             48: noop, 
             104: noop,
@@ -75,6 +116,46 @@ class Clicker():
         for i in keys:
             self.keytable[i] = func
 
+    def setUpRepeat(self, func):
+        logging.info('set Up repeat function')
+        self.setRepeatFunction(UP, func)
+
+    def setDownRepeat(self, func):
+        logging.info('set Down repeat function')
+        self.setRepeatFunction(DOWN, func)
+
+    def setRepeatFunction(self, keys, func):
+        for i in keys:
+            self.repeattable[i] = func
+
+    def repeat(self, event):
+        '''Track a held key through its press (1), repeat (2) and release
+           (0) events.  Returns the whole steps earned since the last flush
+           if they are due now, otherwise 0.
+        '''
+        stamp = event.timestamp()
+        if event.value == 1:
+            self.held[event.code] = Hold(stamp)
+            return 0
+        hold = self.held.get(event.code)
+        if hold is None:
+            return 0
+        if event.value == 2:
+            # The press itself was one step; count from the first repeat.
+            if hold.last is not None:
+                held = stamp - hold.start
+                rate = [r for (secs, r) in self.repeatRates if held >= secs][-1]
+                hold.steps += rate * (stamp - hold.last)
+            hold.last = stamp
+            if stamp - hold.flushed < self.repeatTick:
+                return 0
+        else:
+            del self.held[event.code]
+        steps = int(hold.steps)
+        hold.steps -= steps
+        hold.flushed = stamp
+        return steps
+
     def handler(self, testing=False):
         logging.info('Clicker handler running')
         while True:
@@ -82,7 +163,7 @@ class Clicker():
                 try:
                     if testing:
                         print("opening device %s" % self.device)
-                    input = InputDevice(self.device)
+                    input = self.open()
                     break
                 except Exception as e:
                     logging.error("clicker open failure: %s" % e)
@@ -92,17 +173,116 @@ class Clicker():
 
             try:
                 for event in input.read_loop():
+                    if event.type != ecodes.EV_KEY:
+                        continue
                     # trigger only on key down events
-                    if event.type == ecodes.EV_KEY and event.value == 1:
+                    if event.value == 1:
                         if event.code in self.keytable:
                             self.keytable[event.code](event.code)
                         elif testing:
                             noop(event.code)
+                    if event.code in self.repeattable:
+                        steps = self.repeat(event)
+                        if steps:
+                            self.repeattable[event.code](steps)
             except Exception as e:
                 logging.error("clicker read failure: %s" % e)
                 input.close()
                 sleep(1)
 
+    async def run(self, testing=False):
+        '''Read the device with evdev's asyncio interface.  Must be run on
+           the event loop, e.g. IOLoop.spawn_callback(clicker.run).
+        '''
+        logging.info('Clicker async reader running')
+        self.events = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='clicker')
+        dispatcher = asyncio.ensure_future(self.dispatch(testing))
+        try:
+            while True:
+                try:
+                    input = self.open()
+                except Exception as e:
+                    logging.error("clicker open failure: %s" % e)
+                    await asyncio.sleep(5)
+                    continue
+                try:
+                    async for event in input.async_read_loop():
+                        self.accept(event)
+                except Exception as e:
+                    logging.error("clicker read failure: %s" % e)
+                input.close()
+                await asyncio.sleep(1)
+        finally:
+            dispatcher.cancel()
+            self.executor.shutdown(wait=False)
+
+    def open(self):
+        return InputDevice(self.device)
+
+    def accept(self, event):
+        '''Debounce key down events and queue presses and held key steps
+           for dispatch.
+        '''
+        if event.type != ecodes.EV_KEY:
+            return
+        stamp = event.timestamp()
+        if event.value == 1:
+            last = self.lastPress.get(event.code)
+            if last is not None and 0 <= stamp - last < self.debounce:
+                self.bounced += 1
+                logging.debug('clicker: key %d bounced' % event.code)
+                return
+            self.lastPress[event.code] = stamp
+            self.enqueue(event.code, stamp, None)
+        if event.code in self.repeattable:
+            steps = self.repeat(event)
+            if steps:
+                self.enqueue(event.code, stamp, steps)
+
+    def enqueue(self, code, stamp, steps):
+        if steps is not None:
+            if code in self.pendingSteps:
+                # Add them to the steps already waiting for this key.
+                self.pendingSteps[code] += steps
+                self.combined += 1
+                return
+            self.pendingSteps[code] = steps
+        self.events.put_nowait((code, stamp, steps))
+
+    async def dispatch(self, testing=False):
+        loop = asyncio.get_event_loop()
+        while True:
+            (code, stamp, steps) = await self.events.get()
+            if steps is not None:
+                steps = self.pendingSteps.pop(code)
+            try:
+                await loop.run_in_executor(self.executor, self.invoke,
+                                           code, stamp, steps, testing)
+            except Exception as e:
+                logging.exception('clicker: key %d callback failed: %s' % (code, e))
+
+    def invoke(self, code, stamp, steps=None, testing=False):
+        # evdev timestamps are wall clock (CLOCK_REALTIME) by default.
+        latency = time.time() - stamp
+        self.latencies.append(latency)
+        logging.debug('clicker: key %d handled %.1fms after the kernel event' % (
+                      code, latency * 1000))
+        if steps is not None:
+            self.repeattable[code](steps)
+        elif code in self.keytable:
+            self.keytable[code](code)
+        elif testing:
+            noop(code)
+
+    def latencyStats(self):
+        '''(count, mean, max) of kernel event to callback, in seconds.'''
+        latencies = list(self.latencies)
+        if not latencies:
+            return (0, 0.0, 0.0)
+        return (len(latencies), sum(latencies) / len(latencies), max(latencies))
+
 def main(argv):
     device = '/dev/input/event0'
     if len(argv) > 1:
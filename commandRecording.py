@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+'''
+Compact recordings of the commands a device handler consumes, and replay.
+
+With params.commandRecording set, every command the device handler takes
+off its queue is appended to that file.  A record is
+
+    opcode (1 byte)  time since the previous record (varint, ms)  values
+
+where the opcode is the command's index in Opcodes and the values
+depend on it: a zigzag varint for levels and MA, the mode code for
+set_mode, a, b and activate for adjust_ab, a byte for set_minimum.
+Anything else (unknown commands, odd values) is stored as JSON.  Each
+run of the handler starts with a START record holding the wall clock
+time, so one file collects a whole history.  A simulated 2h15m session
+(simulation.py) comes to about 830 bytes.
+
+The file starts with MAGIC.  Writes are buffered and flushed at least
+every flushInterval seconds, by the first record after it or, when the
+handler is idle, by a flush thread, and on exit.
+
+    ./commandRecording.py dump FILE
+    ./commandRecording.py replay FILE [--speed 1] [--run -1]
+                          [--handler buttshock|dweeb] [--port /dev/ttyUSB0]
+                          [--url http://localhost:31280/devices]
+                          [--emulator [--standIn] | --mock]
+
+replay feeds a run back into a real device handler at --speed times
+real time (0: as fast as the handler takes them) and prints the
+handler's command timing, so it doubles as a load generator for the
+transports.  --emulator and --mock run it against et232Emulator or
+mockDeviceWeb.
+'''
+
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import os
+import struct
+from SurpriseClient import ModeCodes
+import sys
+import threading
+import time
+
+MAGIC = b'SRC\x01'
+
+# Never reorder: recordings refer to commands by their index.
+Opcodes = ('off', 'on', 'on_low', 'on_norm', 'on_max', 'on_max_plus',
+           'on_max_a', 'on_max_b', 'reserve', 'release',
+           'set_levels_from_device', 'set_level_a', 'set_level_b', 'set_ma',
+           'set_mode', 'adjust_ab', 'set_minimum')
+OpcodeOf = {cmd: opcode for (opcode, cmd) in enumerate(Opcodes)}
+START = 0xfe
+JSON = 0xff
+
+IntCommands = ('set_level_a', 'set_level_b', 'set_ma')
+ModeNames = {code: name for (name, code) in ModeCodes.items()}
+
+
+def varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def zigzag(n):
+    return varint((n << 1) if n >= 0 else ((-n << 1) - 1))
+
+
+def isInt(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def encode(command, delta):
+    '''The record for command, delta milliseconds after the previous one.'''
+    cmd = command['cmd']
+    opcode = OpcodeOf.get(cmd)
+    values = bytearray()
+    keys = set(command) - {'stamps'}
+    if opcode is None:
+        pass
+    elif cmd in IntCommands and keys == {'cmd', 'value'} and isInt(command['value']):
+        values = zigzag(command['value'])
+    elif cmd == 'set_mode' and keys == {'cmd', 'value'} and command['value'] in ModeCodes:
+        values = bytearray([ModeCodes[command['value']]])
+    elif (cmd == 'adjust_ab' and keys == {'cmd', 'a', 'b', 'activate'} and
+          isInt(command['a']) and isInt(command['b'])):
+        values = zigzag(command['a']) + zigzag(command['b'])
+        values.append(bool(command['activate']))
+    elif cmd == 'set_minimum' and keys == {'cmd', 'value'}:
+        values = bytearray([bool(command['value'])])
+    elif keys != {'cmd'}:
+        opcode = None
+    if opcode is None:
+        text = json.dumps({k: command[k] for k in keys}).encode()
+        (opcode, values) = (JSON, varint(len(text)) + text)
+    return bytes([opcode]) + varint(delta) + values
+
+
+class Reader():
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self):
+        (n, shift) = (0, 0)
+        while True:
+            b = self.byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def zigzag(self):
+        n = self.varint()
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+    def records(self):
+        '''Yield (run, start, at, command): the run number, the wall clock
+           time it started and seconds since then.  A recording cut short
+           (e.g. by a crash) ends at its last complete record.
+        '''
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a command recording')
+        self.offset = len(MAGIC)
+        (run, start, at) = (-1, None, 0)
+        while self.offset < len(self.data):
+            try:
+                opcode = self.byte()
+                if opcode == START:
+                    (start,) = struct.unpack_from('<d', self.data, self.offset)
+                    self.offset += 8
+                    (run, at) = (run + 1, 0)
+                    continue
+                at += self.varint()
+                yield (run, start, at / 1000.0, self.command(opcode))
+            except (IndexError, struct.error):
+                logging.warning('recording truncated at byte %d' % self.offset)
+                return
+
+    def command(self, opcode):
+        if opcode == JSON:
+            length = self.varint()
+            text = self.data[self.offset:self.offset + length]
+            if len(text) < length:
+                raise IndexError
+            self.offset += length
+            return json.loads(text.decode())
+        cmd = Opcodes[opcode]
+        if cmd in IntCommands:
+            return {'cmd': cmd, 'value': self.zigzag()}
+        if cmd == 'set_mode':
+            return {'cmd': cmd, 'value': ModeNames[self.byte()]}
+        if cmd == 'adjust_ab':
+            return {'cmd': cmd, 'a': self.zigzag(), 'b': self.zigzag(),
+                    'activate': bool(self.byte())}
+        if cmd == 'set_minimum':
+            return {'cmd': cmd, 'value': bool(self.byte())}
+        return {'cmd': cmd}
+
+
+def read(path):
+    '''All runs in a recording: a list of (start, [(at, command), ...]).'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    runs = {}
+    for (run, start, at, command) in Reader(data).records():
+        runs.setdefault(run, (start, []))[1].append((at, command))
+    return [runs[run] for run in sorted(runs)]
+
+
+class Recorder():
+    '''Appends commands to a recording.  record() is called on the device
+       handler's thread; the file is only written when the buffer fills,
+       flushInterval has passed or on close() (at the latest on exit).
+       The flush thread writes out what an idle handler left buffered.
+    '''
+    def __init__(self, path, flushInterval=10.0, clock=time.monotonic,
+                 wallClock=time.time):
+        self.path = path
+        self.flushInterval = flushInterval
+        self.clock = clock
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab', buffering=8192)
+        if new:
+            self.file.write(MAGIC)
+        self.file.write(bytes([START]) + struct.pack('<d', wallClock()))
+        self.last = self.clock()
+        self.flushed = self.last
+        self.records = 0
+        self.lock = threading.Lock()
+        # Records written since the last flush.
+        self.dirty = False
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(name='recorder', target=self.flushLoop,
+                                        daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def record(self, command, now=None):
+        '''Record command as of now, by default the time it was queued.'''
+        if command is None:
+            return
+        if now is None:
+            stamps = command.get('stamps')
+            now = stamps[0] if stamps else self.clock()
+        with self.lock:
+            if self.file.closed:
+                # After close() (on SIGTERM or at exit) the handler may
+                # still take a command; that isn't a device error.
+                return
+            # Keep last at the recorded time so rounding doesn't accumulate.
+            delta = max(0, int(round((now - self.last) * 1000)))
+            self.last += delta / 1000.0
+            self.file.write(encode(command, delta))
+            self.records += 1
+            self.dirty = True
+            if now - self.flushed >= self.flushInterval:
+                self.file.flush()
+                self.flushed = now
+                self.dirty = False
+
+    def flushLoop(self):
+        # Wall clock intervals: clock may be a simulation's.
+        while not self.closed.wait(self.flushInterval):
+            with self.lock:
+                if self.dirty and not self.file.closed:
+                    self.file.flush()
+                    self.dirty = False
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.file.close()
+
+
+async def replay(commands, queue, speed=1.0):
+    '''Put (at, command) pairs on queue at speed times real time, or as
+       fast as the queue takes them with speed 0.  Returns once the last
+       command has been taken off the queue.
+    '''
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    for (at, command) in commands:
+        if speed:
+            delay = start + at / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        queue.put(dict(command))
+        while speed == 0 and queue.qsize() > 4:
+            await asyncio.sleep(0.001)
+    while queue.qsize():
+        await asyncio.sleep(0.01)
+
+
+def dump(args):
+    for (start, commands) in read(args.file):
+        print('run started %s, %d commands over %.0fs' % (
+              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+              len(commands), commands[-1][0] if commands else 0))
+        for (at, command) in commands:
+            print('  %9.3f %s' % (at, command))
+    print('%d bytes' % os.path.getsize(args.file))
+
+
+def handler(args, queue):
+    import playSound
+
+    class Silent():
+        def play(self, name):
+            pass
+
+    playSound.engine = Silent()
+    if args.handler == 'buttshock':
+        import buttshockClient
+        port = args.port
+        if args.emulator:
+            from et232Emulator import ET232Emulator, useClient
+            print('client: %s' % useClient(buttshockClient.buttshock.et232,
+                                           args.standIn))
+            emulator = ET232Emulator()
+            atexit.register(emulator.stop)
+            port = emulator.start()
+        return buttshockClient.deviceHandler(queue, port=port)
+    import dweebClient
+    url = args.url
+    if args.mock:
+        from mockDeviceWeb import MockDeviceWeb
+        url = 'http://127.0.0.1:%d/devices' % MockDeviceWeb(31282, 0.02).start().port
+    return dweebClient.deviceHandler(queue, webUrl=url,
+                                     WSUrl=url.replace('http', 'ws', 1),
+                                     test=True)
+
+
+def replayMain(args):
+    from SurpriseClient import CommandQueue
+    (start, commands) = read(args.file)[args.run]
+    device = handler(args, CommandQueue())
+
+    async def run():
+        task = asyncio.ensure_future(device.run())
+        began = time.monotonic()
+        await replay(commands, device.queue, args.speed)
+        await asyncio.sleep(0.5)
+        elapsed = time.monotonic() - began - 0.5
+        task.cancel()
+        await asyncio.wait([task])
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    print('replayed %d commands (%.0fs recorded) in %.2fs: %.0f commands/s' % (
+          len(commands), commands[-1][0] if commands else 0, elapsed,
+          len(commands) / elapsed))
+    print(device.timing.dump())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_dump = commands.add_parser('dump')
+    parser_dump.add_argument('file')
+    parser_replay = commands.add_parser('replay')
+    parser_replay.add_argument('file')
+    parser_replay.add_argument('--speed', type=float, default=1.0,
+                               help='times real time; 0 for as fast as possible')
+    parser_replay.add_argument('--run', type=int, default=-1,
+                               help='which run of the recording (default: last)')
+    parser_replay.add_argument('--handler', choices=['buttshock', 'dweeb'],
+                               default='buttshock')
+    parser_replay.add_argument('--port', default='/dev/ttyUSB0')
+    parser_replay.add_argument('--url', default='http://localhost:31280/devices')
+    parser_replay.add_argument('--emulator', action='store_true',
+                               help='replay into et232Emulator')
+    parser_replay.add_argument('--mock', action='store_true',
+                               help='replay into mockDeviceWeb')
+    parser_replay.add_argument('--standIn', action='store_true',
+                               help="with --emulator and without buttshock-py's "
+                                    "ET232 support, use the emulator's SerialClient")
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.CRITICAL)
+    if args.command == 'dump':
+        dump(args)
+    else:
+        replayMain(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
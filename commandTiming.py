@@ -0,0 +1,130 @@
+'''
+Per-command timing through the device queue.
+
+CommandQueue stamps each command as it is queued, and the device
+handler stamps it as it takes it off the queue, as the first serial
+write or websocket send for it starts and as the last one completes
+(for dweeb: as DeviceWeb acknowledges it).  The stamps are
+time.monotonic() values kept in command['stamps'] of the copy the queue
+holds; unstamped() leaves them out when a command is logged.
+
+CommandTiming turns the stamps into fixed-bucket histograms per command
+and phase:
+
+  wait       queued until taken off the queue
+  process    taken off the queue until the transport started
+  transport  transport start until complete
+  total      queued until complete, or until processed if nothing was
+             written
+
+A histogram is a fixed list of counts, so recording costs the same
+however long the handler has been running.  dump() formats them;
+runSurprise logs the dump on SIGUSR1.
+'''
+
+import bisect
+import time
+
+# Upper bucket edges in milliseconds; the last bucket takes the rest.
+BucketEdges = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+Phases = ('wait', 'process', 'transport', 'total')
+ENQUEUED, DEQUEUED, STARTED, DONE = range(4)
+
+
+def newStamps():
+    return [time.monotonic(), None, None, None]
+
+
+def unstamped(command):
+    '''command without its stamps, for logging.'''
+    if not command or 'stamps' not in command:
+        return command
+    return {key: value for (key, value) in command.items() if key != 'stamps'}
+
+
+def stamp(command, index):
+    stamps = command.get('stamps') if command else None
+    if stamps is not None:
+        stamps[index] = time.monotonic()
+
+
+def started(command):
+    '''Stamp the start of the transport, unless it already started.'''
+    stamps = command.get('stamps') if command else None
+    if stamps is not None and stamps[STARTED] is None:
+        stamps[STARTED] = time.monotonic()
+
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BucketEdges) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BucketEdges, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def quantile(self, q):
+        '''Upper edge of the bucket holding the q quantile, or the
+           maximum if that is lower.
+        '''
+        rank = q * self.count
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(BucketEdges):
+                    return min(BucketEdges[index], self.max)
+                return self.max
+        return 0.0
+
+
+class CommandTiming():
+    def __init__(self):
+        self.histograms = {}
+        self.untimed = 0
+
+    def histogram(self, cmd, phase):
+        key = (cmd, phase)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        return self.histograms[key]
+
+    def record(self, command):
+        stamps = command.get('stamps') if command else None
+        if not stamps or stamps[DEQUEUED] is None:
+            self.untimed += 1
+            return
+        (enqueued, dequeued, start, done) = stamps
+        cmd = command['cmd']
+        self.histogram(cmd, 'wait').add((dequeued - enqueued) * 1000)
+        if start is not None and done is not None:
+            self.histogram(cmd, 'process').add((start - dequeued) * 1000)
+            self.histogram(cmd, 'transport').add((done - start) * 1000)
+        else:
+            done = time.monotonic()
+        self.histogram(cmd, 'total').add((done - enqueued) * 1000)
+
+    def dump(self):
+        lines = ['%-22s %-9s %6s %8s %8s %8s %8s' % (
+                 'command', 'phase', 'count', 'mean', 'p50', 'p95', 'max')]
+        for (cmd, phase) in sorted(self.histograms,
+                                   key=lambda k: (k[0], Phases.index(k[1]))):
+            h = self.histograms[(cmd, phase)]
+            lines.append('%-22s %-9s %6d %6.1fms %6.1fms %6.1fms %6.1fms' % (
+                         cmd, phase, h.count, h.sum / h.count,
+                         h.quantile(0.5), h.quantile(0.95), h.max))
+        lines.append('buckets (ms): %s' % ' '.join(
+                     '<=%g' % edge for edge in BucketEdges))
+        for (cmd, phase) in sorted(self.histograms):
+            if phase == 'total':
+                lines.append('%-22s %s' % (cmd, ' '.join(
+                             str(c) for c in self.histograms[(cmd, phase)].counts)))
+        if self.untimed:
+            lines.append('%d commands without stamps' % self.untimed)
+        return '\n'.join(lines)
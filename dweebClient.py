@@ -4,8 +4,11 @@ Dweeb client interface for an ErosTek ET232
 '''
 
 import asyncio
+import collections
+from commandTiming import DONE, stamp, started, unstamped
 import json
 import logging
+import params
 import pprint
 import queue
 import SurpriseClient
@@ -33,7 +36,14 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
     def __init__(self, deviceQ, max_a=40, max_b=50,
                        webUrl='http://localhost:31280/devices',
                        WSUrl='ws://localhost:31280/devices',
-                       test=False):
+                       test=False, window=params.dweebWindow,
+                       ackTimeout=params.dweebAckTimeout,
+                       reconnectDelay=params.dweebReconnectDelay):
+        '''Up to window commands may be sent before DeviceWeb acknowledges
+           them.  A command that is not acknowledged within ackTimeout
+           seconds is treated as acknowledged.  A lost connection is
+           retried every reconnectDelay seconds.
+        '''
         logging.info('creating dweeb deviceHandler instance')
         if not test:
             logger = logging.getLogger('websockets')
@@ -46,12 +56,16 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
         self.ma_high = 50
         self.webUrl = webUrl
         self.WSUrl = WSUrl
-        with urllib.request.urlopen(webUrl) as response:
-            html = response.read()
-            self.devices = json.loads(html.decode("utf-8"))
-            #pp = pprint.PrettyPrinter(indent=4)
-            #pp.pprint(self.device.devices)
-        dev = self.findDevice('ET 232')
+        self.window = window
+        self.ackTimeout = ackTimeout
+        self.reconnectDelay = reconnectDelay
+        self.inflight = collections.OrderedDict()
+        self.acks = []
+        # The command being sent; kept until it is sent in full, so one
+        # cut off by a lost connection is sent again after reconnecting.
+        self.pending = None
+        self.deviceState = None
+        dev = self.readDevice()
         self.devix = dev['devix']
         logging.info('deviceClient init: devix = %s', dev['devix'])
 
@@ -59,6 +73,15 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
 
         logging.info('dweeb deviceClient instance created')
 
+    def readDevice(self):
+        '''The ET 232's entry in DeviceWeb's device list (blocks).'''
+        with urllib.request.urlopen(self.webUrl) as response:
+            html = response.read()
+            self.devices = json.loads(html.decode("utf-8"))
+            #pp = pprint.PrettyPrinter(indent=4)
+            #pp.pprint(self.device.devices)
+        return self.findDevice('ET 232')
+
     def setLevelsFromState(self, state):
         '''
         This is a typical JSON state response.  We'll receive its a parsed dict.
@@ -71,30 +94,62 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
 
     async def run(self):
         logging.info('deviceClient run')
-        #try:
+        connected = False
         while True:
-            async with websockets.connect(self.WSUrl) as websocket:
-                logging.info('websocket: %s, %s' % (self.WSUrl, websocket))
-                self.websocket = websocket
-
-                logging.info('calling producer_handler')
-                await self.producer_handler(websocket)
-            logging.error('websocket: closing')
-            while not ws.closed:
-                await asyncio.sleep(1.0)
-        #except Exception as e:
-        #    logging.error('websocket open failed.  already in use?')
-        #    logging.error(e)
-        logging.error('deviceClient run completed')
+            try:
+                async with websockets.connect(self.WSUrl) as websocket:
+                    if connected:
+                        self.reconnects += 1
+                    connected = True
+                    logging.info('websocket: %s, %s' % (self.WSUrl, websocket))
+                    self.websocket = websocket
+                    self.slots = asyncio.Semaphore(self.window)
+                    reader = asyncio.ensure_future(self.WSReader(websocket))
+
+                    logging.info('calling producer_handler')
+                    try:
+                        await self.producer_handler(websocket)
+                    finally:
+                        reader.cancel()
+                        self.dropInflight()
+                logging.error('websocket: closing')
+            except (OSError, websockets.ConnectionClosed,
+                    websockets.InvalidHandshake) as e:
+                # DeviceWeb restarted or went away: retry until it's back.
+                logging.error('websocket: %s' % e)
+                self.errors += 1
+            await asyncio.sleep(self.reconnectDelay)
 
     async def producer_handler(self, ws):
         while ws.open:
             # logging.info('---- producer_handler called: qsize %d ----' % self.queue.qsize())
-            command = self.queue.get()
-            self.queue.task_done()
+            if self.pending is not None:
+                command = self.pending
+                logging.warning('resending %s' % unstamped(command))
+            else:
+                command = await self.nextCommand()
+                self.queue.task_done()
+                self.pending = command
             await self.processCommand(ws, command)
+            self.pending = None
+            self.finish(command)
         logging.info('websocket no longer open')
 
+    def finish(self, command):
+        '''A command is complete once DeviceWeb has acknowledged all it
+           sent, which with a window may be after the next one started.
+        '''
+        (acks, self.acks) = (self.acks, [])
+        if not acks or command is None:
+            super(deviceHandler, self).finish(command)
+            return
+
+        def done(f):
+            stamp(command, DONE)
+            super(deviceHandler, self).finish(command)
+
+        asyncio.gather(*acks).add_done_callback(done)
+
     def findDevice(self, device):
         for dev in self.devices:
             if dev['name'] == device:
@@ -103,26 +158,60 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
         raise self.NoDeviceFound
 
     async def WSReader(self, ws):
-        '''Stub routine for later.'''
-        while True:
-            message = await self.websocket.recv()
-            logging.info('WSReader received: %s' % message)
-            j = json.loads(message)
-            if j is not None:
-                await self.setLevelsFromState(j)
+        '''Read DeviceWeb replies and match them to commands in flight.'''
+        async for message in ws:
+            logging.debug('WSReader received: %s' % message)
+            try:
+                reply = json.loads(message)
+            except ValueError:
+                logging.error('WSReader: bad reply %s' % message)
+                continue
+            self.acknowledge(reply)
+
+    def acknowledge(self, reply):
+        '''Complete the command a reply belongs to.  Replies are matched on
+           seqNr; a reply without one acknowledges the oldest command.
+        '''
+        seqNr = reply.get('seqNr') if isinstance(reply, dict) else None
+        if isinstance(reply, dict) and 'level_a' in reply:
+            self.deviceState = reply
+        if seqNr in self.inflight:
+            ack = self.inflight.pop(seqNr)
+        elif seqNr is None and self.inflight:
+            (_, ack) = self.inflight.popitem(last=False)
+        else:
+            logging.debug('unsolicited reply: %s' % reply)
+            return
+        if not ack.done():
+            ack.set_result(reply)
+
+    def expire(self, seqNr):
+        ack = self.inflight.pop(seqNr, None)
+        if ack and not ack.done():
+            logging.warning('no reply for seqNr %d after %.1fs' % (
+                            seqNr, self.ackTimeout))
+            self.errors += 1
+            ack.set_result(None)
+
+    def dropInflight(self):
+        while self.inflight:
+            (_, ack) = self.inflight.popitem(last=False)
+            if not ack.done():
+                ack.set_result(None)
 
     async def processCommand(self, ws, command):
         if command == None:
             logging.error('Commands finished.')
             return
         else:
-            logging.info('processing %s' % command)
+            logging.info('processing %s' % unstamped(command))
             cmd = command['cmd']
             if cmd == 'reserve':
                 #await self.sendCommandStr(ws, cmd)
                 resp = await self.sendAndReceive(ws, cmd)
                 logging.info(resp)
-                self.setLevelsFromState(json.loads(resp))
+                if resp is not None:
+                    self.setLevelsFromState(resp)
                 await asyncio.sleep(1.0)
             elif cmd == 'release':
                 #resp = await self.sendAndReceive(ws, cmd)
@@ -145,7 +234,10 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
                 await self.setValue(ws, 'set_level_a', 0)
                 await self.setValue(ws, 'set_level_b', self.max_b)
             elif cmd == 'adjust_ab':
-                self.adjustLevels(2 * command['a'], 2 * command['b'])
+                # Adjust once, even if the command has to be sent again.
+                if not command.get('adjusted'):
+                    self.adjustLevels(2 * command['a'], 2 * command['b'])
+                    command['adjusted'] = True
                 if command['activate']:
                     if command['a'] != 0:
                         await self.setValue(ws, 'set_level_a', self.max_a)
@@ -156,6 +248,10 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
                 self.setMinimum(zero=value)
                 logging.info('setting levels: max_a_min %d, max_b_min %d' % 
                               (self.max_a_min, self.max_b_min))
+            elif cmd == 'set_levels_from_device':
+                dev = await asyncio.get_event_loop().run_in_executor(
+                    None, self.readDevice)
+                self.setLevelsFromState(dev['state'])
             elif cmd == 'off':
                 await self.setValue(ws, 'set_level_a', 0)
                 await self.setValue(ws, 'set_level_b', 0)
@@ -179,8 +275,8 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
 
     async def sendAndReceive(self, ws, event):
         cmd = {'event': event}
-        await self.sendCommand(ws, cmd)
-        resp = await ws.recv()
+        ack = await self.sendCommand(ws, cmd)
+        resp = await ack
         return(resp)
 
     async def sendCommandStr(self, ws, event):
@@ -188,14 +284,31 @@ class deviceHandler(SurpriseClient.genericDeviceHandler):
         await self.sendCommand(ws, cmd)
 
     async def sendCommand(self, ws, cmd):
-        cmd['seqNr'] = self.seqNr
+        '''Send cmd once a window slot is free and return a future that
+           completes with DeviceWeb's reply (or None if none arrives).
+        '''
+        await self.slots.acquire()
+        loop = asyncio.get_event_loop()
+        seqNr = self.seqNr
+        cmd['seqNr'] = seqNr
         self.seqNr += 1
         cmd['devix'] = self.devix
         commandStr = json.dumps(cmd)
+        ack = loop.create_future()
+        self.inflight[seqNr] = ack
+        timer = loop.call_later(self.ackTimeout, self.expire, seqNr)
+        ack.add_done_callback(lambda f: (timer.cancel(), self.slots.release()))
         logging.info('Request: %s' % commandStr)
-        await ws.send(commandStr)
+        started(self.current)
+        self.acks.append(ack)
+        try:
+            await ws.send(commandStr)
+        except Exception:
+            self.inflight.pop(seqNr, None)
+            ack.set_result(None)
+            raise
         logging.info('Request: sent!')
-        await asyncio.sleep(1.5)
+        return ack
 
 
 def enqueueCommands(deviceQ, commands):
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+'''
+ET232 emulator on a pseudo-terminal.
+
+Serves a pty that buttshockClient.deviceHandler can open in place of
+/dev/ttyUSB0 and answers register reads and writes from a register file,
+so the whole serial path (handshake, read, write, reconnect) can be
+exercised without hardware.
+
+Timing: each command is answered only after the time its request and
+reply bytes would take on the wire at the configured baud rate (10 bits
+per byte), plus an optional processing delay.
+
+Faults: Faults can drop replies, corrupt them or stall them at random,
+and hangup() (or hangupAfter commands) drops the line the way pulling
+the USB cable does.  The port is a symlink that is pointed at a fresh
+pty when the line comes back, so the handler can reconnect to the same
+path.
+
+The wire format is a Protocol object.  AsciiProtocol is a reconstruction
+(0x00 sync answered by 0x07, 'H'+address to read and 'I'+address+value to
+write, in hex, terminated by CR) rather than a capture from a real
+ET232; replace it if your unit differs.  SerialClient speaks the same
+protocol through pyserial.
+
+useClient() picks the client the handler talks to the emulator with.
+With buttshock-py's ET232SerialSync installed, it must agree with the
+emulator (handshake, a register read and a write) or nothing runs.
+SerialClient only stands in for it when asked to, since measuring it
+says nothing about the real client.
+
+    ./et232Emulator.py [--baud 19200]     # serve until interrupted
+'''
+
+import logging
+import os
+import pty
+import random
+import select
+import serial
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+SYNC = 0x00
+SYNC_REPLY = 0x07
+ACK = 0x06
+
+
+class AsciiProtocol():
+    '''Requests and replies, as bytes.  parse() takes the bytes received so
+       far and returns (consumed, request) for the first complete request,
+       or (0, None) if there isn't one yet.  A request is ('sync',),
+       ('read', address) or ('write', address, value).
+    '''
+    READ = b'H'
+    WRITE = b'I'
+    END = b'\r'
+
+    def parse(self, data):
+        if not data:
+            return (0, None)
+        if data[0] == SYNC:
+            return (1, ('sync',))
+        end = data.find(self.END)
+        if end < 0:
+            return (0, None)
+        (line, consumed) = (data[:end], end + 1)
+        try:
+            if line[:1] == self.READ and len(line) == 3:
+                return (consumed, ('read', int(line[1:3], 16)))
+            if line[:1] == self.WRITE and len(line) == 5:
+                return (consumed, ('write', int(line[1:3], 16), int(line[3:5], 16)))
+        except ValueError:
+            pass
+        return (consumed, ('bad', line))
+
+    def request(self, kind, address=0, value=0):
+        if kind == 'sync':
+            return bytes([SYNC])
+        if kind == 'read':
+            return self.READ + b'%02X' % address + self.END
+        return self.WRITE + b'%02X%02X' % (address, value) + self.END
+
+    def reply(self, request, value=None):
+        kind = request[0]
+        if kind == 'sync':
+            return bytes([SYNC_REPLY])
+        if kind == 'read':
+            return b'%02X' % value + self.END
+        if kind == 'write':
+            return bytes([ACK])
+        return b''
+
+    def replyLength(self, kind):
+        return {'sync': 1, 'read': 3, 'write': 1}[kind]
+
+    def value(self, reply):
+        return int(reply[:2], 16)
+
+
+class Faults():
+    '''Per command probabilities of a dropped, corrupted or stalled reply.'''
+    def __init__(self, drop=0.0, corrupt=0.0, stall=0.0, stallTime=0.5,
+                 hangupAfter=None, seed=None):
+        self.drop = drop
+        self.corrupt = corrupt
+        self.stall = stall
+        self.stallTime = stallTime
+        self.hangupAfter = hangupAfter
+        self.rng = random.Random(seed)
+
+
+class ET232Emulator():
+    # ET232 defaults for the registers buttshockClient uses.
+    Registers = {0x8c: 30, 0x88: 30, 0x89: 128, 0xa3: 11, 0xa4: 0, 0xd3: 0}
+
+    def __init__(self, baud=19200, latency=0.0, faults=None, protocol=None,
+                 registers=None, downtime=1.0):
+        self.baud = baud
+        self.latency = latency
+        self.faults = faults or Faults()
+        self.protocol = protocol or AsciiProtocol()
+        self.registers = dict(registers or self.Registers)
+        self.downtime = downtime
+        self.directory = tempfile.mkdtemp(prefix='et232-')
+        self.path = os.path.join(self.directory, 'ttyUSB0')
+        self.master = None
+        self.slave = None
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.served = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.hangups = 0
+        self.writes = []    # (time.monotonic(), register, value)
+        self.up = threading.Event()
+
+    def byteTime(self, n):
+        return n * 10.0 / self.baud
+
+    def open(self):
+        (master, slave) = pty.openpty()
+        tty.setraw(slave)
+        if os.path.lexists(self.path):
+            os.unlink(self.path)
+        os.symlink(os.ttyname(slave), self.path)
+        (self.master, self.slave) = (master, slave)
+        self.up.set()
+        logging.info('ET232 emulator on %s (%s)' % (self.path, os.ttyname(slave)))
+
+    def close(self):
+        self.up.clear()
+        if os.path.lexists(self.path):
+            os.unlink(self.path)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        (self.master, self.slave) = (None, None)
+
+    def start(self):
+        self.open()
+        self.running = True
+        self.thread = threading.Thread(name='et232-emulator', target=self.serve,
+                                       daemon=True)
+        self.thread.start()
+        return self.path
+
+    def stop(self):
+        '''Stop serving, close the pty and remove the port's directory.'''
+        self.running = False
+        if self.thread is not None:
+            # serve() checks running at least every 0.1s.
+            self.thread.join(1.0)
+            self.thread = None
+        with self.lock:
+            self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def hangup(self, downtime=None):
+        '''Drop the line now and bring it back (as a new pty behind the same
+           path) after downtime seconds.
+        '''
+        with self.lock:
+            self.hangups += 1
+            self.close()
+        threading.Timer(self.downtime if downtime is None else downtime,
+                        self.reopen).start()
+
+    def reopen(self):
+        with self.lock:
+            if self.running and self.master is None:
+                self.open()
+
+    def serve(self):
+        data = b''
+        while self.running:
+            if not self.up.wait(0.1):
+                data = b''
+                continue
+            with self.lock:
+                master = self.master
+            if master is None:
+                continue
+            try:
+                (readable, _, _) = select.select([master], [], [], 0.1)
+                if not readable:
+                    continue
+                data += os.read(master, 1024)
+            except OSError:
+                # The client closed its end; wait for it to reopen.
+                time.sleep(0.05)
+                continue
+            while True:
+                (consumed, request) = self.protocol.parse(data)
+                if not consumed:
+                    break
+                data = data[consumed:]
+                self.answer(master, request, consumed)
+
+    def answer(self, master, request, requestLength):
+        kind = request[0]
+        value = None
+        if kind == 'read':
+            value = self.registers.get(request[1], 0)
+        elif kind == 'write':
+            self.registers[request[1]] = request[2]
+            self.writes.append((time.monotonic(), request[1], request[2]))
+        elif kind == 'bad':
+            logging.error('ET232 emulator: bad request %r' % (request[1],))
+            return
+        self.served += 1
+        reply = self.protocol.reply(request, value)
+        time.sleep(self.byteTime(requestLength + len(reply)) + self.latency)
+
+        faults = self.faults
+        if kind != 'sync':
+            if faults.rng.random() < faults.drop:
+                self.dropped += 1
+                return
+            if faults.rng.random() < faults.corrupt:
+                self.corrupted += 1
+                reply = bytes(b ^ 0x5a for b in reply)
+            if faults.rng.random() < faults.stall:
+                time.sleep(faults.stallTime)
+        try:
+            os.write(master, reply)
+        except OSError:
+            pass
+        if faults.hangupAfter and self.served % faults.hangupAfter == 0:
+            self.hangup()
+
+
+class SerialClient():
+    '''The ET232SerialSync interface (perform_handshake, read, write,
+       close and .port) over pyserial, speaking AsciiProtocol.
+    '''
+    def __init__(self, port, debug=False, timeout=0.5, protocol=None):
+        self.debug = debug
+        self.protocol = protocol or AsciiProtocol()
+        self.port = serial.Serial(port, 19200, timeout=timeout)
+
+    def command(self, kind, address=0, value=0):
+        self.port.write(self.protocol.request(kind, address, value))
+        length = self.protocol.replyLength(kind)
+        reply = self.port.read(length)
+        if len(reply) < length:
+            raise IOError('ET232: short reply %r to %s' % (reply, kind))
+        return reply
+
+    def perform_handshake(self):
+        self.port.reset_input_buffer()
+        for _ in range(12):
+            self.port.write(bytes([SYNC]))
+            reply = self.port.read(1)
+            if reply == bytes([SYNC_REPLY]):
+                return
+        raise IOError('ET232: no handshake reply')
+
+    def read(self, address):
+        reply = self.command('read', address)
+        try:
+            return self.protocol.value(reply)
+        except ValueError:
+            raise IOError('ET232: bad reply %r' % reply)
+
+    def write(self, address, data):
+        for (offset, value) in enumerate(data):
+            reply = self.command('write', address + offset, value)
+            if reply != bytes([ACK]):
+                raise IOError('ET232: write not acknowledged: %r' % reply)
+
+    def close(self):
+        self.port.close()
+
+
+def mismatch(clientClass, timeout=5.0):
+    '''Why clientClass and the emulator don't understand each other, or
+       None if they do: a handshake, a read of a register and a write the
+       emulator sees, on an emulator of its own.
+    '''
+    emulator = ET232Emulator()
+    path = emulator.start()
+    result = []
+
+    def probe():
+        try:
+            client = clientClass(path, debug=False)
+            try:
+                client.perform_handshake()
+                expected = emulator.registers[0x89]
+                value = client.read(0x89)
+                if value != expected:
+                    result.append('read of 0x89 gave %r, not %d' % (value, expected))
+                    return
+                client.write(0x89, [value ^ 0x55])
+                if emulator.registers[0x89] != value ^ 0x55:
+                    result.append('the emulator did not see a write to 0x89')
+                    return
+                result.append(None)
+            finally:
+                client.close()
+        except Exception as e:
+            result.append('%s: %s' % (type(e).__name__, e))
+
+    thread = threading.Thread(name='et232-probe', target=probe, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    emulator.stop()
+    if not result:
+        return 'no answer within %.0fs' % timeout
+    return result[0]
+
+
+def useClient(et232, standIn=False):
+    '''Make sure et232 (the buttshock.et232 module) has an ET232SerialSync
+       that talks to the emulator and return a description of it.  Raises
+       RuntimeError if the installed one disagrees with the emulator, or
+       if none is installed and standIn is False.
+    '''
+    if hasattr(et232, 'ET232SerialSync') and et232.ET232SerialSync is not SerialClient:
+        reason = mismatch(et232.ET232SerialSync)
+        if reason:
+            raise RuntimeError('buttshock-py ET232SerialSync and the emulator '
+                               'disagree (%s); fix AsciiProtocol first' % reason)
+        return 'buttshock-py ET232SerialSync'
+    if not standIn:
+        raise RuntimeError('buttshock-py ET232SerialSync is not installed; '
+                           'use the stand-in option to run against the '
+                           "emulator's own SerialClient instead")
+    et232.ET232SerialSync = SerialClient
+    return "the emulator's SerialClient (stand-in, not buttshock-py)"
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baud', type=int, default=19200)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--corrupt', type=float, default=0.0)
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.INFO)
+    emulator = ET232Emulator(args.baud, args.latency,
+                             Faults(drop=args.drop, corrupt=args.corrupt))
+    print('serving %s' % emulator.start())
+    try:
+        while True:
+            time.sleep(10)
+            print('served %d, writes %d, registers %s' % (
+                  emulator.served, len(emulator.writes),
+                  {'%02x' % r: v for (r, v) in emulator.registers.items()}))
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,140 @@
+'''
+Runtime metrics for the /metrics endpoint, in the plain-text exposition
+format Prometheus and friends scrape.
+
+Everything here is read from counters and containers the code already
+keeps (or plain integers it bumps), without taking any of their locks:
+a scrape every few seconds must not hold up the device handler, the
+timers or the IOLoop.  A value read while another thread updates it may
+be one update behind, which is fine for a gauge.
+'''
+
+from commandTiming import BucketEdges
+import playSound
+import threading
+
+# Every state Surprise can be in, for the surprise_state gauge.
+States = ('Idle', 'IdleOn', 'Waiting', 'Starting', 'On', 'Off')
+
+
+def labels(**values):
+    if not values:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for (name, value) in sorted(values.items()))
+
+
+class Exposition():
+    '''Collects metric families and renders them as text.'''
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, value, **values):
+        self.lines.append('%s%s %s' % (name, labels(**values), value))
+
+    def metric(self, name, kind, help, value, **values):
+        self.family(name, kind, help)
+        self.sample(name, value, **values)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def collect(surprise, webSockets=None):
+    '''The metrics of a running Surprise as exposition text.  webSockets
+       (runSurprise.CommandHandler) has clients and sent for the /command
+       websocket.
+    '''
+    out = Exposition()
+    device = surprise.device
+
+    # Reads the deque directly: qsize() takes the queue's mutex.
+    out.metric('surprise_device_queue_depth', 'gauge',
+               'Commands waiting for the device handler.',
+               len(surprise.queue.queue))
+    out.metric('surprise_device_queue_enqueued_total', 'counter',
+               'Commands put on the device queue.', surprise.queue.enqueued)
+    out.metric('surprise_threads', 'gauge', 'Live threads.',
+               threading.active_count())
+    out.metric('surprise_timers_pending', 'gauge',
+               'Timers scheduled, including cancelled ones not yet dropped.',
+               surprise.scheduler.queued())
+    out.metric('surprise_session_timers', 'gauge',
+               'Timers of the current session.', len(surprise.sessionTimers))
+
+    endpoints = []
+    if surprise.wsHandler is not None:
+        endpoints.append(('status', surprise.wsHandler))
+    if webSockets is not None:
+        endpoints.append(('command', webSockets))
+    out.family('surprise_websocket_clients', 'gauge',
+               'Connected websocket clients.')
+    for (endpoint, ws) in endpoints:
+        out.sample('surprise_websocket_clients', len(ws.clients),
+                   endpoint=endpoint)
+    out.family('surprise_websocket_messages_sent_total', 'counter',
+               'Websocket messages sent.')
+    for (endpoint, ws) in endpoints:
+        out.sample('surprise_websocket_messages_sent_total', ws.sent,
+                   endpoint=endpoint)
+
+    if device is not None:
+        out.metric('surprise_device_commands_total', 'counter',
+                   'Commands processed by the device handler.',
+                   device.commands)
+        out.metric('surprise_device_errors_total', 'counter',
+                   'Device errors (failed commands, dropped connections, '
+                   'unacknowledged commands).', device.errors)
+        out.metric('surprise_device_reconnects_total', 'counter',
+                   'Device reconnects.', device.reconnects)
+        commandSeconds(out, device.timing)
+
+    (calls, seconds) = playSound.stats()
+    out.metric('surprise_sound_calls_total', 'counter',
+               'playSound() calls.', calls)
+    out.metric('surprise_sound_seconds_total', 'counter',
+               'Seconds spent in playSound() calls.', '%.6f' % seconds)
+    engine = playSound.engine
+    if isinstance(engine, playSound.AudioEngine):
+        out.metric('surprise_sound_played_total', 'counter',
+                   'Sounds played by the audio engine.', engine.played)
+
+    state = surprise.state
+    out.family('surprise_state', 'gauge', 'The current state (1) of Surprise.')
+    for name in States:
+        out.sample('surprise_state', int(name == state), state=name)
+    out.metric('surprise_locked', 'gauge', 'Whether the controls are locked.',
+               int(bool(surprise.locked)))
+    out.metric('surprise_session_seconds', 'gauge',
+               'Planned time of the current session so far.',
+               surprise.sessionTime)
+    out.metric('surprise_state_seconds', 'gauge', 'Time in the current state.',
+               '%.3f' % (surprise.clock() - surprise.stateStart))
+    return out.text()
+
+
+def commandSeconds(out, timing):
+    '''The 'total' timing histograms (queued to complete) per command.'''
+    out.family('surprise_device_command_seconds', 'histogram',
+               'Time from queueing a command to its completion.')
+    # list() copies the dict in one step, so a new command showing up in
+    # the handler thread meanwhile can't break the iteration.
+    for ((cmd, phase), histogram) in sorted(list(timing.histograms.items())):
+        if phase != 'total':
+            continue
+        counts = list(histogram.counts)
+        cumulative = 0
+        for (edge, count) in zip(BucketEdges, counts):
+            cumulative += count
+            out.sample('surprise_device_command_seconds_bucket', cumulative,
+                       cmd=cmd, le='%g' % (edge / 1000.0))
+        out.sample('surprise_device_command_seconds_bucket', sum(counts),
+                   cmd=cmd, le='+Inf')
+        out.sample('surprise_device_command_seconds_sum',
+                   '%.6f' % (histogram.sum / 1000.0), cmd=cmd)
+        out.sample('surprise_device_command_seconds_count', sum(counts),
+                   cmd=cmd)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+'''
+A local stand-in for DeviceWeb (dweeb) with one ET 232 attached.
+
+Serves GET /devices and the websocket protocol dweebClient speaks on the
+same port: reserve, release, set_level_a, set_level_b, set_mode and
+set_ma.  Every command is answered with the device state, shaped like
+the example in dweebClient.setLevelsFromState, plus the command's seqNr.
+
+Commands are processed one at a time, as by the device, each taking
+latency seconds plus up to jitter more.  dropRate leaves a fraction of
+commands unanswered, and disconnect() closes every connection and
+refuses new ones for a while, so the dweeb transport's throughput and
+reconnect behaviour can be measured locally.
+
+    ./mockDeviceWeb.py [--port 31280] [--latency 0.02]
+'''
+
+import argparse
+import asyncio
+import http
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import websockets
+
+
+class MockDeviceWeb():
+    def __init__(self, port=31280, latency=0.0, jitter=0.0, dropRate=0.0,
+                 host='127.0.0.1', name='ET 232', devix=6, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.dropRate = dropRate
+        self.name = name
+        self.rng = random.Random(seed)
+        self.state = {'devix': devix, 'avail': 'local', 'mode': 2,
+                      'status': 'ready', 'level_a': 30, 'level_b': 30,
+                      'ma': 0, 'batt': 0}
+        self.loop = None
+        self.busy = None
+        self.clients = set()
+        self.downUntil = 0.0
+        self.received = []      # time.monotonic() of every command
+        self.connections = 0
+        self.dropped = 0
+
+    async def devices(self, path, headers):
+        if 'Upgrade' in headers:
+            if time.monotonic() < self.downUntil:
+                return (http.HTTPStatus.SERVICE_UNAVAILABLE, [], b'down\n')
+            return None
+        if path != '/devices':
+            return (http.HTTPStatus.NOT_FOUND, [], b'not found\n')
+        body = json.dumps([{'name': self.name, 'devix': self.state['devix'],
+                            'state': self.state}]).encode()
+        return (http.HTTPStatus.OK, [('Content-Type', 'application/json')], body)
+
+    def apply(self, cmd):
+        event = cmd.get('event')
+        if event == 'reserve':
+            self.state['avail'] = 'remote'
+        elif event == 'release':
+            self.state['avail'] = 'local'
+        elif event in ('set_level_a', 'set_level_b', 'set_mode', 'set_ma'):
+            self.state[event[4:]] = cmd['value']
+        else:
+            logging.error('mockDeviceWeb: unknown event %s' % event)
+
+    async def handler(self, ws, path):
+        self.connections += 1
+        self.clients.add(ws)
+        try:
+            async for message in ws:
+                self.received.append(time.monotonic())
+                cmd = json.loads(message)
+                async with self.busy:
+                    await asyncio.sleep(self.latency + self.jitter * self.rng.random())
+                    self.apply(cmd)
+                    reply = dict(self.state, seqNr=cmd.get('seqNr'))
+                if self.rng.random() < self.dropRate:
+                    self.dropped += 1
+                    continue
+                await ws.send(json.dumps(reply))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(ws)
+
+    async def serve(self):
+        self.loop = asyncio.get_event_loop()
+        self.busy = asyncio.Lock()
+        return await websockets.serve(self.handler, self.host, self.port,
+                                      process_request=self.devices)
+
+    def start(self):
+        '''Serve from a background thread.'''
+        ready = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.serve())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(name='mockDeviceWeb', target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def disconnect(self, downtime=0.0):
+        '''Close every connection and refuse new ones for downtime seconds.
+           May be called from any thread.
+        '''
+        self.downUntil = time.monotonic() + downtime
+
+        async def close():
+            for ws in list(self.clients):
+                await ws.close(code=1001, reason='going away')
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=31280)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--dropRate', type=float, default=0.0)
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.INFO)
+    mock = MockDeviceWeb(args.port, args.latency, args.jitter, args.dropRate)
+    asyncio.get_event_loop().run_until_complete(mock.serve())
+    print('mock DeviceWeb on %s:%d' % (mock.host, mock.port))
+    try:
+        asyncio.get_event_loop().run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv)
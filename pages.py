@@ -1,7 +1,20 @@
 """
 These are functions to return HTML pages.
+
+A page is one of a few layouts (rows of buttons) and only depends on the
+layout and whether Surprise is locked, so PageCache renders every
+combination once, with a strong ETag and pre-compressed bodies.
 """
 
+import gzip
+import hashlib
+import params
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
 def header(meta=''):
     return """
         <html>
@@ -38,18 +51,79 @@ def header(meta=''):
 
 def buttons(names):
     string = "\n"
+    if params.webUIMode == 'websocket':
+        for name in names:
+            string += '<button class="btn %s" type="button" onclick="press(\'%s\')">%s</button>' % (
+                     name.lower(), name.lower(), name) + "\n"
+        return '<div> %s </div>' % string
     for name in names:
         string += '<button class="btn %s" onclick="playSound()" name=action value="%s">%s</button>' % (
                  name.lower(), name.lower(), name) + "\n"
     return '<form method="get" action="/"> %s </form>' % string
 
+def commandChannel():
+    """Script for the 'websocket' web UI mode.  Button presses are sent
+       over /command and the reply replaces the buttons in place.
+    """
+    return """
+        <script>
+            var command = new WebSocket("ws://" + location.host + "/command");
+            command.onmessage = function (event) {
+                var reply = JSON.parse(event.data);
+                document.getElementById('controls').innerHTML = reply.controls;
+            };
+            function press(action) {
+                playSound();
+                command.send(action);
+            }
+        </script>"""
+
+def countdown():
+    """Script for the 'event' websocket protocol.  The server sends a
+       state: message on each state change and the timer is rendered
+       here, in the same format as wsHandler.getStatus().
+    """
+    return """
+        <script>
+            var current = null;
+            var skew = 0;
+            function showTimer() {
+                var element = document.getElementById('timer');
+                if (current == null || element == null) return;
+                var state = current.state;
+                if (state.substr(0, 4) == 'Idle' || state == 'Waiting') {
+                    element.innerHTML = state;
+                    return;
+                }
+                var elapsed = Date.now() / 1000 - skew - current.start;
+                element.innerHTML = state + ' ' + Math.floor(elapsed) + '/' +
+                    Math.floor(current.duration) + 's,  ' +
+                    Math.floor(current.total) + 's total';
+            }
+            function onState(value) {
+                current = JSON.parse(value);
+                skew = Date.now() / 1000 - current.now;
+                showTimer();
+            }
+            setInterval(showTimer, 500);
+        </script>"""
+
 def trailer():
+    if params.wsProtocol == 'event':
+        script = countdown()
+        onState = 'if (fields[1] == "state") { onState(fields[2]); return; }'
+    else:
+        script = ''
+        onState = ''
+    if params.webUIMode == 'websocket':
+        script += commandChannel()
     return """
-        </center>
+        </center>%s
         <script>
             var ws = new WebSocket("ws://192.168.0.26:8889/");
             ws.onmessage = function (event) {
                 var fields = event.data.match(/([^:]*):(.*)/);
+                %s
                 var element = document.getElementById(fields[1])
                 if (element != null) element.innerHTML = fields[2];
             };
@@ -61,25 +135,83 @@ def trailer():
         </script>
         </body>
         </html>
-        """
+        """ % (script, onState)
 
-def idle(surprise):
-    if surprise.locked:
-        return header() + buttons(['Activate']) + trailer()
+def idleButtons(locked):
+    if locked:
+        return [['Activate']]
     else:
-        return (header() + buttons(['Activate', 'Lock']) +
-                '<br>' + buttons(['On', 'Off']) +
-                '<br>' + buttons(['Down', 'Up']) + trailer())
+        return [['Activate', 'Lock'], ['On', 'Off'], ['Down', 'Up']]
 
-def waiting(surprise):
-    if surprise.locked:
-        return header() + buttons(['Start']) + trailer()
+def waitingButtons(locked):
+    if locked:
+        return [['Start']]
     else:
-        return header() + buttons(['Start', 'Reset']) + trailer()
+        return [['Start', 'Reset']]
 
-def status(surprise):
-    if surprise.locked:
-        return header() + buttons(['Down', 'Up']) + trailer()
+def statusButtons(locked):
+    if locked:
+        return [['Down', 'Up']]
     else:
-        return header() + buttons(['Reset', 'Down', 'Up']) + trailer()
-                
+        return [['Reset', 'Down', 'Up']]
+
+Layouts = {
+    'idle': idleButtons,
+    'waiting': waitingButtons,
+    'status': statusButtons,
+}
+
+def controls(layout, locked):
+    rows = Layouts[layout](locked)
+    return '<br>'.join(buttons(row) for row in rows)
+
+def render(layout, locked):
+    if params.webUIMode == 'websocket':
+        return (header() + '<div id="controls">' + controls(layout, locked) +
+                '</div>' + trailer())
+    return header() + controls(layout, locked) + trailer()
+
+def idle(surprise):
+    return render('idle', surprise.locked)
+
+def waiting(surprise):
+    return render('waiting', surprise.locked)
+
+def status(surprise):
+    return render('status', surprise.locked)
+
+
+class RenderedPage():
+    """One page, encoded once as identity, gzip and (if available) brotli."""
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        digest = hashlib.sha1(body).hexdigest()
+        self.bodies = {'': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body)
+        self.etags = dict((encoding, '"%s%s"' % (digest, '-' + encoding if encoding else ''))
+                          for encoding in self.bodies)
+
+    def choose(self, acceptEncoding):
+        """Return (encoding, body, etag) for an Accept-Encoding header."""
+        accepted = [e.split(';')[0].strip() for e in acceptEncoding.split(',')]
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.bodies:
+                return (encoding, self.bodies[encoding], self.etags[encoding])
+        return ('', self.bodies[''], self.etags[''])
+
+
+class PageCache():
+    def __init__(self):
+        self.pages = {}
+        self.controls = {}
+        for layout in Layouts:
+            for locked in (False, True):
+                self.pages[(layout, locked)] = RenderedPage(render(layout, locked))
+                self.controls[(layout, locked)] = controls(layout, locked)
+
+    def get(self, layout, locked):
+        return self.pages[(layout, bool(locked))]
+
+    def getControls(self, layout, locked):
+        return self.controls[(layout, bool(locked))]
@@ -36,6 +36,11 @@ ADD_ON_PERCENT = 25
 ADD_OFF_PERCENT = 18
 TEASE_PERCENT = 20
 
+# Work out the whole session when it starts ('eager'), step by step as it
+# runs ('lazy'), or draw each interval when the previous one ends (None).
+# With a plan, the schedule can be previewed at /plan.
+sessionPlan = None
+
 # multipliers for levels off of max value
 MAX_PLUS_LEVEL = 1.1
 NORMAL_LEVEL = 0.88
@@ -65,16 +70,87 @@ USEFUL_ET232_MODES=['waves', 'intense', 'random', 'audio-soft',
 
 # Port number for Surprise web interface
 port = 8888
+# Web UI: 'form' buttons submit the page and reload it; 'websocket' buttons
+# send the action over a persistent websocket and only the buttons change.
+webUIMode = 'form'
+
+# Status websocket: updates buffered per browser, and what to do with a
+# browser that falls that far behind ('drop' its oldest update or
+# 'disconnect' it).
+wsClientBuffer = 16
+wsSlowClient = 'drop'
+# Status websocket protocol: 'poll' re-sends the timer text to every
+# browser twice a second; 'event' sends each state (with its start time
+# and planned duration) once and the page counts down by itself.
+wsProtocol = 'poll'
 
 # Devices and other strings
 #clickerDevice = '/dev/clicker'
 clickerDevice = '/dev/input/event0'
+# Read the clicker with evdev's asyncio interface on the main loop instead
+# of a blocking reader thread.  Repeated presses of the same key within
+# clickerDebounce seconds are ignored, and presses wait for their callback
+# without holding up the reader.  None are ever dropped; the steps of a
+# held key still waiting are added up.
+clickerAsync = False
+clickerDebounce = 0.05
+# Holding up/down on the clicker adjusts levels continuously.  The rate
+# (steps per second) grows with how long the key has been held, and the
+# steps earned are sent as one adjustment every clickerRepeatTick seconds.
+clickerRepeatRates = ((0.0, 5), (1.0, 10), (2.0, 20))
+clickerRepeatTick = 0.2
 
 # Estim Device handler: one of ('dweeb', 'buttshock')
 estimHandler = 'buttshock'
 # estimDevice (only used by buttshock handler)
 estimDevice = '/dev/ttyUSB0'
+# dweeb handler: number of commands that may be awaiting a DeviceWeb reply,
+# and how long to wait for a reply before sending on regardless.
+dweebWindow = 4
+dweebAckTimeout = 1.5
+# seconds between attempts to reconnect to DeviceWeb
+dweebReconnectDelay = 1.0
 
 
+# Log through a queue and a writer thread (see asyncLogging.py) instead
+# of writing on the calling thread.  The queue holds logQueueSize records;
+# logOverflow is 'drop-new', 'drop-old' or 'block'.
+asyncLogging = False
+logQueueSize = 10000
+logOverflow = 'drop-old'
+logBatchSize = 256
+logFlushInterval = 1.0
+
 announcePower = False
 keepaliveInterval = 15*60
+
+# Decode all sounds at startup and play them through one long-lived
+# output worker instead of running mpg123 (and waiting) for every sound.
+audioEngine = False
+# How a new request for a sound is queued when the audio engine is used:
+# 'queue' (default), 'dedupe' (replace a queued request for the same sound)
+# or 'preempt' (cut off what is playing and drop everything queued).
+soundRules = {
+    'sorry': 'dedupe',
+    'locked': 'dedupe',
+    'reset': 'preempt',
+}
+
+# Execution engine: one of ('threaded', 'async').
+#   threaded runs timers, the device handler and the websocket server on
+#     their own threads.
+#   async runs them all as coroutines on the tornado IOLoop, so state
+#     transitions never race each other.  A device handler with blocking
+#     I/O (buttshock) still gets a thread of its own, and sounds play in
+#     the background, so a transition no longer waits for its sound.
+# async stays opt-in until sessions have been run with that pacing.
+engine = 'threaded'
+
+# Drop queued device commands that a newer command makes pointless
+# (e.g. an 'off' still waiting when 'on_max' is queued).  Each dropped
+# command saves a serial write or, for dweeb, a websocket round trip.
+coalesceCommands = True
+
+# Append every command the device handler consumes to this file (see
+# commandRecording.py), or None.
+commandRecording = None
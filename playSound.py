@@ -1,12 +1,242 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import glob
 import logging
+import os
+import params
 import subprocess
+import threading
+import time
 
 '''
 Used http://www.fromtexttospeech.com/ with voice 'Daisy' to generate my mp3 files
+
+By default playSound() runs mpg123 for every sound and waits for it to
+finish.  After startAudioEngine() every file in sounds/ is decoded once
+into memory and playSound() only queues a request for the AudioEngine's
+output worker, which streams PCM into a single long-lived aplay process.
+After playInBackground() (the async engine, where the caller is the
+IOLoop) mpg123 runs on a worker thread of its own instead of the caller's.
 '''
+
+MPG123 = '/usr/bin/mpg123'
+APLAY = '/usr/bin/aplay'
+
+engine = None
+background = None
+
+# (calls, seconds) of playSound() per thread, for /metrics.  Each thread
+# only replaces its own entry, so neither playSound() nor a scrape takes
+# a lock.
+counts = {}
+
+
 def playSound(file):
+    start = time.monotonic()
+    try:
+        if engine is not None:
+            engine.play(file)
+        elif background is not None:
+            background.submit(mpg123, file)
+        else:
+            mpg123(file)
+    finally:
+        elapsed = time.monotonic() - start
+        ident = threading.get_ident()
+        (calls, seconds) = counts.get(ident, (0, 0.0))
+        counts[ident] = (calls + 1, seconds + elapsed)
+
+
+def stats():
+    '''(calls, seconds) of playSound() over all threads.'''
+    perThread = list(counts.values())
+    return (sum(c for (c, s) in perThread), sum(s for (c, s) in perThread))
+
+
+def mpg123(file):
     try:
-        completed = subprocess.run(['/usr/bin/mpg123', '-q', 'sounds/%s.mp3' % file])
+        completed = subprocess.run([MPG123, '-q', 'sounds/%s.mp3' % file])
     except OSError as e:
         logging.error('playSound failed: %s' % e)
 
+
+def playInBackground():
+    '''Play sounds with mpg123 one after another on a worker thread, so
+       playSound() returns at once.  The audio engine, when it runs,
+       takes precedence.
+    '''
+    global background
+    if background is None:
+        background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sound')
+
+
+def startAudioEngine(directory='sounds', rules=params.soundRules):
+    '''Decode all sounds and route playSound() through the AudioEngine.
+       Falls back to mpg123 per call if the engine cannot start.
+    '''
+    global engine
+    audio = AudioEngine(directory, rules)
+    try:
+        audio.start()
+    except OSError as e:
+        logging.error('audio engine failed to start, using mpg123: %s' % e)
+        return None
+    engine = audio
+    return audio
+
+
+class AudioEngine():
+    '''
+    Plays sounds from an in-memory PCM cache through one output worker.
+
+    rules maps a sound name to how a new request for it is queued:
+      'queue'   (default) play after everything already queued
+      'dedupe'  replace a request for the same sound that is still queued
+      'preempt' stop the sound that is playing and drop everything queued
+
+    A sound that couldn't be decoded, or any sound while the output
+    can't be opened, is played with mpg123 by the output worker.  The
+    output is reopened with a growing delay between attempts.
+    '''
+    RATE = 22050
+    CHANNELS = 1
+    SAMPLE_BYTES = 2
+    CHUNK_SECS = 0.02
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+
+    def __init__(self, directory='sounds', rules=None, player=None):
+        self.directory = directory
+        self.rules = rules or {}
+        self.player = player or [APLAY, '-q', '-t', 'raw', '-f', 'S16_LE',
+                                 '-r', str(self.RATE), '-c', str(self.CHANNELS),
+                                 '--buffer-time=50000']
+        self.chunk = int(self.RATE * self.CHUNK_SECS) * self.CHANNELS * self.SAMPLE_BYTES
+        self.cache = {}
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.interrupt = False
+        self.output = None
+        self.retryAt = 0.0
+        self.retryDelay = self.RETRY_MIN
+        self.played = 0
+        self.fallbacks = 0
+        self.latencies = collections.deque(maxlen=100)
+
+    def decode(self, path):
+        completed = subprocess.run(
+            [MPG123, '-q', '-s', '-m', '-r', str(self.RATE), '-e', 's16', path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return completed.stdout
+
+    def load(self):
+        start = time.monotonic()
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.mp3'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                self.cache[name] = self.decode(path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error('AudioEngine: cannot decode %s: %s' % (path, e))
+        logging.info('AudioEngine: decoded %d sounds, %d kB in %.1fs' % (
+                     len(self.cache), sum(map(len, self.cache.values())) / 1024,
+                     time.monotonic() - start))
+
+    def start(self):
+        self.load()
+        if not self.cache:
+            raise OSError('no sounds decoded from %s' % self.directory)
+        self.openOutput()
+        threading.Thread(name='audio', target=self.run, daemon=True).start()
+
+    def openOutput(self):
+        self.output = subprocess.Popen(self.player, stdin=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+
+    def closeOutput(self):
+        '''Kill and reap the player, so a failed one isn't left a zombie.'''
+        output = self.output
+        self.output = None
+        try:
+            output.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        output.kill()
+        output.wait()
+
+    def outputReady(self):
+        '''Whether there is an output, reopening it if it's time to try.'''
+        if self.output is not None:
+            return True
+        if time.monotonic() < self.retryAt:
+            return False
+        try:
+            self.openOutput()
+        except OSError as e:
+            logging.error('AudioEngine: cannot open output, retrying in %.0fs: %s' % (
+                          self.retryDelay, e))
+            self.retryAt = time.monotonic() + self.retryDelay
+            self.retryDelay = min(self.RETRY_MAX, self.retryDelay * 2)
+            return False
+        self.retryDelay = self.RETRY_MIN
+        return True
+
+    def play(self, name):
+        '''Queue a sound and return immediately.'''
+        rule = self.rules.get(name, 'queue')
+        with self.cond:
+            if rule == 'preempt':
+                self.pending.clear()
+                self.interrupt = True
+            elif rule == 'dedupe':
+                for request in list(self.pending):
+                    if request[0] == name:
+                        self.pending.remove(request)
+            self.pending.append((name, time.monotonic()))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                (name, requested) = self.pending.popleft()
+                self.interrupt = False
+            self.played += 1
+            if name in self.cache and self.outputReady():
+                self.stream(name, requested)
+            else:
+                self.fallback(name)
+
+    def stream(self, name, requested):
+        data = self.cache[name]
+        for offset in range(0, len(data), self.chunk):
+            if self.interrupt:
+                logging.debug('AudioEngine: %s preempted' % name)
+                break
+            try:
+                self.output.stdin.write(data[offset:offset + self.chunk])
+                self.output.stdin.flush()
+            except (BrokenPipeError, ValueError) as e:
+                logging.error('AudioEngine: output failed, restarting: %s' % e)
+                self.closeOutput()
+                break
+            if offset == 0:
+                latency = time.monotonic() - requested
+                self.latencies.append(latency)
+                logging.debug('AudioEngine: %s started after %.1fms' % (
+                              name, latency * 1000))
+
+    def fallback(self, name):
+        self.fallbacks += 1
+        path = os.path.join(self.directory, '%s.mp3' % name)
+        try:
+            subprocess.run([MPG123, '-q', path])
+        except OSError as e:
+            logging.error('AudioEngine: cannot play %s: %s' % (name, e))
+
+    def latencyStats(self):
+        '''(count, mean, max) of request to first sample, in seconds.'''
+        latencies = list(self.latencies)
+        if not latencies:
+            return (0, 0.0, 0.0)
+        return (len(latencies), sum(latencies) / len(latencies), max(latencies))
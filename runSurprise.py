@@ -6,30 +6,43 @@ the core state machine and locking (in process()).
 '''
 
 import argparse
+import asyncio
+import asyncLogging
 import clicker
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
+import metrics
 import os
 import pages
 import params
-from playSound import playSound
+from playSound import playInBackground, playSound, startAudioEngine
+import signal
 from Surprise import Surprise
 from syslog_rfc5424_formatter import RFC5424Formatter
 from threading import Thread
 import time
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
 
 
 TEST_MODE = False
 
-# Maps web page method to use for each state Surprise can be in.
+# Time to give the browser's button beep to play before answering.
+BEEP_DELAY = 0.5
+
+# Longest wait on SIGTERM for the device handler to take the last commands.
+STOP_DRAIN = 2.0
+
+# Maps the page layout to use for each state Surprise can be in.
 Page = {
-    'Idle': pages.idle,
-    'IdleOn': pages.idle,
-    'Waiting': pages.waiting,
-    'Starting': pages.status,
-    'On': pages.status,
-    'Off': pages.status,
+    'Idle': 'idle',
+    'IdleOn': 'idle',
+    'Waiting': 'waiting',
+    'Starting': 'status',
+    'On': 'status',
+    'Off': 'status',
 }
 
 
@@ -41,46 +54,209 @@ class MyFileHandler(tornado.web.StaticFileHandler):
     def Xparse_url_path(self, url_path):
         return os.path.basename('./' + url_path)
 
+    def get_cache_time(self, path, modified, mime_type):
+        # beep.wav never changes; let browsers keep it.
+        return self.CACHE_MAX_AGE
+
 
 class MainHandler(tornado.web.RequestHandler):
-    def initialize(self, processor):
+    def initialize(self, processor, pageCache):
         self.processor = processor
+        self.pageCache = pageCache
 
-    def get(self):
+    async def get(self):
         action = self.get_argument('action', None)
-        state = self.processor(action)
-        self.write(Page[state](surprise))
+        state = await self.processor(action)
+        page = self.pageCache.get(Page[state], surprise.locked)
+        (encoding, body, etag) = page.choose(
+            self.request.headers.get('Accept-Encoding', ''))
+        self.set_header('Etag', etag)
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if encoding:
+            self.set_header('Content-Encoding', encoding)
+        self.write(body)
+
+
+class CommandHandler(tornado.websocket.WebSocketHandler):
+    '''Web UI 'websocket' mode: each message is an action, and the reply
+       carries the state and the buttons to show for it.
+    '''
+    # For /metrics.
+    clients = set()
+    sent = 0
+
+    def initialize(self, processor, pageCache):
+        self.processor = processor
+        self.pageCache = pageCache
+
+    def open(self):
+        CommandHandler.clients.add(self)
+        self.reply(surprise.getState())
+
+    def on_close(self):
+        CommandHandler.clients.discard(self)
+
+    async def on_message(self, message):
+        # The page plays its beep itself and doesn't navigate, so there
+        # is no need to wait for it here.
+        state = await self.processor(message, wait=False)
+        self.reply(state)
+
+    def reply(self, state):
+        self.write_message(json.dumps({
+            'state': state,
+            'controls': self.pageCache.getControls(Page[state], surprise.locked),
+        }))
+        CommandHandler.sent += 1
+
+
+class PlanHandler(tornado.web.RequestHandler):
+    '''Read-only view of the session plan (params.sessionPlan) as JSON.
+       Step times are seconds after sessionStart.
+    '''
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps({'state': surprise.getState(),
+                               'plan': surprise.planPreview()}))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    '''Runtime gauges and counters in the plain-text exposition format.'''
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(metrics.collect(surprise, CommandHandler))
 
 
 class Processor():
-    def __init__(self, clicker):
+    def __init__(self, clicker, ioloop=None):
+        # With the async engine, clicker events are handed to the IOLoop
+        # so that every state transition runs on the loop thread.
+        self.ioloop = ioloop
+        # Web requests run their transitions here, one at a time, so a
+        # slow transition (e.g. playSound) doesn't hold up the IOLoop.
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='processor')
+        # Whether the last press of up and down adjusted the levels.
+        self.holdAdjusts = {}
         clicker.setUp(self.clickUp)
         clicker.setLeft(self.clickLeft)
         clicker.setRight(self.clickRight)
         clicker.setDown(self.clickDown)
         clicker.setMiddle(self.clickMiddle)
+        clicker.setUpRepeat(self.repeatUp)
+        clicker.setDownRepeat(self.repeatDown)
 
     def clickUp(self, code):
         logging.info('clickUp')
-        self.process('up')
+        self.dispatch('up')
 
     def clickLeft(self, code):
         logging.info('clickLeft')
-        self.process('left')
+        self.dispatch('left')
 
     def clickRight(self, code):
         logging.info('clickRight')
-        self.process('right')
+        self.dispatch('right')
 
     def clickDown(self, code):
         logging.info('clickDown')
-        self.process('down')
+        self.dispatch('down')
 
     def clickMiddle(self, code):
         logging.info('clickMiddle')
-        self.process('middle')
+        self.dispatch('middle')
+
+    def repeatUp(self, steps):
+        logging.info('repeatUp %d' % steps)
+        self.dispatchAdjust(steps)
+
+    def repeatDown(self, steps):
+        logging.info('repeatDown %d' % steps)
+        self.dispatchAdjust(-steps)
+
+    def dispatchAdjust(self, steps):
+        if self.ioloop:
+            self.ioloop.add_callback(self.adjust, steps)
+        else:
+            self.adjust(steps)
+
+    def adjust(self, steps):
+        '''Steps from a held up/down key, only if the press that started
+           the hold adjusted the levels and a press still would.  Holding
+           down to lock the controls must not go on to lower the levels.
+        '''
+        key = 'up' if steps > 0 else 'down'
+        if self.holdAdjusts.get(key) and self.adjustable():
+            surprise.adjustLevels(steps)
+
+    def adjustable(self):
+        '''Whether a press of up or down adjusts the levels.'''
+        state = surprise.getState()
+        return state == 'IdleOn' or (surprise.locked and
+                                     state in ('Starting', 'On', 'Off'))
+
+    def dispatch(self, action):
+        if self.ioloop:
+            self.ioloop.add_callback(self.press, action)
+        else:
+            self.press(action)
+
+    def press(self, action):
+        '''A clicker press.  Notes whether it adjusts the levels before
+           processing it, which may change that (e.g. by locking).
+        '''
+        self.holdAdjusts[action] = self.adjustable()
+        if self.ioloop:
+            return self.processAsync(action)
+        return self.process(action)
 
     def process(self, action):
+        state = self.transition(action)
+        time.sleep(BEEP_DELAY)   # Give time for beep to play.
+        return(state)
+
+    async def processAsync(self, action, wait=True):
+        '''Like process() but never blocks the IOLoop.  With the async
+           engine the transition runs on the loop itself (its sounds are
+           played in the background, see playInBackground), otherwise it
+           is handed to the processor thread.  wait=False skips the beep
+           wait.
+        '''
+        if self.ioloop:
+            state = self.transition(action)
+        else:
+            state = await tornado.ioloop.IOLoop.current().run_in_executor(
+                self.executor, self.transition, action)
+        if action is not None and wait:
+            await asyncio.sleep(BEEP_DELAY)   # Give time for beep to play.
+        return(state)
+
+    async def stop(self, ioloop):
+        '''On SIGTERM: end a session in progress, so its counters are
+           logged and the device is turned off, give the device handler
+           STOP_DRAIN to take the commands and stop ioloop.
+        '''
+        logging.info('stopping on SIGTERM in state %s' % surprise.getState())
+        try:
+            if surprise.getState() != 'Idle':
+                if self.ioloop:
+                    surprise.endSession()
+                else:
+                    await ioloop.run_in_executor(self.executor,
+                                                 surprise.endSession)
+            deadline = time.monotonic() + STOP_DRAIN
+            while surprise.queue.qsize() and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        finally:
+            ioloop.stop()
+
+    def transition(self, action):
         state = surprise.getState()
         locked = surprise.locked
         if TEST_MODE == True:
@@ -148,14 +324,18 @@ class Processor():
 	    
         state = surprise.getState()
         logging.debug('state is %s' % state)
-        time.sleep(0.5)   # Give time for beep to play.
         return(state)
 
 
-def make_app(processor):
+def make_app(processor, pageCache=None):
+    if pageCache is None:
+        pageCache = pages.PageCache()
     return tornado.web.Application([
-        (r"/(beep\.wav)", tornado.web.StaticFileHandler, {'path': '.'}),
-        (r"/", MainHandler, dict(processor=processor)),
+        (r"/(beep\.wav)", MyFileHandler, {'path': '.'}),
+        (r"/", MainHandler, dict(processor=processor, pageCache=pageCache)),
+        (r"/command", CommandHandler, dict(processor=processor, pageCache=pageCache)),
+        (r"/plan", PlanHandler),
+        (r"/metrics", MetricsHandler),
     ])
 
 
@@ -168,6 +348,8 @@ if __name__ == "__main__":
     parser.add_argument('--verbose', '-v', help='debug level', type=int,
                         default=0)
     parser.add_argument('--test', '-t', help='enable test mode', default=False)
+    parser.add_argument('--engine', help='execution engine',
+                        choices=['threaded', 'async'], default=params.engine)
     args = parser.parse_args()
     maxSession = int(args.maxSession)*60
     if args.verbose > 1:
@@ -182,30 +364,73 @@ if __name__ == "__main__":
     #syslog_handler = logging.handlers.SysLogHandler(address=('loghost', 514))
     syslog_handler = logging.handlers.SysLogHandler(address='/dev/log')
     syslog_handler.setLevel(logLevel)
-    #syslog_handler.setFormatter(RFC5424Formatter())
-    file_handler = logging.FileHandler(filename='/var/log/surprise.log')
+    #syslog_handler.setFormatter(RFC5424Formatter(cache=True))
+    if params.asyncLogging:
+        file_handler = asyncLogging.BatchedFileHandler(filename='/var/log/surprise.log')
+    else:
+        file_handler = logging.FileHandler(filename='/var/log/surprise.log')
     file_handler.setLevel(logLevel)
     file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-    logger.addHandler(syslog_handler)
-    logger.addHandler(file_handler)
+    listener = None
+    if params.asyncLogging:
+        listener = asyncLogging.install(logger, [syslog_handler, file_handler])
+    else:
+        logger.addHandler(syslog_handler)
+        logger.addHandler(file_handler)
 
     logging.info('%s ------------------------------------------' % params.version)
 
+    if params.audioEngine:
+        startAudioEngine()
+    if args.engine == 'async':
+        # Transitions and timers run on the IOLoop; sounds mustn't block it.
+        playInBackground()
+
     clicker = clicker.Clicker(params.clickerDevice)
-    clickerThread = Thread(name='clicker', target=clicker.handler)
 
+    ioloop = tornado.ioloop.IOLoop.current()
     surprise = Surprise(maxSession, testMode=TEST_MODE,
-                        modes=params.USEFUL_ET232_MODES)
+                        modes=params.USEFUL_ET232_MODES, engine=args.engine,
+                        loop=ioloop.asyncio_loop)
     surpriseThread = Thread(name='surprise', target=surprise.idle)
 
+    # kill -USR1 logs the per-command timing histograms.  The loop runs
+    # the handler, not the signal itself: logging from a raw signal handler
+    # can deadlock on a lock the interrupted code holds.
+    ioloop.asyncio_loop.add_signal_handler(signal.SIGUSR1, lambda: logging.log(
+        max(logLevel, logging.INFO),
+        'device command timing:\n%s' % surprise.device.timing.dump()))
+
     surpriseThread.start()
     logging.info('SurpriseThread running')
-    clickerThread.start()
-    logging.info('clickerThread running')
+    if params.clickerAsync:
+        ioloop.spawn_callback(clicker.run)
+    else:
+        clickerThread = Thread(name='clicker', target=clicker.handler)
+        clickerThread.start()
+        logging.info('clickerThread running')
 
-    processor = Processor(clicker)
+    processor = Processor(clicker,
+                          ioloop=ioloop if args.engine == 'async' else None)
 
-    app = make_app(processor.process)
+    # systemd stops the service with SIGTERM, which would otherwise kill
+    # it without running the atexit handlers.
+    ioloop.asyncio_loop.add_signal_handler(signal.SIGTERM, lambda:
+        ioloop.spawn_callback(processor.stop, ioloop))
+
+    app = make_app(processor.processAsync)
     app.listen(params.port)
     logging.info('%s: listening on %d' % (params.version, params.port))
-    tornado.ioloop.IOLoop.current().start()
+    ioloop.start()
+
+    # Only SIGTERM stops the loop.  The device handler, websocket and
+    # clicker threads never return, so exiting normally would wait for
+    # them forever and never get to the atexit handlers: write out the
+    # recording and the log here and leave.
+    if surprise.device.recorder is not None:
+        surprise.device.recorder.close()
+    logging.info('%s: stopped' % params.version)
+    if listener is not None:
+        listener.stop()
+    logging.shutdown()
+    os._exit(0)
@@ -0,0 +1,244 @@
+'''
+A single thread timer scheduler for Surprise.
+
+threading.Timer starts a new OS thread for every event it schedules.
+This module instead keeps every pending event in a min-heap ordered by
+its deadline on the monotonic clock and fires them all from one
+long-lived thread.
+
+schedule() returns a TimerHandle that can be cancelled.  Timers that
+belong together (e.g. everything scheduled during a session) can be
+created through a TimerGroup so they can all be cancelled at once.
+
+AsyncScheduler offers the same interface on top of an asyncio event loop
+for the async engine, where every timer runs as a loop callback.
+
+VirtualScheduler keeps the same heap on a virtual clock that only moves
+when the caller steps it, so a simulation can run hours of timers in
+milliseconds and in a repeatable order.
+'''
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerHandle():
+    def __init__(self, when, function, args, group=None):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.group = group
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.group:
+            self.group.discard(self)
+
+    def active(self):
+        return not (self.cancelled or self.fired)
+
+
+class TimerGroup():
+    '''A set of timers that can be cancelled together.'''
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.handles = set()
+        self.lock = threading.Lock()
+
+    def schedule(self, secs, function, *args):
+        # Hold the lock until the handle is in the group, so a cancel()
+        # from another thread can't slip in between and miss it.  A timer
+        # that fires meanwhile waits for the lock in discard().
+        with self.lock:
+            handle = self.scheduler.schedule(secs, function, *args, group=self)
+            if handle.active():
+                self.handles.add(handle)
+        return handle
+
+    def discard(self, handle):
+        with self.lock:
+            self.handles.discard(handle)
+
+    def cancel(self):
+        with self.lock:
+            handles = self.handles
+            self.handles = set()
+        for handle in handles:
+            handle.cancelled = True
+        return len(handles)
+
+    def __len__(self):
+        return len(self.handles)
+
+
+class Scheduler():
+    def __init__(self, name='scheduler', clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(name=self.name, target=self.run,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def now(self):
+        return self.clock()
+
+    def schedule(self, secs, function, *args, group=None):
+        handle = TimerHandle(self.clock() + secs, function, args, group)
+        with self.cond:
+            heapq.heappush(self.heap, (handle.when, next(self.counter), handle))
+            # Only wake the thread if this is the new earliest deadline.
+            if self.heap[0][2] is handle:
+                self.cond.notify()
+        return handle
+
+    def group(self):
+        return TimerGroup(self)
+
+    def pending(self):
+        with self.cond:
+            return sum(1 for (_, _, handle) in self.heap if handle.active())
+
+    def queued(self):
+        '''Like pending() but without taking the lock, so it also counts
+           cancelled timers that haven't reached the top of the heap yet.
+        '''
+        return len(self.heap)
+
+    def run(self):
+        logging.info('%s running' % self.name)
+        while True:
+            with self.cond:
+                while self.running:
+                    # Drop cancelled timers lazily as they reach the top.
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - self.clock()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if not self.running:
+                    return
+                (_, _, handle) = heapq.heappop(self.heap)
+                handle.fired = True
+            if handle.group:
+                handle.group.discard(handle)
+            try:
+                handle.function(*handle.args)
+            except Exception as e:
+                logging.exception('%s: timer %s failed: %s' % (
+                                  self.name, handle.function, e))
+
+
+class AsyncScheduler():
+    '''Scheduler with the same interface that fires timers as callbacks on
+       an asyncio event loop (e.g. the tornado IOLoop) instead of a thread.
+       Timers may be scheduled from other threads; they are handed over to
+       the loop thread.
+    '''
+    def __init__(self, loop, name='async-scheduler'):
+        self.loop = loop
+        self.name = name
+        self.handles = set()
+        self.threadId = threading.get_ident()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        for handle in list(self.handles):
+            handle.cancel()
+        self.handles.clear()
+
+    def now(self):
+        return self.loop.time()
+
+    def schedule(self, secs, function, *args, group=None):
+        handle = TimerHandle(self.now() + secs, function, args, group)
+        self.handles.add(handle)
+        if threading.get_ident() == self.threadId:
+            self.loop.call_later(secs, self.fire, handle)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_at, handle.when,
+                                           self.fire, handle)
+        return handle
+
+    def group(self):
+        return TimerGroup(self)
+
+    def pending(self):
+        return sum(1 for handle in list(self.handles) if handle.active())
+
+    def queued(self):
+        return len(self.handles)
+
+    def fire(self, handle):
+        self.handles.discard(handle)
+        if handle.cancelled:
+            return
+        handle.fired = True
+        if handle.group:
+            handle.group.discard(handle)
+        try:
+            handle.function(*handle.args)
+        except Exception as e:
+            logging.exception('%s: timer %s failed: %s' % (
+                              self.name, handle.function, e))
+
+
+class VirtualScheduler(Scheduler):
+    '''Scheduler on a virtual clock.  Nothing runs on its own: step()
+       moves the clock to the next deadline and fires that timer on the
+       calling thread.  Exceptions from timers are not caught.
+    '''
+    def __init__(self, name='virtual-scheduler', start=0.0):
+        self.time = start
+        super(VirtualScheduler, self).__init__(name, clock=lambda: self.time)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def step(self, until=None):
+        '''Fire the next timer due no later than until.  Returns False
+           (and leaves the clock alone) if there is none.
+        '''
+        with self.cond:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if not self.heap or (until is not None and self.heap[0][0] > until):
+                return False
+            (when, _, handle) = heapq.heappop(self.heap)
+            handle.fired = True
+        self.time = max(self.time, when)
+        if handle.group:
+            handle.group.discard(handle)
+        handle.function(*handle.args)
+        return True
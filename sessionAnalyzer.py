@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+'''
+Monte Carlo analysis of the session timing parameters in params.py.
+
+Reimplements the timing logic of Surprise (delay, calculateTime and the
+mode/power change scheduling in turnOn) as NumPy operations over a whole
+batch of sessions at once, so millions of sessions take seconds.  For
+every session it measures, from startSurprise to the end of the session:
+
+  length   actual session length (the session timer, or the first turn
+           on/off once the planned time is used up)
+  on       seconds spent On
+  off      seconds spent Starting or Off
+  teases   number of teased (shortened) on/off cycles
+  changes  mode/power changes in each On cycle (including the first)
+
+--check runs sessions through the real Surprise code (simulation.py)
+with the same parameters and fails if any mean is out of line.
+
+    ./sessionAnalyzer.py --sessions 1000000
+    ./sessionAnalyzer.py --ESTIM_ON_MAX 240 --TEASE_PERCENT 10 --check 500
+
+Requires numpy.
+'''
+
+import argparse
+import numpy as np
+import params
+import sys
+import time
+
+Parameters = ('DELAY_MIN', 'START_SLEEP_MAX', 'ESTIM_ON_MAX', 'ESTIM_OFF_MAX',
+              'ADD_ON_PERCENT', 'ADD_OFF_PERCENT', 'TEASE_PERCENT')
+Metrics = ('length', 'on', 'off', 'teases', 'changes')
+
+
+class Analyzer():
+    def __init__(self, rng, maxSession=params.MAX_SESSION_TIME, **settings):
+        self.rng = rng
+        self.maxSession = maxSession
+        for name in Parameters:
+            setattr(self, name, settings.get(name, getattr(params, name)))
+
+    def randint(self, low, high):
+        '''random.randint (both ends inclusive) for arrays of bounds.
+           Scaling uniform floats is much faster than rng.integers with
+           array bounds.
+        '''
+        low = np.asarray(low)
+        span = np.asarray(high) - low + 1
+        return low + (self.rng.random(low.shape) * span).astype(np.int64)
+
+    def percent(self, n, percentage):
+        '''random.randint(0, 100) < percentage, n times.'''
+        return self.rng.random(n) < percentage / 101
+
+    def calculateTime(self, n, max, percentage):
+        '''Surprise.calculateTime for n cycles: (secs, teased).'''
+        secs = self.randint(np.full(n, self.DELAY_MIN), max).astype(float)
+        adding = np.arange(n)
+        while adding.size:
+            adding = adding[self.percent(adding.size, percentage)]
+            secs[adding] += self.randint(np.full(adding.size, self.DELAY_MIN), max)
+        teased = (secs > 10) & self.percent(n, self.TEASE_PERCENT)
+        secs[teased] /= 10
+        return (secs, teased)
+
+    def modeChanges(self, secs, duration):
+        '''Changes that happen within duration of an On cycle lasting secs
+           (the scheduling loop in Surprise.turnOn).
+        '''
+        changes = np.ones(secs.size, dtype=np.int64)
+        t = np.zeros(secs.size, dtype=np.int64)
+        active = np.flatnonzero(secs - t > 120)
+        while active.size:
+            t[active] = self.randint(np.maximum(60, t[active]),
+                                     secs[active].astype(np.int64) - 20)
+            changes[active] += t[active] < duration[active]
+            active = active[secs[active] - t[active] > 120]
+        return changes
+
+    def run(self, n):
+        '''Simulate n sessions; returns a dict of metric arrays.'''
+        elapsed = self.randint(np.full(n, self.DELAY_MIN),
+                               self.START_SLEEP_MAX).astype(float)
+        planned = np.zeros(n)
+        on = np.zeros(n)
+        off = elapsed.copy()
+        teases = np.zeros(n, dtype=np.int64)
+        changes = []
+        sessions = np.arange(n)
+        turningOn = True
+        while True:
+            # turnOn/turnOff run only while the session timer hasn't
+            # fired, and end the session once the planned time is used up.
+            sessions = sessions[(elapsed[sessions] < self.maxSession) &
+                                (planned[sessions] <= self.maxSession)]
+            if not sessions.size:
+                break
+            if turningOn:
+                (secs, teased) = self.calculateTime(
+                    sessions.size, self.ESTIM_ON_MAX, self.ADD_ON_PERCENT)
+            else:
+                (secs, teased) = self.calculateTime(
+                    sessions.size, self.ESTIM_OFF_MAX, self.ADD_OFF_PERCENT)
+            duration = np.minimum(secs, self.maxSession - elapsed[sessions])
+            if turningOn:
+                on[sessions] += duration
+                changes.append(self.modeChanges(secs, duration))
+            else:
+                off[sessions] += duration
+            planned[sessions] += secs
+            teases[sessions] += teased
+            elapsed[sessions] += secs
+            turningOn = not turningOn
+        return {
+            'length': np.minimum(elapsed, self.maxSession),
+            'on': on,
+            'off': off,
+            'teases': teases,
+            'changes': np.concatenate(changes) if changes else np.zeros(0),
+        }
+
+
+def simulated(sessions, maxSession, settings):
+    '''The same metrics measured from sessions run by simulation.py.'''
+    for (name, value) in settings.items():
+        setattr(params, name, value)
+    import simulation
+    metrics = {name: [] for name in Metrics}
+    for seed in range(sessions):
+        session = simulation.simulate(seed, maxSession, button=True)
+        start = next(when for (when, kind, detail) in session.events
+                     if kind == 'state' and detail[0] == 'Starting')
+        end = session.result['ended']
+        spent = {'Starting': 0.0, 'On': 0.0, 'Off': 0.0}
+        state = None
+        for (when, kind, detail) in session.events:
+            if kind == 'state':
+                state = detail[0]
+                if state in spent:
+                    spent[state] += min(detail[1], end - when)
+                if state == 'On':
+                    metrics['changes'].append(0)
+            elif kind == 'ws' and detail[0] == 'status' and state == 'On':
+                metrics['changes'][-1] += 1
+        metrics['length'].append(end - start)
+        metrics['on'].append(spent['On'])
+        metrics['off'].append(spent['Starting'] + spent['Off'])
+        metrics['teases'].append(session.result['teases'])
+    return {name: np.array(values, dtype=float) for (name, values) in metrics.items()}
+
+
+def report(results):
+    print('%-8s %10s %10s %10s %10s %10s %10s' % (
+          'metric', 'mean', 'std', 'p5', 'p50', 'p95', 'max'))
+    for name in Metrics:
+        values = results[name]
+        (p5, p50, p95) = np.percentile(values, (5, 50, 95))
+        print('%-8s %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f' % (
+              name, values.mean(), values.std(), p5, p50, p95, values.max()))
+
+
+def check(results, expected):
+    '''Compare means; a difference of more than 4 standard errors fails.'''
+    ok = True
+    for name in Metrics:
+        (a, b) = (results[name], expected[name])
+        error = np.sqrt(a.var() / a.size + b.var() / b.size)
+        within = abs(a.mean() - b.mean()) <= 4 * error
+        ok = ok and within
+        print('%-8s analyzer %10.2f  simulation %10.2f  +/- %.2f  %s' % (
+              name, a.mean(), b.mean(), error, 'ok' if within else 'MISMATCH'))
+    return ok
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=250000,
+                        help='sessions sampled at once')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--maxSession', type=int,
+                        default=params.MAX_SESSION_TIME // 60,
+                        help='maximum time for session in minutes')
+    parser.add_argument('--check', type=int, default=0, metavar='SESSIONS',
+                        help='also run this many sessions through Surprise')
+    for name in Parameters:
+        parser.add_argument('--' + name, type=int, default=getattr(params, name))
+    args = parser.parse_args(argv[1:])
+    settings = {name: getattr(args, name) for name in Parameters}
+    maxSession = args.maxSession * 60
+
+    started = time.monotonic()
+    analyzer = Analyzer(np.random.default_rng(args.seed), maxSession, **settings)
+    batches = []
+    for first in range(0, args.sessions, args.batch):
+        batches.append(analyzer.run(min(args.batch, args.sessions - first)))
+    results = {name: np.concatenate([batch[name] for batch in batches])
+               for name in Metrics}
+    print('%d sessions in %.1fs: %s, maxSession %ds' % (
+          args.sessions, time.monotonic() - started,
+          ', '.join('%s %d' % item for item in settings.items()), maxSession))
+    report(results)
+
+    if args.check:
+        if not check(results, simulated(args.check, maxSession, settings)):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,179 @@
+'''
+Session plans: the whole of a session worked out up front.
+
+Without a plan, turnOn and turnOff draw each interval when the previous
+one ends.  generate() makes the same draws (interval() and
+changeTimes() are shared with Surprise) but yields the session as a
+sequence of timed steps: each on and off interval, the mode/power
+changes within the on intervals, and the end of the session.  The mode
+and MA of every on and change step are settled here too, so a step's
+timer only applies them and a seeded plan says everything the session
+will do.
+
+A SessionPlan stores the steps in typed arrays, either all of them when
+the session starts (eager) or as they are needed (lazy), and Surprise
+steps through it with a single timer.  preview() is what the /plan
+endpoint shows.
+'''
+
+from array import array
+import params
+
+ON, CHANGE, OFF, END = range(4)
+Kinds = ('on', 'change', 'off', 'end')
+
+
+def interval(rng, max, percentage, min=None):
+    '''The draws of Surprise.calculateTime: (secs, amounts, teased).'''
+    if min is None:
+        min = params.DELAY_MIN
+    secs = rng.randint(min, max)
+    amounts = [secs]
+    while rng.randint(0, 100) < percentage:
+        more = rng.randint(min, max)
+        secs += more
+        amounts.append(more)
+    teased = secs > 10 and rng.randint(0, 100) < params.TEASE_PERCENT
+    if teased:
+        secs /= 10
+    return (secs, amounts, teased)
+
+
+def changeTimes(rng, secs):
+    '''When the mode/power changes within an on interval of secs happen.'''
+    times = []
+    t = 0
+    while (secs - t) > 120:
+        # secs may be fractional after a tease.
+        t = rng.randint(max(60,t),int(secs)-20)
+        times.append(t)
+    return times
+
+
+def generate(rng, maxSession, start, modes, modeIndex, maRange):
+    '''Yield (at, kind, secs, level, teased, mode, ma) steps for a session
+       whose first on interval starts at start.  at is seconds since the
+       session started, level an index into params.onCommand and mode an
+       index into modes (both -1 if none; ma only counts with a mode).
+       Modes go round modes from modeIndex, as Surprise.nextMode does, and
+       MA is drawn from maRange (low, high).  Ends like the live session:
+       at maxSession, or at the first on/off once the planned time exceeds
+       maxSession.
+    '''
+    def change():
+        nonlocal modeIndex
+        level = rng.randint(0, len(params.onCommand) - 1)
+        mode = modeIndex % len(modes)
+        modeIndex += 1
+        return (level, mode, rng.randint(*maRange))
+
+    at = start
+    planned = 0
+    kind = ON
+    while at < maxSession and planned <= maxSession:
+        if kind == ON:
+            (secs, _, teased) = interval(rng, params.ESTIM_ON_MAX,
+                                         params.ADD_ON_PERCENT)
+            times = changeTimes(rng, secs)
+            (level, mode, ma) = change()
+            yield (at, ON, secs, level, teased, mode, ma)
+            for t in times:
+                if at + t >= maxSession:
+                    break
+                (level, mode, ma) = change()
+                yield (at + t, CHANGE, 0, level, False, mode, ma)
+            kind = OFF
+        else:
+            (secs, _, teased) = interval(rng, params.ESTIM_OFF_MAX,
+                                         params.ADD_OFF_PERCENT)
+            yield (at, OFF, secs, -1, teased, -1, 0)
+            kind = ON
+        at += secs
+        planned += secs
+    yield (min(at, maxSession), END, 0, -1, False, -1, 0)
+
+
+class SessionPlan():
+    def __init__(self, steps, modes, eager=True):
+        '''modes are the mode names the steps' mode indexes refer to.'''
+        self.source = iter(steps)
+        self.modes = tuple(modes)
+        self.at = array('d')
+        self.kind = array('B')
+        self.secs = array('d')
+        self.level = array('b')
+        self.teased = array('B')
+        self.mode = array('b')
+        self.ma = array('h')
+        self.position = 0
+        self.complete = False
+        self.eager = eager
+        if eager:
+            while self.extend():
+                pass
+
+    def __len__(self):
+        return len(self.kind)
+
+    def extend(self):
+        '''Generate one more step; False once the plan is complete.'''
+        if self.complete:
+            return False
+        (at, kind, secs, level, teased, mode, ma) = next(self.source)
+        # Append kind last: readers use len(self.kind).
+        self.at.append(at)
+        self.secs.append(secs)
+        self.level.append(level)
+        self.teased.append(teased)
+        self.mode.append(mode)
+        self.ma.append(ma)
+        self.kind.append(kind)
+        self.complete = (kind == END)
+        return True
+
+    def step(self, index):
+        while index >= len(self) and self.extend():
+            pass
+        if index >= len(self):
+            return None
+        return (self.at[index], self.kind[index], self.secs[index],
+                self.level[index], bool(self.teased[index]),
+                self.mode[index], self.ma[index])
+
+    def advance(self):
+        '''The next step, or None after the end.'''
+        step = self.step(self.position)
+        if step is not None:
+            self.position += 1
+        return step
+
+    def peek(self):
+        return self.step(self.position)
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in
+                   (self.at, self.kind, self.secs, self.level, self.teased,
+                    self.mode, self.ma))
+
+    def preview(self):
+        '''The steps generated so far, for display.'''
+        steps = []
+        for index in range(len(self.kind)):
+            level = self.level[index]
+            mode = self.mode[index]
+            steps.append({
+                'at': self.at[index],
+                'kind': Kinds[self.kind[index]],
+                'secs': self.secs[index],
+                'level': params.onCommand[level] if level >= 0 else None,
+                'mode': self.modes[mode] if mode >= 0 else None,
+                'ma': self.ma[index] if mode >= 0 else None,
+                'teased': bool(self.teased[index]),
+            })
+        return {
+            'mode': 'eager' if self.eager else 'lazy',
+            'complete': self.complete,
+            'position': self.position,
+            'bytes': self.nbytes(),
+            'steps': steps,
+        }
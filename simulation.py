@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+'''
+Deterministic simulation of Surprise sessions.
+
+Surprise is run on a VirtualScheduler with a random.Random seeded for
+the session and a RecordingDevice in place of the estim device handler.
+No threads, sockets, sounds or real waiting are involved, so a full
+MAX_SESSION_TIME session takes milliseconds and the same seed always
+produces the same session (compare Session.digest()).  A reported
+session can be replayed event by event from its seed.
+
+    ./simulation.py --sessions 1000        # summary over many seeds
+    ./simulation.py --seed 42 --events     # replay one session
+    ./simulation.py --record FILE          # commandRecording of the sessions
+'''
+
+import argparse
+from commandRecording import Recorder
+import hashlib
+import json
+import logging
+import params
+import random
+from scheduler import VirtualScheduler
+from Surprise import Surprise
+from SurpriseClient import genericDeviceHandler
+import sys
+import time
+
+
+class RecordingDevice(genericDeviceHandler):
+    '''Takes the place of the device handler: records every command
+       Surprise queues instead of sending it anywhere.
+    '''
+    def __init__(self, rng, record, max_a=params.HARD_MAX_A,
+                 max_b=params.HARD_MAX_B):
+        super(RecordingDevice, self).__init__(None, max_a, max_b)
+        self.rng = rng
+        self.record = record
+
+    def randomMA(self):
+        return self.rng.randint(self.ma_low, self.ma_high)
+
+    def drain(self):
+        while not self.queue.empty():
+            command = self.queue.get()
+            self.queue.task_done()
+            # Timing stamps are wall clock; keep them out of the digest.
+            command.pop('stamps', None)
+            self.record('cmd', command)
+            if self.recorder is not None:
+                self.recorder.record(command)
+
+
+class SimulatedSurprise(Surprise):
+    '''Surprise that records its state changes and session totals.'''
+    def __init__(self, record, *args, **kwargs):
+        self.record = record
+        self.result = None
+        super(SimulatedSurprise, self).__init__(*args, **kwargs)
+
+    def setState(self, state, secs=0):
+        self.record('state', [state, secs])
+        super(SimulatedSurprise, self).setState(state, secs)
+
+    def endSession(self):
+        if self.result is None:
+            self.result = {'ended': self.clock(), 'planned': self.sessionTime,
+                           'on': self.onTime, 'off': self.offTime,
+                           'teases': self.teases}
+        super(SimulatedSurprise, self).endSession()
+
+
+class Session():
+    def __init__(self, seed, events, result, elapsed):
+        self.seed = seed
+        self.events = events
+        self.result = result
+        self.elapsed = elapsed
+
+    def completed(self):
+        return self.result is not None
+
+    def count(self, kind):
+        return sum(1 for (_, k, _) in self.events if k == kind)
+
+    def periods(self, state):
+        return sum(1 for (_, k, d) in self.events if k == 'state' and d[0] == state)
+
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.events).encode()).hexdigest()
+
+
+def simulate(seed, maxSession=params.MAX_SESSION_TIME, button=False,
+             recording=None):
+    '''Run one session: activate, start (by the failsafe timer, or at once
+       with button=True) and run until the session has ended.  With a
+       recording path the device commands are appended to it, on the
+       virtual clock.
+    '''
+    started = time.monotonic()
+    events = []
+    scheduler = VirtualScheduler()
+    rng = random.Random(seed)
+
+    def record(kind, detail):
+        events.append((scheduler.now(), kind, detail))
+
+    device = RecordingDevice(rng, record)
+    if recording:
+        device.recorder = Recorder(recording, clock=scheduler.now)
+    surprise = SimulatedSurprise(record, maxSession, rng=rng,
+                                 scheduler=scheduler, clock=scheduler.now,
+                                 device=device,
+                                 sound=lambda name: record('sound', name),
+                                 services=False)
+    device.queue = surprise.queue
+
+    def drain():
+        device.drain()
+        while not surprise.wsQueue.empty():
+            message = surprise.wsQueue.get()
+            surprise.wsQueue.task_done()
+            record('ws', [message['field'], message['value']])
+
+    surprise.startWait()
+    if button:
+        surprise.startSurprise()
+    drain()
+    # Sessions end on their own; the limit only stops a broken one.
+    limit = params.FAILSAFE_START + 2 * maxSession
+    while surprise.result is None and scheduler.step(until=limit):
+        drain()
+    if device.recorder is not None:
+        device.recorder.close()
+    return Session(seed, events, surprise.result, time.monotonic() - started)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0,
+                        help='first (or only) seed')
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--maxSession', type=int,
+                        default=params.MAX_SESSION_TIME // 60,
+                        help='maximum time for session in minutes')
+    parser.add_argument('--button', action='store_true',
+                        help='start with the button rather than the failsafe')
+    parser.add_argument('--events', action='store_true',
+                        help='print every event of each session')
+    parser.add_argument('--plan', choices=('eager', 'lazy'), default=None,
+                        help='run sessions from a session plan')
+    parser.add_argument('--record', metavar='FILE', default=None,
+                        help='append each session\'s device commands to FILE')
+    args = parser.parse_args(argv[1:])
+    params.sessionPlan = args.plan
+    logging.getLogger().setLevel(logging.ERROR)
+
+    sessions = []
+    for seed in range(args.seed, args.seed + args.sessions):
+        session = simulate(seed, args.maxSession * 60, args.button, args.record)
+        sessions.append(session)
+        if args.events:
+            for (when, kind, detail) in session.events:
+                print('%8.1f %-5s %s' % (when, kind, detail))
+        if args.sessions == 1 or args.events:
+            print('seed %d: %s %s' % (seed, session.result, session.digest()))
+
+    done = [s for s in sessions if s.completed()]
+    print('%d sessions, %d completed, %.2fms each' % (
+          len(sessions), len(done),
+          sum(s.elapsed for s in sessions) / len(sessions) * 1000))
+    if done:
+        print('mean: ended %.0fs, on %.0fs, off %.0fs, %.1f on periods, '
+              '%.1f device commands' % (
+              sum(s.result['ended'] for s in done) / len(done),
+              sum(s.result['on'] for s in done) / len(done),
+              sum(s.result['off'] for s in done) / len(done),
+              sum(s.periods('On') for s in done) / len(done),
+              sum(s.count('cmd') for s in done) / len(done)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
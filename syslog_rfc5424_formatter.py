@@ -1,4 +1,5 @@
 import logging
+import math
 import time
 import socket
 import datetime
@@ -8,6 +9,9 @@ version_info = (1, 2, 2)
 __version__ = '.'.join(str(s) for s in version_info)
 __author__ = 'EasyPost <oss@easypost.com>'
 
+# The header for cache=True: isotime, hostname, name, procid, msgid, sd
+HEADER = '1 %s %s %s %s %s %s '
+
 
 class RFC5424FormatterError(Exception):
     pass
@@ -52,14 +56,23 @@ class RFC5424Formatter(logging.Formatter, object):
 
        1. Construct the logger with an sd_id kwarg (or set the `sd_id` attribute on the logger object)
        2. Construct your individual records with `{'args': {'structured_data': {'iut': '3'}}}`
+
+    With cache=True the hostname and timezone suffix are looked up at most
+    once per second (when a record from a new second comes along) instead
+    of for every record, and the date and time part of the timestamp is
+    rendered once per second.  The output is the same.
     '''
-    def __init__(self, fmt='%(message)s', datefmt=None, style='%', procid=None, msgid=None, sd_id=None):
+    def __init__(self, fmt='%(message)s', datefmt=None, style='%', procid=None, msgid=None, sd_id=None,
+                 cache=False):
         # note: we accept and throw away "style" because our stuff only works with %
         # we also accept and throw away datefmt for similar reasons
         self._tz_fix = re.compile(r'([+-]\d{2})(\d{2})$')
         self._procid = procid
         self._msgid = msgid
         self._sd_id = sd_id
+        self._cache = cache
+        # (second, 'YYYY-MM-DDTHH:MM:SS', hostname, timezone suffix)
+        self._cached = (None, None, None, None)
         return super(RFC5424Formatter, self).__init__(fmt=fmt, datefmt=None)
 
     @property
@@ -91,21 +104,50 @@ class RFC5424Formatter(logging.Formatter, object):
             raise InvalidSDIDError('SD-ID cannot be empty')
         self._sd_id = sd_id
 
-    def format(self, record):
+    def _hostname(self):
         try:
-            record.__dict__['hostname'] = socket.gethostname()
+            return socket.gethostname()
         except Exception:
-            record.__dict__['hostname'] = '-'
-        isotime = datetime.datetime.fromtimestamp(record.created).isoformat()
+            return '-'
+
+    def _tz_suffix(self):
         tz = self._tz_fix.match(time.strftime('%z'))
         if time.timezone and tz:
             (offset_hrs, offset_min) = tz.groups()
             if int(offset_hrs) == 0 and int(offset_min) == 0:
-                isotime = isotime + 'Z'
-            else:
-                isotime = '{0}{1}:{2}'.format(isotime, offset_hrs, offset_min)
+                return 'Z'
+            return '{0}:{1}'.format(offset_hrs, offset_min)
+        return 'Z'
+
+    def _isotime_cached(self, created):
+        # datetime.fromtimestamp() rounds to the microsecond half to even,
+        # carrying into the next second, and isoformat() leaves out a zero
+        # fraction.
+        (frac, whole) = math.modf(created)
+        usec = round(frac * 1e6)
+        if usec >= 1000000:
+            (whole, usec) = (whole + 1.0, usec - 1000000)
+        elif usec < 0:
+            (whole, usec) = (whole - 1.0, usec + 1000000)
+        second = int(whole)
+
+        cached = self._cached
+        if cached[0] != second:
+            stamp = datetime.datetime.fromtimestamp(second).isoformat()
+            cached = self._cached = (second, stamp, self._hostname(), self._tz_suffix())
+
+        if usec:
+            return ('%s.%06d%s' % (cached[1], usec, cached[3]), cached[2])
+        return (cached[1] + cached[3], cached[2])
+
+    def format(self, record):
+        if self._cache:
+            (isotime, hostname) = self._isotime_cached(record.created)
+            record.__dict__['hostname'] = hostname
         else:
-            isotime = isotime + 'Z'
+            record.__dict__['hostname'] = self._hostname()
+            isotime = datetime.datetime.fromtimestamp(record.created).isoformat()
+            isotime = isotime + self._tz_suffix()
 
         record.__dict__['isotime'] = isotime
         record.__dict__['procid'] = self.procid if self.procid else record.process
@@ -148,7 +190,12 @@ class RFC5424Formatter(logging.Formatter, object):
             if key in record.args:
                 record.__dict__[key] = record.args.pop(key)
 
-        header = '1 {isotime} {hostname} {name} {procid} {msgid} {sd} '.format(
-            **record.__dict__
-        )
+        if self._cache:
+            header = HEADER % (record.__dict__['isotime'], record.__dict__['hostname'],
+                               record.name, record.__dict__['procid'],
+                               record.__dict__['msgid'], record.__dict__['sd'])
+        else:
+            header = '1 {isotime} {hostname} {name} {procid} {msgid} {sd} '.format(
+                **record.__dict__
+            )
         return header + super(RFC5424Formatter, self).format(record)
@@ -1,20 +1,39 @@
 #!/usr/bin/env python
 
-# WS server that sends messages at random intervals
+# WS server that sends status updates to every connected browser.
+#
+# Updates are read once from the producer queue and fanned out to each
+# client through its own bounded buffer, so a slow client only ever
+# delays itself.
 
 import asyncio
 import logging
+import params
 import queue
 import sys
 import websockets
 
 class wsHandler():
-    def __init__(self, surprise, queue, listenAddr="0.0.0.0", port=8889):
+    def __init__(self, surprise, queue, listenAddr="0.0.0.0", port=8889,
+                 bufferSize=params.wsClientBuffer,
+                 slowClient=params.wsSlowClient):
+        '''slowClient decides what happens when a client's buffer is full:
+           'drop' discards its oldest pending update, 'disconnect' closes
+           the client.
+        '''
         self.surprise = surprise
         self.queue = queue
         self.listenAddr = listenAddr
         self.port = port
+        self.bufferSize = bufferSize
+        self.slowClient = slowClient
         self.lastmsg = {'field': '?', 'value': ''}
+        self.latest = {}
+        self.clients = {}
+        self.sent = 0
+        self.dropped = 0
+        # The loop only keeps weak references to tasks: hold on to ours.
+        self.tasks = set()
 
     def getStatus(self):
         (status, interval, elapsed, total) = self.surprise.timerStatus()
@@ -24,27 +43,96 @@ class wsHandler():
             return ('%s %d/%ds,  %ds total' %
                     (status, elapsed, interval, total))
 
-    def start(self):
-        async def process(websocket, path):
+    async def process(self, websocket, path):
+        buffer = asyncio.Queue(maxsize=self.bufferSize)
+        self.clients[websocket] = buffer
+        logging.info('wsHandler: %d clients' % len(self.clients))
+        try:
+            if params.wsProtocol == 'event':
+                await self.sendEvents(websocket, buffer)
             while True:
                 try:
-                    msg = self.queue.get(timeout=0.5)
-                except queue.Empty:
+                    msg = await asyncio.wait_for(buffer.get(), 0.5)
+                except asyncio.TimeoutError:
                     msg = self.lastmsg
                 # logging.debug('wsHandler: processing %s' % msg)
-                try:
-                    await websocket.send('timer:%s' % self.getStatus())
-                    await websocket.send('%s:%s' % (msg['field'], msg['value']))
-                except websockets.exceptions.ConnectionClosed:
-                    logging.info('Connection closed.')
-                    return
-                self.lastmsg = msg
+                await websocket.send('timer:%s' % self.getStatus())
+                await websocket.send('%s:%s' % (msg['field'], msg['value']))
+                self.sent += 2
+        except websockets.exceptions.ConnectionClosed:
+            logging.info('Connection closed.')
+        finally:
+            self.clients.pop(websocket, None)
 
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        start_server = websockets.serve(process, self.listenAddr, self.port)
+    async def sendEvents(self, websocket, buffer):
+        '''Event protocol: bring a new client up to date with the latest
+           value of every field, then send updates only as they happen.
+        '''
+        for msg in list(self.latest.values()):
+            await websocket.send('%s:%s' % (msg['field'], msg['value']))
+        while True:
+            msg = await buffer.get()
+            await websocket.send('%s:%s' % (msg['field'], msg['value']))
+            self.sent += 1
+
+    async def pump(self):
+        '''Read each update from the producer queue once and publish it.'''
+        while True:
+            msg = await self.nextMessage()
+            self.lastmsg = msg
+            self.latest[msg['field']] = msg
+            self.publish(msg)
+
+    def publish(self, msg):
+        for (websocket, buffer) in list(self.clients.items()):
+            try:
+                buffer.put_nowait(msg)
+                continue
+            except asyncio.QueueFull:
+                self.dropped += 1
+            if self.slowClient == 'disconnect':
+                logging.info('wsHandler: disconnecting slow client %s' %
+                             (websocket.remote_address,))
+                self.clients.pop(websocket, None)
+                self.spawn(self.disconnect(websocket))
+            else:
+                buffer.get_nowait()
+                buffer.put_nowait(msg)
+
+    async def disconnect(self, websocket):
+        try:
+            await websocket.close(code=1013)
+        except websockets.exceptions.ConnectionClosed:
+            # Gone before the close handshake finished.
+            pass
+
+    def spawn(self, coroutine, loop=None):
+        task = asyncio.ensure_future(coroutine, loop=loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.taskDone)
+        return task
+
+    def taskDone(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error('wsHandler: %s failed' % task.get_coro().__qualname__,
+                          exc_info=task.exception())
+
+    async def nextMessage(self):
+        if hasattr(self.queue, 'aget'):
+            return await self.queue.aget()
+        return await asyncio.get_event_loop().run_in_executor(None, self.queue.get)
+
+    async def serve(self):
+        '''Start the websocket server on the running event loop.'''
+        server = await websockets.serve(self.process, self.listenAddr, self.port)
+        self.spawn(self.pump())
         logging.info('wsHandler listening on %s:%s' % (self.listenAddr, self.port))
+        return server
 
-        asyncio.get_event_loop().run_until_complete(start_server)
+    def start(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        asyncio.get_event_loop().run_until_complete(self.serve())
         asyncio.get_event_loop().run_forever()
 
 